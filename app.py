@@ -14,11 +14,14 @@ from math import ceil # Needed for pagination
 from flask import (
     Flask, Response, request, render_template, abort,
     send_from_directory, url_for, jsonify, redirect, make_response,
-    flash, session, send_file
+    flash, session, send_file, stream_with_context
 )
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 from urllib.parse import quote, unquote, urljoin
 
+import json # Listing cursors
+import base64 # Listing cursors
 import platform # To check OS type
 import math # For GB conversion
 # Import ctypes ONLY if on Windows
@@ -31,6 +34,17 @@ else: # POSIX specific imports
 import config  # Import configuration
 import auth    # Import authentication logic
 import file_utils # Import file system utilities
+import streaming  # Range response bodies (sendfile / generator)
+import thumbnails # Grid thumbnail derivative cache
+import uploads    # Resumable chunked upload sessions
+import hls        # HLS playlists and lazily transcoded segments
+import transcoder # Background quality-variant job queue
+import bandwidth  # Fair-share bandwidth scheduler
+import text_index # Paged text viewer (line-offset index)
+import compression # Response compression, fingerprinted static assets
+import metadata   # Media metadata cache (background extraction)
+import faststart  # Virtual moov-first layout for MP4s indexed at the end
+import zipstream  # Folder downloads as streamed ZIP64 archives
 
 # --- Flask App Initialization & Configuration ---
 app = Flask(__name__, template_folder='templates', static_folder='static')
@@ -53,12 +67,31 @@ app.logger.info(f"File System Encoding: {config.FILESYSTEM_ENCODING}")
 if config.PASSWORD_HASH.startswith("pbkdf2:sha256:..."):
     app.logger.critical("!!! SECURITY WARNING: Default password hash detected. App is insecure. Generate and set a real hash in config.py !!!")
 
+# --- Background Services ---
+@app.before_request
+def start_background_services():
+    """Starts per-process background threads lazily, so they run in each (forked) worker rather than the master."""
+    file_utils.start_library_indexer()
+    transcoder.start_worker()
+    metadata.start_workers()
+
 # --- Context Processor to Inject Variables into Templates ---
 @app.context_processor
 def inject_now():
     """Makes the current timezone-aware UTC datetime available to all templates."""
     return {'now': datetime.datetime.now(datetime.timezone.utc)}
 
+@app.context_processor
+def inject_asset_url():
+    """Makes asset_url() (content-hashed, immutable static URLs) available to all templates."""
+    return {'asset_url': compression.asset_url}
+
+# --- Response Compression ---
+@app.after_request
+def compress_response(response):
+    """Gzip/brotli for buffered text-like responses (pages, JSON, playlists) the client accepts."""
+    return compression.compress_response(request, response)
+
 # --- Helper Function ---
 def get_relative_path_from_request(path_arg=""):
     """Safely decodes and normalizes the path from the request argument."""
@@ -78,26 +111,15 @@ def get_validated_item_paths(parent_path_from_url, item_id):
     cleaned_parent_path = get_relative_path_from_request(parent_path_from_url)
     app.logger.debug(f"Action Request: URL Parent='{parent_path_from_url}', Item='{item_id}'. Clean Parent='{cleaned_parent_path}'")
 
-    item_full_relative_path = file_utils.find_path_by_id(cleaned_parent_path, item_id)
-    if item_full_relative_path is None:
+    item = file_utils.find_item_by_id(cleaned_parent_path, item_id)
+    if item is None:
         app.logger.error(f"Action failed: Could not find ID '{item_id}' in parent '{cleaned_parent_path}'")
         abort(404, description="Item ID not found in the specified path.")
+    item_full_relative_path = item['path']
 
-    # Determine if it's a file or dir using relative path BEFORE getting absolute
-    # This avoids issues if absolute path fails temporarily
-    is_dir = None
-    temp_abs_path_check = file_utils.get_safe_fullpath(item_full_relative_path)
-    if temp_abs_path_check:
-         try:
-            if os.path.isdir(temp_abs_path_check): is_dir = True
-            elif os.path.isfile(temp_abs_path_check): is_dir = False
-         except OSError: pass # Handle potential race condition/error
-
-    # Now get final absolute path for return
+    # Type comes from the listing index; a single existence check guards against deletes since the scan
+    is_dir = item['type'] == 'folder'
     target_item_abs = file_utils.get_safe_fullpath(item_full_relative_path)
-
-    # Check if it exists and is the expected type (file for most actions, dir/file for delete)
-    # Allow None for is_dir if check failed, but target_item_abs must exist
     if target_item_abs is None or not os.path.exists(target_item_abs):
          app.logger.error(f"Action failed: Path unsafe or item does not exist. Relative='{item_full_relative_path}', Absolute='{target_item_abs}'")
          abort(404, description="Item not found or access denied.")
@@ -145,7 +167,7 @@ def browse(subpath):
     try: page = int(request.args.get('page', 1))
     except ValueError: page = 1
     if page < 1: page = 1
-    items_per_page = 198 # Configurable
+    items_per_page = config.BROWSE_ITEMS_PER_PAGE
 
     current_path = get_relative_path_from_request(subpath)
     app.logger.info(f"Request browse: Path='{current_path}', SortBy='{sort_by}', Order='{sort_order}', Page='{page}'")
@@ -227,25 +249,21 @@ def browse(subpath):
         app.logger.error(f"Unexpected error getting disk stats for '{target_dir_abs}': {e}", exc_info=True)
     # --- End Get Free Space ---
 
-    # Get sorted items list from file_utils
-    all_items_unpaginated, is_image_only_folder = file_utils.get_folder_contents_with_ids(
-        current_path, sort_by=sort_by, sort_order=sort_order
+    # Get only the requested page from file_utils (a slice of the listing's memoized order for this sort mode)
+    items_to_display, total_items, is_image_only_folder, listing = file_utils.get_folder_page(
+        current_path, sort_by=sort_by, sort_order=sort_order, offset=(page - 1) * items_per_page, limit=items_per_page
     )
 
-    # Apply Pagination ONLY for Image Grid
-    total_items = len(all_items_unpaginated)
-    total_pages = 1
-    items_to_display = all_items_unpaginated
-
-    if is_image_only_folder and total_items > items_per_page:
-        total_pages = ceil(total_items / items_per_page)
-        if page > total_pages: page = total_pages # Adjust page if out of bounds
-        start_index = (page - 1) * items_per_page
-        end_index = start_index + items_per_page
-        items_to_display = all_items_unpaginated[start_index:end_index]
-        app.logger.debug(f"Image grid pagination: Page {page}/{total_pages}, Items {start_index}-{end_index-1} of {total_items}")
-    elif is_image_only_folder:
-         app.logger.debug(f"Image grid: {total_items} items, no pagination.")
+    # Pagination applies to every folder type
+    total_pages = max(1, ceil(total_items / items_per_page))
+    if page > total_pages: # Adjust page if out of bounds
+        page = total_pages
+        items_to_display, total_items, is_image_only_folder, listing = file_utils.get_folder_page(
+            current_path, sort_by=sort_by, sort_order=sort_order, offset=(page - 1) * items_per_page, limit=items_per_page
+        )
+    app.logger.debug(f"Browse pagination: Page {page}/{total_pages}, {len(items_to_display)} of {total_items} items")
+    if listing is not None: transcoder.prioritize_folder(listing.relative_path, listing.items) # Variants for this folder first
+    next_cursor = encode_list_cursor(page * items_per_page, listing) if page < total_pages else None
 
     # Prepare Breadcrumbs (Ensure sort/page params are included)
     breadcrumbs = []
@@ -271,8 +289,11 @@ def browse(subpath):
     up_link_url = url_for('browse', subpath=parent_dir_path, sort_by=sort_by, sort_order=sort_order) if current_path else None
 
     # Download Playlist Link (Include sort params - maybe not necessary?)
-    has_media = any(item['type'] in ('video', 'audio') for item in items_to_display) # Check displayed items
+    has_media = listing is not None and any(item['type'] in ('video', 'audio') for item in listing.items) # Playlist covers the whole folder
     download_playlist_link = url_for('download_playlist', subpath=current_path) if has_media else None
+    has_subfolders = listing is not None and any(item['type'] == 'folder' for item in listing.items)
+    download_playlist_recursive_link = url_for('download_playlist', subpath=current_path, recursive=1) if has_subfolders else None
+    download_folder_link = url_for('download_folder', subpath=current_path) if listing is not None and listing.items else None # Whole subtree as one ZIP
 
     return render_template(
         'browse.html',
@@ -284,6 +305,8 @@ def browse(subpath):
         up_link_url=up_link_url,
         is_image_only_folder=is_image_only_folder,
         download_playlist_link=download_playlist_link,
+        download_playlist_recursive_link=download_playlist_recursive_link,
+        download_folder_link=download_folder_link,
         video_ext=config.VIDEO_EXTENSIONS,
         audio_ext=config.AUDIO_EXTENSIONS,
         current_sort_by=sort_by,
@@ -291,9 +314,106 @@ def browse(subpath):
         pagination={ # Pass pagination info
             'current_page': page, 'total_pages': total_pages, 'has_prev': page > 1,
             'has_next': page < total_pages, 'total_items': total_items, 'per_page': items_per_page
+        },
+        next_cursor=next_cursor, # Infinite scroll continues from here via browse_json
+        upload_settings={ # Chunked uploader parameters
+            'max_file_size': config.UPLOAD_MAX_FILE_SIZE, 'chunk_size': config.UPLOAD_CHUNK_SIZE,
+            'parallel_chunks': config.UPLOAD_PARALLEL_CHUNKS
         }
     )
 
+# --- JSON Listing API ---
+def encode_list_cursor(offset, listing):
+    """Opaque cursor: the next offset plus the listing version it was computed against."""
+    version = f"{listing.signature[1]:x}-{listing.signature[2]:x}" if listing else ""
+    return base64.urlsafe_b64encode(json.dumps({'o': offset, 'v': version}).encode()).decode().rstrip('=')
+
+def decode_list_cursor(cursor):
+    """Returns (offset, version); a missing or malformed cursor starts from the beginning."""
+    if not cursor: return 0, None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return max(0, int(data['o'])), data.get('v')
+    except Exception: return 0, None
+
+@app.route('/browse_json/', defaults={'subpath': ''})
+@app.route('/browse_json/<path:subpath>')
+@auth.login_required
+def browse_json(subpath):
+    """
+    Cursor-paginated folder listing as JSON (used by browse.js for infinite scroll).
+    Query: sort_by, sort_order, limit, cursor (from the previous response's next_cursor),
+    include_html=1 to also get the rendered <li> rows.
+    """
+    sort_by = request.args.get('sort_by', 'name')
+    sort_order = request.args.get('sort_order', 'asc')
+    if sort_by not in ['name', 'type', 'size', 'date']: sort_by = 'name'
+    if sort_order not in ['asc', 'desc']: sort_order = 'asc'
+    try: limit = int(request.args.get('limit', config.BROWSE_ITEMS_PER_PAGE))
+    except ValueError: limit = config.BROWSE_ITEMS_PER_PAGE
+    limit = min(max(limit, 1), config.BROWSE_JSON_MAX_LIMIT)
+    offset, cursor_version = decode_list_cursor(request.args.get('cursor'))
+
+    current_path = get_relative_path_from_request(subpath)
+    items, total_items, is_image_only_folder, listing = file_utils.get_folder_page(
+        current_path, sort_by=sort_by, sort_order=sort_order, offset=offset, limit=limit
+    )
+    if listing is None: return jsonify({"error": f"Directory not found: '{current_path or '/'}'"}), 404
+
+    next_offset = offset + len(items)
+    current_version = f"{listing.signature[1]:x}-{listing.signature[2]:x}"
+    payload = {
+        "path": current_path, "sort_by": sort_by, "sort_order": sort_order,
+        "total_items": total_items, "offset": offset, "is_image_only": is_image_only_folder,
+        # The folder changed since the cursor was issued; offsets may have shifted by a few rows
+        "listing_changed": cursor_version is not None and cursor_version != current_version,
+        "next_cursor": encode_list_cursor(next_offset, listing) if next_offset < total_items else None,
+        "items": [{
+            'id': item['id'], 'type': item['type'], 'display_name': item['display_name'], 'path': item['path'],
+            'size': item['size'], 'mtime': item['mtime'], 'is_problematic': item['is_problematic'], 'meta': item.get('meta'),
+        } for item in items],
+    }
+    if request.args.get('include_html') == '1':
+        payload['html'] = render_template('_file_items.html', items=items, current_path=current_path,
+                                          is_image_only_folder=is_image_only_folder, current_sort_by=sort_by, current_sort_order=sort_order)
+    return jsonify(payload)
+
+
+# --- Library Search ---
+SEARCH_TYPES = ('folder', 'video', 'audio', 'image', 'text', 'other')
+
+def get_search_params():
+    """(query, item_type, page) from the request; unknown types mean 'any'."""
+    query = request.args.get('q', '').strip()[:200]
+    item_type = request.args.get('type', '')
+    if item_type not in SEARCH_TYPES: item_type = None
+    try: page = max(1, int(request.args.get('page', 1)))
+    except ValueError: page = 1
+    return query, item_type, page
+
+@app.route('/search')
+@auth.login_required
+def search():
+    """Filename search across the whole library (served from the library index)."""
+    query, item_type, page = get_search_params()
+    per_page = config.SEARCH_RESULTS_PER_PAGE
+    hits, total_hits = file_utils.search_library(query, item_type=item_type, offset=(page - 1) * per_page, limit=per_page) if query else ([], 0)
+    app.logger.info(f"Search: q={query!r}, type={item_type}, page={page} -> {total_hits} hit(s)")
+    return render_template('search.html', query=query, item_type=item_type or '', search_types=SEARCH_TYPES, hits=hits,
+                           total_hits=total_hits, total_capped=total_hits >= config.SEARCH_MAX_HITS, page=page,
+                           total_pages=ceil(total_hits / per_page) if total_hits else 0)
+
+@app.route('/search_json')
+@auth.login_required
+def search_json():
+    """JSON version of /search. Query: q, type, page."""
+    query, item_type, page = get_search_params()
+    per_page = config.SEARCH_RESULTS_PER_PAGE
+    if not query: return jsonify({"error": "Missing search query 'q'."}), 400
+    hits, total_hits = file_utils.search_library(query, item_type=item_type, offset=(page - 1) * per_page, limit=per_page)
+    return jsonify({"query": query, "type": item_type, "page": page, "per_page": per_page, "total_hits": total_hits,
+                    "total_capped": total_hits >= config.SEARCH_MAX_HITS, "hits": hits})
+
 # --- File Action Routes ---
 
 @app.route('/download/<item_id>', defaults={'parent_path_in_url': ''})
@@ -304,23 +424,85 @@ def download_file(parent_path_in_url, item_id):
     _, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
     if is_dir: abort(400, "Cannot download a directory.") # Should not happen if called from UI correctly
     try:
-        filename = os.path.basename(item_full_relative_path)
-        response = make_response(send_file(target_file_abs, as_attachment=True, download_name=filename))
-        return response
+        filename = os.path.basename(item_full_relative_path); st = os.stat(target_file_abs)
+        # send_file evaluates If-None-Match/If-Modified-Since/Range/If-Range against our validators
+        response = make_response(send_file(target_file_abs, as_attachment=True, download_name=filename, etag=streaming.file_etag(st), last_modified=int(st.st_mtime)))
+        response.headers['Cache-Control'] = streaming.cache_control_for(file_utils.get_file_type(filename))
+        return streaming.replace_with_range_body(response, request.environ, target_file_abs, 'download')
     except Exception as e: app.logger.error(f"Error sending file '{target_file_abs}': {e}", exc_info=True); abort(500)
 
+@app.route('/download_folder/', defaults={'subpath': ''}, methods=['GET', 'HEAD'])
+@app.route('/download_folder/<path:subpath>', methods=['GET', 'HEAD'])
+@auth.login_required
+def download_folder(subpath):
+    """
+    Streams a folder and everything below it as one ZIP64 archive (stored, built on the fly; no temp file).
+    The size is known up front and single byte ranges are served, so interrupted downloads resume.
+    """
+    current_path = get_relative_path_from_request(subpath)
+    if file_utils.get_directory_listing(current_path) is None: abort(404, description="Folder not found.")
+    try: archive = zipstream.build_archive(current_path)
+    except Exception as e: app.logger.error(f"Error building ZIP layout for '{current_path}': {e}", exc_info=True); abort(500)
+    if request.if_none_match.contains(archive.etag): rv = Response(status=304); rv.set_etag(archive.etag); return rv
+    range_header = request.headers.get('Range', None)
+    if range_header and (request.if_range.date or request.if_range.etag not in (None, archive.etag)):
+        range_header = None # Folder changed since the client's copy: send the whole archive
+    start, stop = 0, archive.size
+    if range_header:
+        m = re.match(r'bytes=(\d*)-(\d*)', range_header) # First range only; suffix ranges let ZIP readers fetch the central directory
+        if not m or not (m.group(1) or m.group(2)): abort(400)
+        if m.group(1): start = int(m.group(1)); stop = min(int(m.group(2)) + 1, archive.size) if m.group(2) else archive.size
+        else: start = max(0, archive.size - int(m.group(2)))
+        if start >= stop: return Response("Range Not Satisfiable", 416, headers={'Content-Range': f'bytes */{archive.size}'})
+    body = zipstream.open_body(request.environ, archive, start, stop) if request.method != 'HEAD' else ()
+    if range_header:
+        response = Response(body, 206, mimetype='application/zip', direct_passthrough=True)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{archive.size}'
+    else: response = Response(body, 200, mimetype='application/zip', direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'; response.headers['Content-Length'] = str(stop - start)
+    response.headers['Cache-Control'] = 'private, no-cache'; response.set_etag(archive.etag)
+    zip_filename = f"{os.path.basename(current_path) or 'media_root'}.zip"
+    try: encoded_filename = quote(zip_filename, safe=""); response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{encoded_filename}"
+    except Exception: ascii_filename = zip_filename.encode('ascii', 'ignore').decode('ascii') or "folder.zip"; response.headers["Content-Disposition"] = f"attachment; filename=\"{ascii_filename}\""
+    return response
+
 
 @app.route('/view_text/<item_id>', defaults={'parent_path_in_url': ''})
 @app.route('/view_text/<path:parent_path_in_url>/<item_id>')
 @auth.login_required
 def view_text_content(parent_path_in_url, item_id):
-    """Returns the content of a text file as JSON."""
+    """
+    Returns one page of a text file as JSON. ?line=N (0-based) or ?offset=BYTES picks the start
+    (default: the beginning), ?lines=M the page length; the response's end_offset continues it.
+    """
     _, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
     if is_dir: abort(400, "Cannot view directory content this way.")
     if file_utils.get_file_type(item_full_relative_path) != 'text': return jsonify({"error": "File is not a text file."}), 400
-    content, error_message = file_utils.read_text_file_safe(target_file_abs)
-    if error_message: return jsonify({"error": error_message}), 400
-    else: return jsonify({"content": content, "filename": os.path.basename(item_full_relative_path)})
+    try:
+        line = request.args.get('line', type=int); offset = request.args.get('offset', type=int); max_lines = request.args.get('lines', type=int)
+        if (line is not None and line < 0) or (offset is not None and offset < 0): return jsonify({"error": "Invalid line or offset."}), 400
+        page = text_index.read_page(item_id, target_file_abs, line=line, offset=offset, max_lines=max_lines)
+    except OSError as e: app.logger.error(f"OS error reading text file '{target_file_abs}': {e}"); return jsonify({"error": "Error: Could not access file."}), 400
+    except Exception as e: app.logger.error(f"Unexpected error reading text file '{target_file_abs}': {e}", exc_info=True); return jsonify({"error": "Error reading file."}), 400
+    follow_url = url_for('follow_text_content', parent_path_in_url=parent_path_in_url, item_id=item_id)
+    return jsonify({"filename": os.path.basename(item_full_relative_path), "follow_url": follow_url, **page})
+
+@app.route('/follow_text/<item_id>', defaults={'parent_path_in_url': ''})
+@app.route('/follow_text/<path:parent_path_in_url>/<item_id>')
+@auth.login_required
+def follow_text_content(parent_path_in_url, item_id):
+    """Live tail: Server-Sent Events with the bytes appended after ?offset=N (or the Last-Event-ID on reconnects)."""
+    _, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
+    if is_dir or file_utils.get_file_type(item_full_relative_path) != 'text': abort(400, description="Requested item is not a text file.")
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None: offset = request.args.get('offset', default=0, type=int)
+    if request.environ.get('pi_streamer.async'): limits = {} # asgi.py: an open follow costs no thread
+    else: limits = {'max_seconds': config.TEXT_FOLLOW_SYNC_MAX_SECONDS, 'retry_ms': config.TEXT_FOLLOW_SYNC_RETRY_MS} # Sync worker: short polls
+    try: stream = text_index.FollowStream(item_id, target_file_abs, max(0, offset), **limits)
+    except OSError as e: app.logger.error(f"Cannot follow '{target_file_abs}': {e}"); abort(404)
+    response = Response(stream, mimetype='text/event-stream', direct_passthrough=True)
+    response.headers['Cache-Control'] = 'no-cache'; response.headers['X-Accel-Buffering'] = 'no' # Don't let nginx buffer events
+    return response
 
 
 @app.route('/view_image/<item_id>', defaults={'parent_path_in_url': ''})
@@ -331,10 +513,41 @@ def view_image_file(parent_path_in_url, item_id):
     _, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
     if is_dir: abort(400, "Cannot view directory as image.")
     if file_utils.get_file_type(item_full_relative_path) != 'image': abort(400, description="Requested item is not an image file.")
-    try: return send_file(target_file_abs, as_attachment=False)
+    try:
+        st = os.stat(target_file_abs)
+        response = streaming.cached_file_response(request, target_file_abs, st, mimetypes.guess_type(target_file_abs)[0] or 'application/octet-stream')
+        if response is None: response = send_file(target_file_abs, as_attachment=False, etag=streaming.file_etag(st), last_modified=int(st.st_mtime))
+        response.headers['Cache-Control'] = streaming.cache_control_for('image')
+        return response
     except Exception as e: app.logger.error(f"Error sending image file '{target_file_abs}': {e}", exc_info=True); abort(500)
 
 
+@app.route('/thumbnail/<item_id>', defaults={'parent_path_in_url': ''})
+@app.route('/thumbnail/<path:parent_path_in_url>/<item_id>')
+@auth.login_required
+def thumbnail_image(parent_path_in_url, item_id):
+    """Serves a cached thumbnail, 202 + placeholder while it's generated, or the original if unsupported."""
+    cleaned_parent_path, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
+    if is_dir or file_utils.get_file_type(item_full_relative_path) != 'image': abort(400, description="Requested item is not an image file.")
+    try: st = os.stat(target_file_abs)
+    except OSError: abort(404)
+    status, thumb_path_or_key = thumbnails.get_or_schedule(item_id, target_file_abs, st)
+    if status == 'pending':
+        response = Response(thumbnails.PENDING_PLACEHOLDER_GIF, 202, mimetype='image/gif')
+        response.headers['Retry-After'] = '1'; response.headers['Cache-Control'] = 'no-store'
+        return response
+    if status == 'unavailable':
+        return redirect(url_for('view_image_file', parent_path_in_url=cleaned_parent_path, item_id=item_id))
+    try:
+        # ETag is the derivative key (item ID + source mtime/size), so it changes with the source image
+        thumb_etag = os.path.splitext(os.path.basename(thumb_path_or_key))[0]
+        response = streaming.cached_file_response(request, thumb_path_or_key, os.stat(thumb_path_or_key), 'image/jpeg', etag=thumb_etag)
+        if response is None: response = send_file(thumb_path_or_key, mimetype='image/jpeg', etag=thumb_etag)
+        response.headers['Cache-Control'] = config.THUMBNAIL_CACHE_CONTROL
+        return response
+    except Exception as e: app.logger.error(f"Error sending thumbnail '{thumb_path_or_key}': {e}", exc_info=True); abort(500)
+
+
 # --- Media Streaming & Playback ---
 
 @app.route('/stream/<item_id>', defaults={'parent_path_in_url': ''})
@@ -346,7 +559,17 @@ def stream_media_by_id(parent_path_in_url, item_id):
     if is_dir: abort(400, "Cannot stream directory.")
     app.logger.debug(f"Stream: Serving abs path '{target_file_abs}' for rel '{item_full_relative_path}'")
     # ... (Range handling and response generation - keep existing correct version) ...
-    range_header = request.headers.get('Range', None); size = os.path.getsize(target_file_abs)
+    try: st = os.stat(target_file_abs)
+    except OSError: abort(404)
+    size = st.st_size; file_type = file_utils.get_file_type(item_full_relative_path)
+    layout = faststart.get_layout(item_id, target_file_abs, st) # MP4 with its index at the end: serve it moved to the front
+    etag = faststart.etag(st) if layout else None
+    if layout: size = layout.size
+    if streaming.is_not_modified(request, st, etag):
+        return streaming.apply_validators(Response(status=304), st, file_type, etag)
+    range_header = request.headers.get('Range', None)
+    if range_header and not streaming.if_range_allows_partial(request, st, etag):
+        range_header = None # File changed since the client's copy: send the whole thing
     byte1, byte2 = 0, None
     if range_header:
         m = re.match(r'bytes=(\d+)-(\d*)', range_header)
@@ -354,26 +577,119 @@ def stream_media_by_id(parent_path_in_url, item_id):
             try: byte1 = int(m.group(1)); rg2 = m.group(2); byte2 = int(rg2) if rg2 else None
             except ValueError: abort(400)
         else: abort(400)
+    # An open-ended range from the start gets just the relocated head; the player then asks for the media data, which is a plain (sendfile) file range
+    if layout and range_header and byte2 is None and byte1 < layout.head_end: byte2 = layout.head_end - 1
     if byte2 is None or byte2 >= size: byte2 = size - 1
     if byte1 < 0 or byte1 >= size or byte1 > byte2:
         resp = Response("Range Not Satisfiable", 416, headers={'Content-Range': f'bytes */{size}'}); return resp
     length = byte2 - byte1 + 1
-    def generate_chunks():
-        try:
-            with open(target_file_abs, 'rb') as f:
-                f.seek(byte1); remaining = length
-                while remaining > 0:
-                    read_size=min(config.CHUNK_SIZE,remaining); chunk=f.read(read_size)
-                    if not chunk: break
-                    yield chunk; remaining-=len(chunk)
-        except Exception as e_gen: app.logger.error(f"Stream generator error: {e_gen}", exc_info=True)
     mime_type, _ = mimetypes.guess_type(target_file_abs)
-    if not mime_type: file_type = file_utils.get_file_type(item_full_relative_path); mime_type = 'video/mp4' if file_type == 'video' else 'audio/mpeg' if file_type == 'audio' else 'application/octet-stream'
-    rv = Response(generate_chunks(), 206, mimetype=mime_type, direct_passthrough=True)
-    rv.headers.set('Content-Range', f'bytes {byte1}-{byte2}/{size}'); rv.headers.set('Accept-Ranges', 'bytes'); rv.headers.set('Content-Length', str(length))
-    return rv
+    if not mime_type: mime_type = 'video/mp4' if file_type == 'video' else 'audio/mpeg' if file_type == 'audio' else 'application/octet-stream'
+    # HEAD gets headers only; don't open the file just to discard the body
+    if request.method == 'HEAD': body = ()
+    elif layout: body = faststart.open_range_body(request.environ, layout, target_file_abs, byte1, length)
+    else: body = streaming.open_range_body(request.environ, target_file_abs, byte1, length)
+    if request.headers.get('Range') and not range_header: # Failed If-Range: full 200 response
+        rv = Response(body, 200, mimetype=mime_type, direct_passthrough=True)
+    else:
+        rv = Response(body, 206, mimetype=mime_type, direct_passthrough=True)
+        rv.headers.set('Content-Range', f'bytes {byte1}-{byte2}/{size}')
+    rv.headers.set('Accept-Ranges', 'bytes'); rv.headers.set('Content-Length', str(length))
+    return streaming.apply_validators(rv, st, file_type, etag)
 
 
+# --- HLS Adaptive Streaming ---
+def get_hls_source(parent_path_in_url, item_id):
+    """Validates a video for HLS and returns (stat, source key, probe info). Aborts if unavailable."""
+    if not hls.is_available(): abort(404, description="HLS streaming is not available (disabled or ffmpeg not found).")
+    _, item_full_relative_path, target_file_abs, is_dir = get_validated_item_paths(parent_path_in_url, item_id)
+    if is_dir or file_utils.get_file_type(item_full_relative_path) != 'video': abort(400, description="HLS is only available for videos.")
+    try: st = os.stat(target_file_abs)
+    except OSError: abort(404)
+    key = hls.source_key(item_id, st)
+    info = hls.probe(target_file_abs, key)
+    if info is None: abort(415, description="Video could not be probed for HLS.")
+    return target_file_abs, st, key, info
+
+def hls_playlist_response(text, st):
+    response = make_response(text)
+    response.headers['Content-Type'] = 'application/vnd.apple.mpegurl'
+    return streaming.apply_validators(response, st, 'video')
+
+@app.route('/hls/<item_id>/master.m3u8', defaults={'parent_path_in_url': ''})
+@app.route('/hls/<path:parent_path_in_url>/<item_id>/master.m3u8')
+@auth.login_required
+def hls_master_playlist(parent_path_in_url, item_id):
+    """HLS master playlist: one variant per configured rendition up to the source height."""
+    _, st, _, info = get_hls_source(parent_path_in_url, item_id)
+    return hls_playlist_response(hls.master_playlist(info), st)
+
+@app.route('/hls/<item_id>/<variant_name>/index.m3u8', defaults={'parent_path_in_url': ''})
+@app.route('/hls/<path:parent_path_in_url>/<item_id>/<variant_name>/index.m3u8')
+@auth.login_required
+def hls_variant_playlist(parent_path_in_url, item_id, variant_name):
+    """HLS media playlist for one variant (segments are listed up front, encoded on request)."""
+    if hls.get_variant(variant_name) is None: abort(404)
+    _, st, _, info = get_hls_source(parent_path_in_url, item_id)
+    return hls_playlist_response(hls.media_playlist(info), st)
+
+@app.route('/hls/<item_id>/<variant_name>/<int:segment_index>.ts', defaults={'parent_path_in_url': ''})
+@app.route('/hls/<path:parent_path_in_url>/<item_id>/<variant_name>/<int:segment_index>.ts')
+@auth.login_required
+def hls_segment(parent_path_in_url, item_id, variant_name, segment_index):
+    """One MPEG-TS segment, transcoded on first request and served from the segment cache afterwards."""
+    variant = hls.get_variant(variant_name)
+    if variant is None: abort(404)
+    target_file_abs, _, key, info = get_hls_source(parent_path_in_url, item_id)
+    if segment_index >= hls.segment_count(info): abort(404)
+    try:
+        segment_path = hls.get_segment(target_file_abs, key, info, variant, segment_index)
+    except TimeoutError as e:
+        app.logger.warning(str(e))
+        return Response("Segment is still being generated.", 503, headers={'Retry-After': '2'})
+    except Exception as e:
+        app.logger.error(f"HLS segment {segment_index} ({variant_name}) failed for '{target_file_abs}': {e}")
+        abort(500)
+    hls.touch(segment_path)
+    response = send_file(segment_path, mimetype='video/mp2t', conditional=True, etag=True)
+    response.headers['Cache-Control'] = config.HLS_SEGMENT_CACHE_CONTROL
+    return streaming.replace_with_range_body(response, request.environ, segment_path, 'stream')
+
+# --- Transcode Queue Status ---
+@app.route('/transcode_status')
+@auth.login_required
+def transcode_status():
+    """Queue depth, running jobs with progress, next queued jobs and recent failures (JSON)."""
+    try: return jsonify(transcoder.get_status())
+    except Exception as e:
+        app.logger.error(f"Could not read transcode queue: {e}", exc_info=True)
+        return jsonify({"error": "Transcode queue unavailable."}), 500
+
+# --- Fingerprinted Static Assets ---
+@app.route('/assets/<path:asset>')
+def static_asset(asset):
+    """Content-hashed static file (see compression.asset_url), precompressed where accepted; cached as immutable."""
+    return compression.send_asset(request, asset)
+
+# --- Stream Stats ---
+@app.route('/stream_stats')
+@auth.login_required
+def stream_stats():
+    """Byte cache counters, plus chunk size, client drain rate and page-cache drops of this worker's active and recent generator-served bodies (JSON)."""
+    return jsonify(streaming.get_stream_stats())
+
+# --- Bandwidth Limits ---
+@app.route('/bandwidth', methods=['GET', 'POST'])
+@auth.login_required
+def bandwidth_limits():
+    """GET: current caps and this worker's paced sessions. POST (JSON or form): global_limit / client_limit in bytes/s, 0 = unlimited."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form; current = bandwidth.get_status()
+        try: bandwidth.set_limits(int(data.get('global_limit', current['global_limit'])), int(data.get('client_limit', current['client_limit'])))
+        except (TypeError, ValueError) as e: return jsonify({"error": f"Invalid limits: {e}"}), 400
+        except OSError as e: app.logger.error(f"Could not store bandwidth limits: {e}"); return jsonify({"error": "Could not store limits."}), 500
+    return jsonify(bandwidth.get_status())
+
 @app.route('/play_video/<item_id>', defaults={'parent_path_in_url': ''})
 @app.route('/play_video/<path:parent_path_in_url>/<item_id>')
 @auth.login_required
@@ -392,7 +708,9 @@ def play_video_page(parent_path_in_url, item_id):
     initial_stream_url = url_for('stream_media_by_id', parent_path_in_url=cleaned_parent_path, item_id=item_id)
     display_filename = os.path.basename(item_full_relative_path); is_problematic_filename = None
     mime_type, _ = mimetypes.guess_type(target_file_abs); mime_type = mime_type or 'video/mp4'
-    return render_template('player_video.html', display_filename=display_filename, back_link_url=back_link_url, quality_options=quality_options, is_problematic_filename=is_problematic_filename, prev_link_url=prev_link_url, next_link_url=next_link_url, initial_stream_url=initial_stream_url, initial_mime_type=mime_type, parent_path_json=cleaned_parent_path)
+    hls_url = url_for('hls_master_playlist', parent_path_in_url=cleaned_parent_path, item_id=item_id) if hls.is_available() else None
+    start_with_hls = hls_url is not None and request.args.get('mode', 'hls' if config.HLS_PLAYER_DEFAULT else '') == 'hls'
+    return render_template('player_video.html', hls_url=hls_url, start_with_hls=start_with_hls, display_filename=display_filename, back_link_url=back_link_url, quality_options=quality_options, is_problematic_filename=is_problematic_filename, prev_link_url=prev_link_url, next_link_url=next_link_url, initial_stream_url=initial_stream_url, initial_mime_type=mime_type, parent_path_json=cleaned_parent_path)
 
 
 @app.route('/play_audio/<item_id>', defaults={'parent_path_in_url': ''})
@@ -420,25 +738,40 @@ def play_audio_page(parent_path_in_url, item_id):
 @app.route('/download_playlist/<path:subpath>')
 @auth.login_required
 def download_playlist(subpath):
-    """Generates M3U playlist with direct download links."""
+    """Generates M3U playlist with direct download links; ?recursive=1 covers the whole subtree, streamed as it is walked."""
     current_path = get_relative_path_from_request(subpath)
-    # ... (keep existing correct logic using url_for('download_file',...) ...
-    target_dir_abs = file_utils.get_safe_fullpath(current_path)
-    if target_dir_abs is None or not os.path.isdir(target_dir_abs): flash(f"Dir not found: '{current_path or '/'}'", "error"); return redirect(url_for('browse', subpath=current_path))
-    all_items, _ = file_utils.get_folder_contents_with_ids(current_path) # Use default sort for playlist
-    media_items = [item for item in all_items if item['type'] in ('video', 'audio')]
-    if not media_items: flash("No media found for playlist.", "info"); return redirect(url_for('browse', subpath=current_path))
+    recursive = request.args.get('recursive', '').lower() in ('1', 'true', 'yes')
+    if file_utils.get_directory_listing(current_path) is None: flash(f"Dir not found: '{current_path or '/'}'", "error"); return redirect(url_for('browse', subpath=current_path))
+    if not recursive:
+        all_items, _ = file_utils.get_folder_contents_with_ids(current_path) # Served from the listing cache / library index
+        if not any(item['type'] in ('video', 'audio') for item in all_items): flash("No media found for playlist.", "info"); return redirect(url_for('browse', subpath=current_path))
     folder_name_base = os.path.basename(current_path) if current_path else "media_root"; playlist_filename_base = secure_filename(f"{folder_name_base}") or "playlist"; playlist_filename = f"{playlist_filename_base}.m3u"
-    m3u_content = ["#EXTM3U"]
-    for item in media_items:
-        display_name_for_m3u = item['display_name'].replace(',', ';').replace('\n', ' ').replace('\r', '')
-        download_url = url_for('download_file', parent_path_in_url=current_path, item_id=item['id'], _external=True)
-        m3u_content.append(f"#EXTINF:-1,{display_name_for_m3u}"); m3u_content.append(download_url)
-    m3u_data = "\n".join(m3u_content) + "\n"; response = make_response(m3u_data.encode('utf-8')); response.headers["Content-Type"] = "audio/x-mpegurl; charset=utf-8"
+    body = _iter_m3u(current_path, recursive); gzipped = compression.accepts_streamed_gzip(request)
+    if gzipped: body = compression.gzip_stream(body) # Streamed, so the after_request hook would skip it
+    response = Response(stream_with_context(body), content_type="audio/x-mpegurl; charset=utf-8")
+    if gzipped: response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
     try: encoded_filename = quote(playlist_filename, safe=""); response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{encoded_filename}"
     except Exception: ascii_filename = playlist_filename.encode('ascii', 'ignore').decode('ascii') or "playlist.m3u"; response.headers["Content-Disposition"] = f"attachment; filename=\"{ascii_filename}\""
     return response
 
+def _iter_m3u(current_path, recursive):
+    """
+    Yields the playlist one folder at a time (depth first, name order), so a large subtree starts downloading
+    right away. Durations come from the metadata cache; files not probed yet get -1 (and are queued for probing).
+    """
+    yield "#EXTM3U\n"
+    for folder, all_items in file_utils.walk_folder(current_path, recursive):
+        media_items = [item for item in all_items if item['type'] in ('video', 'audio')]
+        if media_items:
+            durations = metadata.get_durations(media_items); lines = []
+            for item in media_items:
+                display_name_for_m3u = item['display_name'].replace(',', ';').replace('\n', ' ').replace('\r', '')
+                duration = durations.get(item['path']); duration = round(duration) if duration else -1
+                download_url = url_for('download_file', parent_path_in_url=folder, item_id=item['id'], _external=True)
+                lines.append(f"#EXTINF:{duration},{display_name_for_m3u}\n{download_url}\n")
+            yield "".join(lines)
+
 
 # --- File/Folder Management ---
 
@@ -454,68 +787,102 @@ def upload_file_handler(subpath):
         # ... (error handling) ...
         return jsonify({"success": False, "error": f"Target directory '{target_folder_path or '/'}' not found or invalid."}), 400
 
-    if 'file' not in request.files: # ... (error handling) ...
-        return jsonify({"success": False, "error": "No 'file' part in the request."}), 400
-
-    file = request.files['file'] # This is a FileStorage object
-    if not file or not file.filename: # ... (error handling) ...
-        return jsonify({"success": False, "error": "No file selected or filename is empty."}), 400
-
-    # --- Filename Handling (Keep previous cleaning logic) ---
-    original_filename = file.filename
-    # ... (keep cleaning logic for final_filename) ...
-    cleaned_filename = original_filename.strip('. ')
-    if os.path.sep != '/': cleaned_filename = cleaned_filename.replace(os.path.sep, '_')
-    cleaned_filename = cleaned_filename.replace('/', '_')
-    if ".." in cleaned_filename:
-         return jsonify({"success": False, "error": f"Filename '{original_filename}' contains invalid components ('..')."}), 400
-    if not cleaned_filename:
-         return jsonify({"success": False, "error": f"Filename '{original_filename}' is invalid."}), 400
-    final_filename = cleaned_filename
-    app.logger.info(f"Using final filename for saving: '{final_filename}' (Original: '{original_filename}')")
-    # --- End Filename Handling ---
-
-    destination_abs_str = os.path.join(target_dir_abs, final_filename) # Get destination as string
-    app.logger.debug(f"Calculated destination absolute path string: '{destination_abs_str}'")
-
-    # Check existence using the string path
-    if os.path.exists(destination_abs_str):
-        app.logger.warning(f"Upload skipped: File '{final_filename}' already exists.")
-        return jsonify({"success": False, "error": f"File '{final_filename}' already exists."}), 409
-
-    # --- Attempt to save MANUALLY ---
-    try:
-        # --- MODIFICATION START ---
-        # Manually open the destination file in binary write mode ('wb')
-        # Python's open() SHOULD handle the Unicode string path correctly on modern OS/filesystems
-        app.logger.debug(f"Attempting to open destination '{destination_abs_str}' in 'wb' mode.")
-        with open(destination_abs_str, "wb") as f_dst:
-            # Copy the content from the uploaded file's stream to the destination file
-            # file.stream provides the incoming data stream
-            shutil.copyfileobj(file.stream, f_dst)
-        # --- MODIFICATION END ---
-
-        app.logger.info(f"File '{final_filename}' uploaded successfully to '{target_folder_path}' via manual copy.")
-        return jsonify({"success": True, "filename": final_filename}), 201
+    # Parse the multipart body ourselves (never touch request.files): werkzeug would spool the upload
+    # to a temp file first and we'd copy it a second time. Here every byte is written once.
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({"success": False, "error": "Expected a multipart/form-data upload with a 'file' part."}), 400
 
+    try:
+        final_filename = uploads.receive_multipart_upload(request.stream, boundary, request.content_length, target_dir_abs)
+    except uploads.UploadError as e:
+        app.logger.warning(f"Upload to '{target_folder_path}' rejected: {e.message}")
+        return jsonify({"success": False, "error": e.message}), e.status
     except OSError as e:
-        # Catch OS errors during open() or writing
-        app.logger.error(f"OSError saving file '{final_filename}' to path '{destination_abs_str}': {e}", exc_info=True)
-        error_msg = f"OS error saving '{final_filename}': {e.strerror}. Check permissions/filesystem/encoding."
-        # Attempt to remove partially written file if creation failed midway (optional)
-        if os.path.exists(destination_abs_str):
-            try: os.remove(destination_abs_str)
-            except Exception: pass # Ignore errors during cleanup
-        return jsonify({"success": False, "error": error_msg}), 500
+        # Catch OS errors during open() or writing (the partial temp file is already removed)
+        app.logger.error(f"OSError saving upload to '{target_dir_abs}': {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"OS error saving upload: {e.strerror}. Check permissions/filesystem/encoding."}), 500
     except Exception as e:
-        # Catch other unexpected errors
-        app.logger.error(f"Unexpected error saving file '{final_filename}' to path '{destination_abs_str}': {e}", exc_info=True)
-        error_msg = f"Server error saving '{final_filename}'. Check logs."
-        # Attempt cleanup
-        if os.path.exists(destination_abs_str):
-            try: os.remove(destination_abs_str)
-            except Exception: pass
-        return jsonify({"success": False, "error": error_msg}), 500
+        if isinstance(e, HTTPException): raise # e.g. 413 from MAX_CONTENT_LENGTH
+        app.logger.error(f"Unexpected error saving upload to '{target_dir_abs}': {e}", exc_info=True)
+        return jsonify({"success": False, "error": "Server error saving upload. Check logs."}), 500
+    finally:
+        file_utils.invalidate_directory_cache(target_folder_path)
+
+    app.logger.info(f"File '{final_filename}' uploaded successfully to '{target_folder_path}'.")
+    return jsonify({"success": True, "filename": final_filename}), 201
+
+# --- Resumable Chunked Upload API ---
+# init -> PUT chunks at offsets (any order, in parallel) -> GET status to find gaps -> finalize
+
+@app.route('/upload_init/', defaults={'subpath': ''}, methods=['POST'])
+@app.route('/upload_init/<path:subpath>', methods=['POST'])
+@auth.login_required
+def upload_init(subpath):
+    """Starts an upload session. JSON body: {"filename": str, "size": int}."""
+    target_folder_path = get_relative_path_from_request(subpath)
+    target_dir_abs = file_utils.get_safe_fullpath(target_folder_path)
+    if target_dir_abs is None or not os.path.isdir(target_dir_abs):
+        return jsonify({"success": False, "error": f"Target directory '{target_folder_path or '/'}' not found or invalid."}), 400
+    data = request.get_json(silent=True) or {}
+    final_filename, filename_error = uploads.clean_upload_filename(data.get('filename'))
+    if filename_error: return jsonify({"success": False, "error": filename_error}), 400
+    try: size = int(data.get('size'))
+    except (TypeError, ValueError): return jsonify({"success": False, "error": "Missing or invalid 'size'."}), 400
+    try:
+        session = uploads.create_session(target_dir_abs, target_folder_path, final_filename, size)
+    except uploads.UploadError as e: return jsonify({"success": False, "error": e.message}), e.status
+    except OSError as e:
+        app.logger.error(f"OSError creating upload session for '{final_filename}': {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"OS error preparing '{final_filename}': {e.strerror}"}), 500
+    return jsonify({"success": True, "chunk_size": config.UPLOAD_CHUNK_SIZE, **uploads.session_status(session)}), 201
+
+
+@app.route('/upload_chunk/<session_id>', methods=['PUT'])
+@auth.login_required
+def upload_chunk(session_id):
+    """Writes the raw request body at ?offset=N. The body is streamed straight into the temp file."""
+    try: offset = int(request.args.get('offset', ''))
+    except ValueError: return jsonify({"success": False, "error": "Missing or invalid 'offset'."}), 400
+    try:
+        status = uploads.write_chunk(session_id, offset, request.stream, request.content_length)
+    except uploads.UploadError as e: return jsonify({"success": False, "error": e.message}), e.status
+    except OSError as e:
+        app.logger.error(f"OSError writing chunk for upload {session_id} at {offset}: {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"OS error writing chunk: {e.strerror}"}), 500
+    return jsonify({"success": True, **status})
+
+
+@app.route('/upload_status/<session_id>')
+@auth.login_required
+def upload_status(session_id):
+    """Reports the byte ranges received so far, so a client can resume by sending only the gaps."""
+    try: return jsonify({"success": True, **uploads.get_status(session_id)})
+    except uploads.UploadError as e: return jsonify({"success": False, "error": e.message}), e.status
+
+
+@app.route('/upload_finalize/<session_id>', methods=['POST'])
+@auth.login_required
+def upload_finalize(session_id):
+    """Commits a fully received upload with an atomic rename into the target folder."""
+    try:
+        result = uploads.finalize(session_id)
+    except uploads.UploadError as e: return jsonify({"success": False, "error": e.message}), e.status
+    except OSError as e:
+        app.logger.error(f"OSError finalizing upload {session_id}: {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"OS error finalizing upload: {e.strerror}"}), 500
+    file_utils.invalidate_directory_cache(result['target_path'])
+    return jsonify({"success": True, "filename": result['filename']}), 201
+
+
+@app.route('/upload_abort/<session_id>', methods=['POST'])
+@auth.login_required
+def upload_abort(session_id):
+    """Cancels an upload session and deletes its partial file."""
+    try: uploads.abort_session(session_id)
+    except uploads.UploadError as e: return jsonify({"success": False, "error": e.message}), e.status
+    return jsonify({"success": True})
+
 
 @app.route('/create_folder/', defaults={'subpath': ''}, methods=['POST'])
 @app.route('/create_folder/<path:subpath>', methods=['POST'])
@@ -544,6 +911,7 @@ def create_folder_handler(subpath):
     else:
         try:
             os.makedirs(new_folder_abs)
+            file_utils.invalidate_directory_cache(parent_folder_path)
             app.logger.info(f"Folder '{safe_folder_name}' created successfully in '{parent_folder_path}'")
             flash(f"Folder '{safe_folder_name}' created successfully.", 'success')
         except OSError as e:
@@ -599,6 +967,10 @@ def delete_item(parent_path_in_url, item_id):
     except Exception as e:
         app.logger.error(f"Unexpected error deleting '{target_item_abs}': {e}", exc_info=True)
         flash(f"An unexpected error occurred while deleting '{item_name}'.", "error")
+    finally:
+        # Even a partially failed rmtree may have changed the tree, so always forget it
+        file_utils.invalidate_directory_cache(cleaned_parent_path)
+        file_utils.invalidate_directory_cache(item_full_relative_path, recursive=True)
 
     # Redirect back to the parent folder after attempting deletion
     return redirect(url_for('browse', subpath=cleaned_parent_path))
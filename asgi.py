@@ -0,0 +1,201 @@
+# asgi.py
+import os
+import sys
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config # Use our config file
+import bandwidth
+import text_index
+from app import app as flask_app
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Async serving mode: `uvicorn asgi:application` (or gunicorn -k uvicorn.workers.UvicornWorker asgi:application).
+# Every request still runs through the Flask app (auth, ID validation, conditional and Range handling stay in one
+# place), but on a small thread pool instead of one worker per connection. File bodies - /stream ranges and
+# everything served with send_file (downloads, images, HLS segments) - come back as a FileBody, which is then
+# sent from the event loop: by the server's zero-copy extension if it has one, else with positional reads offloaded
+# to a separate I/O pool. An open stream thus costs one coroutine and at most one chunk of memory, not a thread.
+
+SERVER_SOFTWARE = 'pi-streamer-asgi' # Listed in STREAM_SENDFILE_SERVERS: FileBody honours Content-Length
+
+_pools = None # (Flask view pool, file read pool), created on the first request in each process
+_pools_lock = threading.Lock()
+
+
+def _get_pools():
+    global _pools
+    with _pools_lock:
+        if _pools is None:
+            _pools = (ThreadPoolExecutor(max_workers=config.ASGI_APP_THREADS, thread_name_prefix='asgi-app'),
+                      ThreadPoolExecutor(max_workers=config.ASGI_IO_THREADS, thread_name_prefix='asgi-io'))
+            logger.info(f"ASGI mode: {config.ASGI_APP_THREADS} app threads, {config.ASGI_IO_THREADS} I/O threads")
+        return _pools
+
+
+# --- File Bodies ---
+class FileBody:
+    """
+    wsgi.file_wrapper for this server. The event loop sends Content-Length bytes (else to EOF) from the
+    file's current position; iterating it (e.g. inside Werkzeug's range wrapper) reads blocks synchronously.
+    """
+    def __init__(self, filelike, block_size=None):
+        self.filelike = filelike
+        self.block_size = block_size or config.ASGI_CHUNK_SIZE
+
+    def seekable(self): return hasattr(self.filelike, 'seek') and self.filelike.seekable()
+    def seek(self, *args): self.filelike.seek(*args)
+    def tell(self): return self.filelike.tell()
+
+    def __iter__(self): return self
+
+    def __next__(self):
+        block = self.filelike.read(self.block_size)
+        if not block: raise StopIteration()
+        return block
+
+    def close(self):
+        if hasattr(self.filelike, 'close'): self.filelike.close()
+
+
+# --- Request Bodies ---
+class _RequestBody:
+    """wsgi.input fed from ASGI receive(); read from a pool thread, so each refill blocks only that thread."""
+    def __init__(self, receive, loop):
+        self._receive = receive; self._loop = loop
+        self._buffer = bytearray(); self._more = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect': self._more = False; return
+        self._buffer += message.get('body', b''); self._more = message.get('more_body', False)
+
+    def read(self, size=-1):
+        while self._more and (size is None or size < 0 or len(self._buffer) < size): self._fill()
+        if size is None or size < 0: size = len(self._buffer)
+        data = bytes(self._buffer[:size]); del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while self._more and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size): self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0: end = min(end, size)
+        data = bytes(self._buffer[:end]); del self._buffer[:end]
+        return data
+
+    def __iter__(self):
+        while line := self.readline(): yield line
+
+
+def _build_environ(scope, body):
+    """PEP 3333 environ for an ASGI http scope."""
+    root_path = scope.get('root_path', '')
+    path = scope['path'].encode('utf-8', 'surrogateescape').decode('latin-1') # WSGI carries the decoded path's bytes as latin-1
+    if root_path and path.startswith(root_path): path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': root_path, 'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'), 'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'SERVER_NAME': str(server[0]), 'SERVER_PORT': str(server[1] or 80), 'SERVER_SOFTWARE': SERVER_SOFTWARE,
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'), 'wsgi.input': body, 'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileBody, 'pi_streamer.async': True, # Long-lived bodies don't hold a thread here
+    }
+    if scope.get('client'): environ['REMOTE_ADDR'] = scope['client'][0]; environ['REMOTE_PORT'] = str(scope['client'][1])
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_'); value = raw_value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'): key = name
+        else: key = f'HTTP_{name}'
+        if key in environ: value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+# --- Application ---
+async def application(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup': await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown': await send({'type': 'lifespan.shutdown.complete'}); return
+    if scope['type'] != 'http':
+        if scope['type'] == 'websocket': await send({'type': 'websocket.close'})
+        return
+    loop = asyncio.get_running_loop(); app_pool, io_pool = _get_pools()
+    environ = _build_environ(scope, _RequestBody(receive, loop))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0]); started['headers'] = headers
+
+    try: result = await loop.run_in_executor(app_pool, flask_app, environ, start_response)
+    except Exception as e:
+        logger.error(f"Unhandled error in {scope['method']} {scope['path']}: {e}", exc_info=True)
+        await send({'type': 'http.response.start', 'status': 500, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Internal Server Error'}); return
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']]})
+        content_length = next((int(value) for name, value in started['headers'] if name.lower() == 'content-length'), None)
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(_watch_disconnect(receive, disconnected))
+        try:
+            if isinstance(result, FileBody): await _send_file(scope, send, result, content_length, disconnected, io_pool)
+            elif isinstance(result, text_index.FollowStream): await _send_follow(send, result, disconnected, io_pool)
+            else: await _send_iterable(send, result, disconnected, io_pool)
+        finally: watcher.cancel()
+    finally:
+        if hasattr(result, 'close'):
+            try: result.close()
+            except Exception as e: logger.error(f"Error closing response body for {scope['path']}: {e}")
+
+async def _watch_disconnect(receive, disconnected):
+    """Drains any unread request body and sets `disconnected` when the client goes away."""
+    while (await receive())['type'] != 'http.disconnect': pass
+    disconnected.set()
+
+async def _send_file(scope, send, body, content_length, disconnected, io_pool):
+    """Sends a FileBody from its current offset without holding a thread between chunks."""
+    loop = asyncio.get_running_loop()
+    fd = body.filelike.fileno(); offset = body.filelike.tell()
+    count = content_length if content_length is not None else os.fstat(fd).st_size - offset
+    if 'http.response.zerocopysend' in scope.get('extensions', {}):
+        await send({'type': 'http.response.zerocopysend', 'file': body.filelike, 'offset': offset, 'count': count}); return
+    remaining = count
+    while remaining > 0 and not disconnected.is_set():
+        chunk = await loop.run_in_executor(io_pool, os.pread, fd, min(body.block_size, remaining), offset)
+        if not chunk: logger.warning(f"File for {scope['path']} ended {remaining} bytes early"); break
+        offset += len(chunk); remaining -= len(chunk)
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    if not disconnected.is_set(): await send({'type': 'http.response.body', 'body': b''})
+
+async def _send_iterable(send, result, disconnected, io_pool):
+    """Sends any other WSGI body; generators (which may do file I/O) are advanced on the I/O pool."""
+    if isinstance(result, (list, tuple)):
+        for chunk in result:
+            if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    else:
+        # Paced bodies wait on the loop rather than sleeping in a pool thread
+        throttled = isinstance(result, bandwidth.ThrottledBody)
+        loop = asyncio.get_running_loop(); iterator = iter(result.iterable if throttled else result); done = object()
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(io_pool, next, iterator, done)
+            if chunk is done: break
+            if throttled and (delay := result.take(len(chunk))) > 0: await asyncio.sleep(delay)
+            if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    if not disconnected.is_set(): await send({'type': 'http.response.body', 'body': b''})
+
+async def _send_follow(send, result, disconnected, io_pool):
+    """Sends a live tail by polling its shared watcher's buffer, so an idle follower holds no thread."""
+    loop = asyncio.get_running_loop()
+    while not disconnected.is_set() and not result.finished:
+        data = await loop.run_in_executor(io_pool, result.poll)
+        if data: await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        else: await asyncio.sleep(config.TEXT_FOLLOW_POLL_INTERVAL)
+    if not disconnected.is_set(): await send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,203 @@
+# bandwidth.py
+import os
+import json
+import math
+import time
+import logging
+import threading
+
+import config # Use our config file
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Fair-share bandwidth scheduling for response bodies. Every throttled response is a session with its own token
+# bucket. Twice a second the measured rates are turned into bucket rates by weighted max-min fair sharing (water
+# filling): first each client's cap is split among that client's sessions, then the global cap among all sessions.
+# Sessions using less than their share keep only what they use plus headroom, the rest goes to the others, and
+# 'stream' sessions outweigh 'download' ones. Limits apply per app worker process; runtime changes made through
+# set_limits() are stored in BANDWIDTH_LIMITS_PATH and picked up by every worker.
+
+_REALLOCATE_INTERVAL = 0.5 # Seconds between measuring sessions and recomputing their rates
+_IDLE_SECONDS = 2.0 # A session that sent nothing for this long (paused player, stalled client) gets no share
+_SATURATED_RATIO = 0.8 # A session using at least this part of its rate is assumed to want more
+_DEMAND_HEADROOM = 1.5 # Others are held to their measured rate times this, so they can ramp up
+_MIN_RATE = 16 * 1024 # Bytes/s floor, so a session never stalls completely
+_LIMITS_CHECK_INTERVAL = 1.0 # Seconds between checks of the runtime limits file
+
+
+# --- Sessions ---
+class _Session:
+    __slots__ = ('client', 'traffic_class', 'weight', 'rate', 'tokens', 'refilled_at', 'last_active', 'sent', 'measured_from', 'measured', 'fresh')
+
+    def __init__(self, client, traffic_class, weight, now):
+        self.client = client; self.traffic_class = traffic_class; self.weight = weight
+        self.rate = math.inf; self.tokens = 0.0; self.refilled_at = now; self.last_active = now
+        self.sent = 0; self.measured_from = now; self.measured = 0.0; self.fresh = True
+
+    def demand(self):
+        """Bytes/s this session is expected to use if allowed (inf = as much as it gets)."""
+        if self.fresh or self.rate == math.inf or self.measured >= _SATURATED_RATIO * self.rate: return math.inf
+        return max(self.measured * _DEMAND_HEADROOM, _MIN_RATE)
+
+    def take(self, num_bytes, now):
+        """Charges num_bytes to the bucket; returns the seconds to wait before sending them."""
+        self.sent += num_bytes; self.last_active = now
+        if self.rate == math.inf: self.tokens = 0.0; return 0.0
+        burst = max(self.rate * config.BANDWIDTH_BURST_SECONDS, config.BANDWIDTH_CHUNK_SIZE)
+        self.tokens = min(burst, self.tokens + (now - self.refilled_at) * self.rate) - num_bytes; self.refilled_at = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+def _water_fill(sessions, capacity, demands):
+    """Weighted max-min fair split of capacity; returns {session: rate} with each rate <= its demand."""
+    rates = {}; pending = list(sessions)
+    while pending:
+        if capacity == math.inf:
+            for s in pending: rates[s] = demands[s]
+            break
+        share = capacity / sum(s.weight for s in pending)
+        satisfied = [s for s in pending if demands[s] <= share * s.weight]
+        if not satisfied:
+            for s in pending: rates[s] = share * s.weight
+            break
+        for s in satisfied: rates[s] = demands[s]; capacity -= demands[s]; pending.remove(s)
+    return rates
+
+
+# --- Scheduler ---
+class BandwidthScheduler:
+    """Token buckets for active response bodies, re-rated by fair sharing of the global and per-client caps."""
+    def __init__(self, global_limit=0, client_limit=0):
+        self.global_limit = global_limit; self.client_limit = client_limit
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._measured_at = time.monotonic()
+
+    def is_limited(self):
+        return bool(self.global_limit or self.client_limit)
+
+    def set_limits(self, global_limit, client_limit):
+        with self._lock:
+            self.global_limit = global_limit; self.client_limit = client_limit
+            for s in self._sessions: s.fresh = True # Let everyone probe for the new share
+            self._allocate(time.monotonic())
+
+    def open(self, client, traffic_class):
+        weight = config.BANDWIDTH_WEIGHTS.get(traffic_class, 1)
+        with self._lock:
+            now = time.monotonic(); session = _Session(client, traffic_class, weight, now)
+            self._sessions.add(session); self._allocate(now)
+        return session
+
+    def close(self, session):
+        with self._lock:
+            self._sessions.discard(session); self._allocate(time.monotonic())
+
+    def take(self, session, num_bytes):
+        """Seconds the caller must wait before sending num_bytes on this session."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._measured_at >= _REALLOCATE_INTERVAL: self._measure(now); self._allocate(now)
+            elif now - session.last_active >= _IDLE_SECONDS: # Resuming after a pause: rejoin the split right away
+                session.fresh = True; session.last_active = session.measured_from = now; session.sent = 0; self._allocate(now)
+            return session.take(num_bytes, now)
+
+    def _measure(self, now):
+        self._measured_at = now
+        for s in self._sessions:
+            elapsed = now - s.measured_from
+            if elapsed < _REALLOCATE_INTERVAL / 2: continue # Too new to tell
+            s.measured = s.sent / elapsed if s.fresh else 0.5 * s.measured + 0.5 * s.sent / elapsed
+            if s.sent: s.fresh = False
+            s.sent = 0; s.measured_from = now
+
+    def _allocate(self, now):
+        active = [s for s in self._sessions if now - s.last_active < _IDLE_SECONDS]
+        demands = {s: s.demand() for s in active}
+        if self.client_limit:
+            by_client = {}
+            for s in active: by_client.setdefault(s.client, []).append(s)
+            for sessions in by_client.values(): demands.update(_water_fill(sessions, self.client_limit, demands))
+        rates = _water_fill(active, self.global_limit or math.inf, demands)
+        for s in self._sessions:
+            s.rate = max(rates.get(s, _MIN_RATE), _MIN_RATE) if (self.global_limit or self.client_limit) else math.inf
+
+    def get_status(self):
+        with self._lock:
+            sessions = [{'client': s.client, 'class': s.traffic_class, 'rate': None if s.rate == math.inf else int(s.rate), 'measured': int(s.measured)}
+                        for s in sorted(self._sessions, key=lambda s: (s.client, s.traffic_class))]
+        return {'global_limit': self.global_limit, 'client_limit': self.client_limit, 'sessions': sessions}
+
+
+_scheduler = BandwidthScheduler(config.BANDWIDTH_GLOBAL_LIMIT, config.BANDWIDTH_CLIENT_LIMIT)
+_limits_checked_at = 0.0
+_limits_mtime_ns = None
+
+
+# --- Runtime Limits (shared by workers through a small JSON file) ---
+def _refresh_limits():
+    """Applies BANDWIDTH_LIMITS_PATH when it changed since the last check (at most once per interval)."""
+    global _limits_checked_at, _limits_mtime_ns
+    now = time.monotonic()
+    if now - _limits_checked_at < _LIMITS_CHECK_INTERVAL: return
+    _limits_checked_at = now
+    try: mtime_ns = os.stat(config.BANDWIDTH_LIMITS_PATH).st_mtime_ns
+    except OSError: mtime_ns = None
+    if mtime_ns == _limits_mtime_ns: return
+    _limits_mtime_ns = mtime_ns
+    if mtime_ns is None: limits = {}
+    else:
+        try:
+            with open(config.BANDWIDTH_LIMITS_PATH, 'r', encoding='utf-8') as f: limits = json.load(f)
+        except (OSError, ValueError) as e: logger.error(f"Could not read bandwidth limits '{config.BANDWIDTH_LIMITS_PATH}': {e}"); return
+    _scheduler.set_limits(int(limits.get('global_limit', config.BANDWIDTH_GLOBAL_LIMIT)), int(limits.get('client_limit', config.BANDWIDTH_CLIENT_LIMIT)))
+
+def set_limits(global_limit, client_limit):
+    """Changes the caps (bytes/s, 0 = unlimited) for every worker; persists across restarts."""
+    if global_limit < 0 or client_limit < 0: raise ValueError("Limits must be 0 (unlimited) or positive.")
+    os.makedirs(os.path.dirname(config.BANDWIDTH_LIMITS_PATH), exist_ok=True)
+    tmp_path = f"{config.BANDWIDTH_LIMITS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({'global_limit': global_limit, 'client_limit': client_limit}, f)
+    os.replace(tmp_path, config.BANDWIDTH_LIMITS_PATH)
+    global _limits_checked_at; _limits_checked_at = 0.0; _refresh_limits()
+    logger.info(f"Bandwidth limits set: global {global_limit} B/s, per client {client_limit} B/s")
+
+def is_limited():
+    """True if any cap is set, i.e. response bodies should go through ThrottledBody."""
+    _refresh_limits()
+    return _scheduler.is_limited()
+
+def get_status():
+    _refresh_limits()
+    return _scheduler.get_status()
+
+
+# --- Throttled Bodies ---
+class ThrottledBody:
+    """
+    Response body that paces an iterable of chunks through a scheduler session. Iterating it sleeps
+    between chunks; the ASGI server instead advances `iterable` itself and awaits take()'s delay.
+    """
+    def __init__(self, iterable, client, traffic_class):
+        self.iterable = iterable; self.client = client; self.traffic_class = traffic_class
+        self._session = None # Opened on the first chunk, so HEAD/304 responses never register
+
+    def take(self, num_bytes):
+        if self._session is None: self._session = _scheduler.open(self.client, self.traffic_class)
+        return _scheduler.take(self._session, num_bytes)
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            delay = self.take(len(chunk))
+            if delay > 0: time.sleep(delay)
+            yield chunk
+
+    def close(self):
+        if self._session is not None: _scheduler.close(self._session); self._session = None
+        if hasattr(self.iterable, 'close'): self.iterable.close()
+
+def client_key(environ):
+    """Per-client cap key: the peer address (behind a reverse proxy every client shares the proxy's)."""
+    return environ.get('REMOTE_ADDR') or 'unknown'
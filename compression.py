@@ -0,0 +1,177 @@
+# compression.py
+import os
+import gzip
+import json
+import time
+import zlib
+import hashlib
+import logging
+import mimetypes
+import threading
+
+from flask import send_file, abort, url_for
+
+import config # Use our config file
+
+# brotli is optional: without it responses and static assets are gzip-only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Two parts: (1) negotiated gzip/brotli for dynamic text-like responses (pages, JSON, playlists), applied in an
+# after_request hook; (2) static assets copied under a content hash (style.abc123.css) next to precompressed .gz/.br
+# siblings, so pages can reference them with `Cache-Control: immutable` and repeat visits make no static requests.
+# build_static_assets() does (2) ahead of time; asset_url() builds a changed or missing asset on first use.
+
+_ENCODERS = {'gzip': lambda data: gzip.compress(data, compresslevel=config.COMPRESS_GZIP_LEVEL, mtime=0)}
+if brotli is not None: _ENCODERS['br'] = lambda data: brotli.compress(data, quality=config.COMPRESS_BROTLI_QUALITY)
+_PREFERENCE = ('br', 'gzip') # On equal quality values
+
+
+# --- Negotiation ---
+def negotiate(accept_encodings, available=None):
+    """Best of `available` (default: every encoder) accepted by the client, or None for identity."""
+    best = None; best_quality = 0
+    for encoding in _PREFERENCE:
+        if encoding not in (available if available is not None else _ENCODERS): continue
+        quality = accept_encodings[encoding] # 0 if not accepted; honours '*' and q=0
+        if quality > best_quality: best = encoding; best_quality = quality
+    return best
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in config.COMPRESS_MIMETYPES)
+
+
+# --- Dynamic Responses ---
+def compress_response(req, response):
+    """Compresses a buffered, complete, text-like response body if the client accepts it; returns the response."""
+    if not config.COMPRESS_ENABLED or not is_compressible(response.mimetype): return response
+    response.vary.add('Accept-Encoding')
+    # Files, streams (ranges, SSE follow, HLS segments) and partial/conditional replies are left as they are
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers: return response
+    encoding = negotiate(req.accept_encodings)
+    if encoding is None: return response
+    data = response.get_data()
+    if len(data) < config.COMPRESS_MIN_SIZE: return response
+    compressed = _ENCODERS[encoding](data)
+    if len(compressed) >= len(data): return response
+    response.set_data(compressed); response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Accept-Ranges', None) # Byte ranges would refer to the identity body
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True) # Same content, different bytes
+    return response
+
+def accepts_streamed_gzip(req):
+    """True if a generated body should go through gzip_stream (the after_request hook can't compress streamed responses)."""
+    return config.COMPRESS_ENABLED and negotiate(req.accept_encodings, ('gzip',)) == 'gzip'
+
+def gzip_stream(chunks):
+    """Gzips an iterable of str/bytes chunks as it is consumed, flushing after each so every chunk reaches the client."""
+    compressor = zlib.compressobj(config.COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31) # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data: yield data
+    yield compressor.flush()
+
+
+# --- Fingerprinted Static Assets ---
+_MANIFEST_NAME = 'manifest.json'
+_assets = {} # filename -> (size, mtime_ns, hashed name), per worker
+_assets_lock = threading.Lock()
+_manifest_loaded = False
+
+def _fingerprinted_name(filename, data):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:config.STATIC_ASSET_HASH_LENGTH]}{ext}"
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f: f.write(data)
+    os.replace(tmp_path, path)
+
+def _build_asset(filename, st):
+    """Writes the hashed copy of static/<filename> and its precompressed siblings; returns the hashed name."""
+    with open(os.path.join(config.STATIC_DIR, filename), 'rb') as f: data = f.read()
+    hashed = _fingerprinted_name(filename, data); target = os.path.join(config.STATIC_BUILD_DIR, hashed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not os.path.exists(target): # Content-addressed: an existing file is already this content
+        _write_atomic(target, data)
+        if is_compressible(mimetypes.guess_type(filename)[0]):
+            for encoding, encode in _ENCODERS.items():
+                compressed = encode(data)
+                if len(compressed) < len(data): _write_atomic(f"{target}.{'gz' if encoding == 'gzip' else encoding}", compressed)
+        logger.info(f"Built static asset '{filename}' -> '{hashed}'")
+    return hashed
+
+def _prune_old_versions(current):
+    """Removes superseded hashed copies older than STATIC_ASSET_KEEP_SECONDS (pages cached before a rebuild may still ask for them)."""
+    current_names = set(current.values()); cutoff = time.time() - config.STATIC_ASSET_KEEP_SECONDS
+    stems = {os.path.splitext(name)[0] for name in current}
+    for dirpath, _, files in os.walk(config.STATIC_BUILD_DIR):
+        for name in files:
+            path = os.path.join(dirpath, name); rel = os.path.relpath(path, config.STATIC_BUILD_DIR)
+            base = rel.removesuffix('.gz').removesuffix('.br')
+            if rel == _MANIFEST_NAME or base in current_names: continue
+            if os.path.splitext(os.path.splitext(base)[0])[0] not in stems: continue # Not ours
+            try:
+                if os.stat(path).st_mtime < cutoff: os.remove(path)
+            except OSError: pass
+
+def build_static_assets():
+    """Build step: fingerprints and precompresses every file in static/ and writes the manifest. Run after updating."""
+    manifest = {}
+    for dirpath, _, files in os.walk(config.STATIC_DIR):
+        for name in sorted(files):
+            filename = os.path.relpath(os.path.join(dirpath, name), config.STATIC_DIR).replace(os.sep, '/')
+            st = os.stat(os.path.join(config.STATIC_DIR, filename))
+            manifest[filename] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'asset': _build_asset(filename, st)}
+    os.makedirs(config.STATIC_BUILD_DIR, exist_ok=True)
+    _write_atomic(os.path.join(config.STATIC_BUILD_DIR, _MANIFEST_NAME), json.dumps(manifest, indent=1).encode('utf-8'))
+    _prune_old_versions({filename: entry['asset'] for filename, entry in manifest.items()})
+    print(f"Built {len(manifest)} static assets in {config.STATIC_BUILD_DIR} (brotli: {'yes' if brotli else 'no, pip install brotli'})")
+
+def _load_manifest():
+    global _manifest_loaded
+    _manifest_loaded = True
+    try:
+        with open(os.path.join(config.STATIC_BUILD_DIR, _MANIFEST_NAME), 'r', encoding='utf-8') as f: manifest = json.load(f)
+    except FileNotFoundError: return
+    except (OSError, ValueError) as e: logger.error(f"Could not read static asset manifest: {e}"); return
+    for filename, entry in manifest.items():
+        if os.path.isfile(os.path.join(config.STATIC_BUILD_DIR, entry['asset'])): _assets[filename] = (entry['size'], entry['mtime_ns'], entry['asset'])
+
+def asset_url(filename):
+    """URL of static/<filename> under its content hash (template global); falls back to the plain static URL."""
+    try: st = os.stat(os.path.join(config.STATIC_DIR, filename))
+    except OSError: return url_for('static', filename=filename)
+    with _assets_lock:
+        if not _manifest_loaded: _load_manifest()
+        cached = _assets.get(filename)
+        if cached is None or cached[:2] != (st.st_size, st.st_mtime_ns): # Edited since the last build
+            try: cached = _assets[filename] = (st.st_size, st.st_mtime_ns, _build_asset(filename, st))
+            except OSError as e: logger.error(f"Could not build static asset '{filename}': {e}"); return url_for('static', filename=filename)
+    return url_for('static_asset', asset=cached[2])
+
+def _is_fingerprinted(asset):
+    """True for names _fingerprinted_name produces ('<stem>.<hash><ext>'), so the manifest and temp files are never served."""
+    stem, ext = os.path.splitext(asset)
+    return any(len(digest) == config.STATIC_ASSET_HASH_LENGTH and all(c in '0123456789abcdef' for c in digest)
+               for digest in (os.path.splitext(stem)[1][1:], ext[1:])) # ext: files with no extension of their own
+
+def send_asset(req, asset):
+    """Response for a hashed asset: the precompressed variant the client accepts, cacheable forever."""
+    path = os.path.realpath(os.path.join(config.STATIC_BUILD_DIR, asset))
+    if not path.startswith(os.path.realpath(config.STATIC_BUILD_DIR) + os.sep) or not _is_fingerprinted(asset) or not os.path.isfile(path): abort(404)
+    mimetype = mimetypes.guess_type(asset)[0] or 'application/octet-stream'
+    available = [encoding for encoding in _PREFERENCE if os.path.isfile(f"{path}.{'gz' if encoding == 'gzip' else encoding}")]
+    encoding = negotiate(req.accept_encodings, available) if available else None
+    response = send_file(f"{path}.{'gz' if encoding == 'gzip' else encoding}" if encoding else path, mimetype=mimetype, conditional=True)
+    if encoding: response.headers['Content-Encoding'] = encoding
+    if available: response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = config.STATIC_ASSET_CACHE_CONTROL
+    return response
@@ -11,8 +11,166 @@ PASSWORD_HASH = "pbkdf2:sha256:1000000$QEcVPMpd6XB5QzRY$5078abcb1f23f1b1c424d397
 # --- Media & File Configuration ---
 MEDIA_DIR_BASE = os.path.abspath(os.path.join(APP_DIR, 'media')) # Renamed from videos
 CHUNK_SIZE = 1024 * 1024  # 1 MB
+STREAM_USE_SENDFILE = True # Hand file ranges to the WSGI server's file wrapper (kernel sendfile) when supported
+STREAM_SENDFILE_SERVERS = ('gunicorn', 'waitress', 'pi-streamer-asgi') # SERVER_SOFTWARE prefixes whose file wrapper honours Content-Length
+STREAM_FADVISE = True # posix_fadvise hints: SEQUENTIAL for served ranges, WILLNEED ahead of the reader
+STREAM_READAHEAD_CHUNKS = 2 # Chunks announced (WILLNEED) ahead of the one being read
+STREAM_CHUNK_INITIAL = 256 * 1024 # Generator chunk size at the start of a body; then adapted to the client
+STREAM_CHUNK_MIN = 64 * 1024
+STREAM_CHUNK_MAX = 4 * 1024 * 1024
+STREAM_CHUNK_TARGET_SECONDS = 0.25 # Chunks are sized to take about this long for the client to drain
+STREAM_DROP_BULK_CACHE = True # /download bodies drop sent bytes from the page cache (uses the generator, not sendfile)
+STREAM_DROP_BEHIND_BYTES = 16 * 1024 * 1024 # How much a download sends between DONTNEED calls
+
+# --- Async Serving Mode (asgi.py, e.g. `uvicorn asgi:application`) ---
+ASGI_APP_THREADS = 8 # Threads running Flask views per process (file bodies are sent without holding one)
+ASGI_IO_THREADS = 16 # Threads doing the positional reads behind file bodies
+ASGI_CHUNK_SIZE = 256 * 1024 # Read size per file body chunk: roughly the memory each open stream holds
+
+# --- MP4 Fast Start (/stream serves moov-at-end MP4s with the moov moved in front; files are never modified) ---
+FASTSTART_ENABLED = True
+FASTSTART_CACHE_DIR = os.path.join(APP_DIR, 'cache', 'faststart') # Rewritten moov boxes (shared by workers)
+FASTSTART_MAX_MOOV_BYTES = 64 * 1024 * 1024 # Larger indexes are served where they are
+FASTSTART_MEMORY_BYTES = 32 * 1024 * 1024 # Rewritten moovs kept in memory per worker (LRU)
+FASTSTART_MEMORY_FILES = 1024 # Files remembered per worker (including ones that need no rewrite)
+
+# --- Folder Downloads (/download_folder streams a stored ZIP64 archive; Range/resume supported) ---
+ZIP_CRC_DB_PATH = os.path.join(APP_DIR, 'cache', 'zip_crc.sqlite3') # CRC-32 per file, keyed by path, size and mtime (lets resumes skip re-reading)
+
+# --- Bandwidth Scheduling (per app worker; 0 = unlimited, which keeps kernel sendfile) ---
+BANDWIDTH_GLOBAL_LIMIT = 0 # Bytes/s for all /stream, /download and HLS segment bodies together
+BANDWIDTH_CLIENT_LIMIT = 0 # Bytes/s per client address
+BANDWIDTH_WEIGHTS = {'stream': 4, 'download': 1} # Fair-share weights: playback outranks bulk downloads
+BANDWIDTH_BURST_SECONDS = 0.5 # Token bucket depth, in seconds of a session's rate
+BANDWIDTH_CHUNK_SIZE = 64 * 1024 # Read size for paced bodies
+BANDWIDTH_LIMITS_PATH = os.path.join(APP_DIR, 'cache', 'bandwidth.json') # Runtime overrides set via /bandwidth
+
+# --- Small File Byte Cache (per app worker) ---
+BYTE_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Memory for whole images/thumbnails served without a disk read (LRU)
+BYTE_CACHE_MAX_FILE_BYTES = 512 * 1024 # Only files up to this size are cached
+
+# --- Compression (brotli needs `pip install brotli`, else gzip only) ---
+COMPRESS_ENABLED = True # Negotiated gzip/brotli for pages, JSON and playlists (never media, files or streams)
+COMPRESS_MIN_SIZE = 1024 # Smaller bodies are sent as they are
+COMPRESS_MIMETYPES = ('application/json', 'application/javascript', 'application/xml', 'image/svg+xml', 'audio/x-mpegurl', 'application/vnd.apple.mpegurl') # Besides text/*
+COMPRESS_GZIP_LEVEL = 6 # 1-9; per request, so moderate
+COMPRESS_BROTLI_QUALITY = 5 # 0-11; per request, so moderate (static assets are built once)
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+STATIC_BUILD_DIR = os.path.join(APP_DIR, 'cache', 'static') # Content-hashed, precompressed copies (build_static_assets)
+STATIC_ASSET_HASH_LENGTH = 12 # Hex digits of SHA-256 in asset names
+STATIC_ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable' # The name changes with the content
+STATIC_ASSET_KEEP_SECONDS = 7 * 24 * 3600 # Superseded versions stay this long for pages cached before a rebuild
+
+# --- HTTP Caching (per file type, see EXTENSION_TYPE_MAP) ---
+# Responses always carry ETag/Last-Modified; no-cache means "revalidate", which costs a 304 and no body.
+CACHE_CONTROL_BY_TYPE = {
+    'image': 'private, max-age=86400', # Grid thumbnails and modal views are reused without any request
+    'video': 'private, no-cache',
+    'audio': 'private, no-cache',
+    'text': 'private, no-cache',
+    'default': 'private, no-cache',
+}
 FILESYSTEM_ENCODING = sys.getfilesystemencoding() or 'utf-8'
 
+# --- Directory Listing Cache ---
+LISTING_CACHE_MAX_DIRS = 256 # Max number of directory listings kept in memory (LRU)
+LISTING_CACHE_MAX_ITEMS = 200000 # Max total entries across all cached listings
+LISTING_CACHE_MTIME_GRACE = 2.0 # Seconds; dirs modified more recently than this aren't cached (coarse mtime filesystems)
+LISTING_CACHE_REVALIDATE_INTERVAL = 30 # Seconds before a cached listing re-stats its files (in-place edits don't change the dir mtime)
+
+# --- Library Index (SQLite, shared by all workers) ---
+LIBRARY_INDEX_ENABLED = True # Persist directory listings so cold starts and other workers skip the disk walk
+LIBRARY_INDEX_PATH = os.path.join(APP_DIR, 'cache', 'library.sqlite3') # Keep outside MEDIA_DIR_BASE
+LIBRARY_INDEX_RESCAN_INTERVAL = 300 # Seconds between background incremental rescans
+LIBRARY_INDEX_BUSY_TIMEOUT = 5.0 # Seconds a writer waits for another worker's write lock
+SEARCH_RESULTS_PER_PAGE = 50 # Hits per search results page
+SEARCH_MAX_HITS = 1000 # Hits counted/pageable per query (refine the query beyond this)
+
+# --- Browsing ---
+BROWSE_ITEMS_PER_PAGE = 198 # Items per page for every folder type
+BROWSE_JSON_MAX_LIMIT = 1000 # Upper bound for the 'limit' parameter of the JSON listing API
+
+# --- Image Thumbnails (requires Pillow; full images are used without it) ---
+THUMBNAIL_CACHE_DIR = os.path.join(APP_DIR, 'cache', 'thumbnails') # Keep outside MEDIA_DIR_BASE
+THUMBNAIL_MAX_SIZE = 320 # Longest edge in pixels
+THUMBNAIL_QUALITY = 80 # JPEG quality
+THUMBNAIL_WORKERS = 2 # Processes per app worker used to generate thumbnails
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=31536000, immutable' # Grid URLs carry a version parameter
+
+# --- Text Viewer (paged; any file size) ---
+TEXT_PAGE_LINES = 500 # Lines per page the viewer loads while scrolling
+TEXT_PAGE_MAX_LINES = 5000 # Upper bound for ?lines=
+TEXT_PAGE_MAX_BYTES = 1024 * 1024 # Page size cap (pages end at a whole line unless one line is longer)
+TEXT_INDEX_BLOCK_BYTES = 1024 * 1024 # Line-offset index granularity: one newline count per block
+TEXT_INDEX_DIR = os.path.join(APP_DIR, 'cache', 'text_index') # Persisted indexes, shared by workers
+TEXT_INDEX_MEMORY_MAX = 64 # Indexes kept in memory per worker (LRU)
+TEXT_ENCODING_SAMPLE_BYTES = 64 * 1024 # Bytes read once to pick the encoding
+TEXT_FOLLOW_POLL_INTERVAL = 0.5 # Seconds between size checks of a followed file (one watcher per file per worker)
+TEXT_FOLLOW_MAX_READ = 1024 * 1024 # Appended bytes read per check
+TEXT_FOLLOW_BUFFER_BYTES = 1024 * 1024 # Recent appended bytes kept in memory for the file's viewers
+TEXT_FOLLOW_MAX_CATCHUP = 1024 * 1024 # A viewer further behind than this skips ahead
+TEXT_FOLLOW_IDLE_SECONDS = 10 # A watcher without viewers stops after this long
+TEXT_FOLLOW_KEEPALIVE = 15 # Seconds between SSE keep-alive comments on a quiet file
+TEXT_FOLLOW_MAX_SECONDS = 300 # Follow responses end after this (async mode); EventSource reconnects where it left off
+TEXT_FOLLOW_SYNC_MAX_SECONDS = 3 # Same limit under sync WSGI workers, where each open response holds a whole worker
+TEXT_FOLLOW_SYNC_RETRY_MS = 2000 # Reconnect delay sent to EventSource under sync workers (the worker is free in between)
+
+# --- Media Metadata (duration, resolution, codecs; read in the background, ffprobe only as a fallback) ---
+METADATA_ENABLED = True
+METADATA_DB_PATH = os.path.join(APP_DIR, 'cache', 'metadata.sqlite3') # Keyed by path, size and mtime (shared by workers)
+METADATA_WORKERS = 2 # Extraction threads per app worker
+METADATA_QUEUE_MAX = 10000 # Files waiting per app worker; the rest are queued again later
+METADATA_PROBE_TIMEOUT = 30 # Seconds per ffprobe run
+METADATA_MAX_HEADER_BYTES = 16 * 1024 * 1024 # Largest MP4 moov / Matroska Tracks element read into memory
+METADATA_RECHECK_INTERVAL = 5 # Seconds before a cached listing looks again for metadata still being read
+METADATA_DISCOVERY_INTERVAL = 600 # Seconds between passes over the library index for files not read yet
+
+# --- HLS Adaptive Streaming (requires ffmpeg and ffprobe) ---
+HLS_ENABLED = True # Offer an 'Auto (HLS)' quality in the video player when ffmpeg/ffprobe are found
+HLS_PLAYER_DEFAULT = False # Start the player in HLS mode (else the original file; '?mode=hls' overrides)
+FFMPEG_PATH = 'ffmpeg' # Name on PATH or absolute path
+FFPROBE_PATH = 'ffprobe'
+HLS_CACHE_DIR = os.path.join(APP_DIR, 'cache', 'hls') # Transcoded segments; keep outside MEDIA_DIR_BASE
+HLS_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024 # Least recently used segments are evicted beyond this
+HLS_SEGMENT_SECONDS = 6 # Segment duration
+HLS_VARIANTS = ( # Renditions offered (only those no taller than the source)
+    {'name': '360p', 'height': 360, 'video_bitrate': '800k', 'audio_bitrate': '96k'},
+    {'name': '480p', 'height': 480, 'video_bitrate': '1400k', 'audio_bitrate': '128k'},
+    {'name': '720p', 'height': 720, 'video_bitrate': '2800k', 'audio_bitrate': '128k'},
+    {'name': '1080p', 'height': 1080, 'video_bitrate': '5000k', 'audio_bitrate': '160k'},
+)
+HLS_VIDEO_ENCODER = 'libx264' # e.g. 'h264_v4l2m2m' for the Raspberry Pi hardware encoder
+HLS_X264_PRESET = 'veryfast' # libx264 only
+HLS_MAX_TRANSCODES = 1 # Concurrent ffmpeg processes per app worker
+HLS_PREFETCH_SEGMENTS = 2 # Segments encoded ahead of the one being played
+HLS_SEGMENT_TIMEOUT = 60 # Seconds a segment request waits for the encoder before a 503 (players retry)
+HLS_SEGMENT_CACHE_CONTROL = 'private, no-cache' # Segments revalidate by ETag (their URL doesn't change with the source)
+
+# --- Background Transcoding (quality variants for QUALITY_SUFFIXES, requires ffmpeg/ffprobe) ---
+TRANSCODE_ENABLED = False # Opt-in: writes '<name>_720p<ext>' etc. next to the originals in MEDIA_DIR_BASE
+TRANSCODE_TARGETS = ('_720p', '_480p') # QUALITY_SUFFIXES keys to produce (skipped if the source isn't taller)
+TRANSCODE_CONTAINERS = ('.mp4', '.mkv', '.mov') # Source types handled (output keeps the source's container)
+TRANSCODE_DB_PATH = os.path.join(APP_DIR, 'cache', 'transcode.sqlite3') # Persistent job queue (shared by workers)
+TRANSCODE_MAX_JOBS = 1 # ffmpeg jobs running at once across all app workers
+TRANSCODE_NICENESS = 15 # Process niceness for transcodes, so live streams and HLS keep priority
+TRANSCODE_THREADS = 2 # ffmpeg threads per job
+TRANSCODE_X264_PRESET = 'medium' # libx264 only; variants are made once, so favour quality over speed
+TRANSCODE_CRF = 23 # libx264 only
+TRANSCODE_JOB_TIMEOUT = 6 * 3600 # Seconds before a running ffmpeg is killed and its job marked failed
+TRANSCODE_DISCOVERY_INTERVAL = 600 # Seconds between scans of the library index for videos missing variants
+TRANSCODE_POLL_INTERVAL = 10 # Seconds an idle worker waits before checking the queue again
+
+# --- Uploads ---
+UPLOAD_MAX_FILE_SIZE = 10 * 1024 * 1024 * 1024 # 10 GB per file (chunked uploads)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Chunk size the browser uploader sends per PUT
+UPLOAD_PARALLEL_CHUNKS = 3 # Chunks the browser keeps in flight per file
+UPLOAD_WRITE_BLOCK_SIZE = 1024 * 1024 # Uploads are written to disk in aligned blocks of this size
+UPLOAD_FSYNC_POLICY = 'on_close' # 'none' (leave to the OS), 'on_close' (once per file/chunk) or 'interval'
+UPLOAD_FSYNC_INTERVAL_BYTES = 64 * 1024 * 1024 # With 'interval': fsync after this many bytes
+UPLOAD_MAX_FORM_MEMORY = 500 * 1024 # Max size of a non-file form field in a streamed multipart upload
+UPLOAD_SESSION_DIR = os.path.join(APP_DIR, 'cache', 'uploads') # Resumable session metadata (shared by workers)
+UPLOAD_SESSION_TTL = 24 * 3600 # Seconds an idle upload session (and its partial file) is kept
+
 # --- File Type Recognition ---
 # Keep original video/audio lists for playlist/playall compatibility for now
 VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
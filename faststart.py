@@ -0,0 +1,201 @@
+# faststart.py
+import os
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+import config # Use our config file
+import bandwidth
+import streaming
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# MP4s written with the index (moov) after the media data (mdat) make a player fetch the file's tail before the
+# first frame. For those, /stream serves a virtual "fast start" layout instead of the file's own bytes:
+#     [everything before the first mdat] [moov, chunk offsets shifted] [mdat ... up to the old moov] [rest after it]
+# Only the rewritten moov is new; it is cached in FASTSTART_CACHE_DIR (the file itself is never touched) and every
+# other byte is read from the original, so ranges inside the media data still go out by sendfile.
+
+_HEADER = struct.Struct('>4Q') # Cache file: insert_at, moov_start, moov_end, source_size, then the rewritten moov
+_CONTAINERS = (b'trak', b'mdia', b'minf', b'stbl') # Path from moov down to the chunk offset tables
+_EXTENSIONS = ('.mp4', '.m4v', '.m4a', '.mov')
+
+_layouts = OrderedDict() # source key -> FaststartLayout, or None if the file needs none (per worker, LRU)
+_layouts_bytes = 0
+_layouts_lock = threading.Lock()
+
+
+# --- Layout ---
+class FaststartLayout:
+    """Virtual byte layout of one MP4 with its moov moved in front of the media data."""
+    __slots__ = ('header', 'insert_at', 'moov_start', 'moov_end', 'source_size', 'size')
+
+    def __init__(self, header, insert_at, moov_start, moov_end, source_size):
+        self.header = header; self.insert_at = insert_at; self.moov_start = moov_start; self.moov_end = moov_end
+        self.source_size = source_size; self.size = source_size - (moov_end - moov_start) + len(header)
+
+    @property
+    def head_end(self):
+        """Virtual offset where the relocated moov ends: everything a player needs before the first frame."""
+        return self.insert_at + len(self.header)
+
+    def _segments(self):
+        """(virtual start, length, source offset or None for the rewritten moov) in virtual order."""
+        return ((0, self.insert_at, 0), (self.insert_at, len(self.header), None),
+                (self.head_end, self.moov_start - self.insert_at, self.insert_at),
+                (self.head_end + self.moov_start - self.insert_at, self.source_size - self.moov_end, self.moov_end))
+
+    def pieces(self, start, length):
+        """Virtual range [start, start + length) as (source offset or None, offset within the piece's source, length) pieces."""
+        pieces = []; end = start + length
+        for seg_start, seg_length, source in self._segments():
+            lo = max(start, seg_start); hi = min(end, seg_start + seg_length)
+            if lo < hi: pieces.append((source, lo - seg_start, hi - lo))
+        return pieces
+
+    def map_offset(self, offset):
+        """Where a byte of the original file ends up in the virtual layout."""
+        if self.insert_at <= offset < self.moov_start: return offset + len(self.header)
+        if offset >= self.moov_end: return offset - (self.moov_end - self.moov_start) + len(self.header)
+        return offset
+
+
+# --- Detection & Rewriting ---
+def _top_level_boxes(f, size):
+    """(type, start, end) of the file's top-level boxes, read from their headers only."""
+    boxes = []; pos = 0
+    while pos + 8 <= size:
+        header = os.pread(f.fileno(), 16, pos)
+        if len(header) < 8: break
+        box_size, box_type = struct.unpack('>I4s', header[:8])
+        if box_size == 1 and len(header) == 16: box_size = struct.unpack('>Q', header[8:16])[0]
+        elif box_size == 0: box_size = size - pos
+        if box_size < 8: raise ValueError(f"bad box size at {pos}")
+        boxes.append((box_type, pos, min(pos + box_size, size))); pos += box_size
+    return boxes
+
+def _children(data):
+    """(type, payload) of the boxes in a container's payload."""
+    pos = 0
+    while pos + 8 <= len(data):
+        box_size, box_type = struct.unpack('>I4s', data[pos:pos + 8]); header_length = 8
+        if box_size == 1: box_size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]; header_length = 16
+        elif box_size == 0: box_size = len(data) - pos
+        if box_size < header_length or pos + box_size > len(data): raise ValueError("truncated box in moov")
+        yield box_type, data[pos + header_length:pos + box_size]; pos += box_size
+
+def _box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def _rewrite(data, shift, use_co64):
+    """A container payload with every stco/co64 entry passed through shift (stco becomes co64 if use_co64)."""
+    out = bytearray()
+    for box_type, payload in _children(data):
+        if box_type in _CONTAINERS: out += _box(box_type, _rewrite(payload, shift, use_co64)); continue
+        if box_type in (b'stco', b'co64'):
+            count = struct.unpack('>I', payload[4:8])[0]; wide = box_type == b'co64'
+            offsets = struct.unpack(f">{count}{'Q' if wide else 'I'}", payload[8:8 + count * (8 if wide else 4)])
+            offsets = [shift(offset) for offset in offsets]
+            if use_co64 or wide: out += _box(b'co64', payload[:8] + struct.pack(f'>{count}Q', *offsets))
+            elif max(offsets, default=0) > 0xFFFFFFFF: raise OverflowError("chunk offset needs co64")
+            else: out += _box(b'stco', payload[:8] + struct.pack(f'>{count}I', *offsets))
+            continue
+        out += _box(box_type, payload) # Copied as is (also normalizes 64-bit headers of small boxes)
+    return bytes(out)
+
+def build_layout(file_path_abs, size):
+    """FaststartLayout for an MP4 whose moov follows its first mdat, else None (already fast start, fragmented, not MP4)."""
+    with open(file_path_abs, 'rb') as f:
+        boxes = _top_level_boxes(f, size)
+        types = [box_type for box_type, _, _ in boxes]
+        if b'moov' not in types or b'mdat' not in types or b'moof' in types: return None
+        moov_start, moov_end = next((start, end) for box_type, start, end in boxes if box_type == b'moov')
+        insert_at = next(start for box_type, start, _ in boxes if box_type == b'mdat')
+        if moov_start < insert_at: return None
+        if moov_end - moov_start > config.FASTSTART_MAX_MOOV_BYTES: logger.info(f"moov of '{file_path_abs}' too large to relocate ({moov_end - moov_start} bytes)"); return None
+        moov = os.pread(f.fileno(), moov_end - moov_start, moov_start)
+    header_length = 16 if struct.unpack('>I', moov[:4])[0] == 1 else 8
+    payload = moov[header_length:]
+    if any(box_type == b'cmov' for box_type, _ in _children(payload)): return None # Compressed moov
+    for use_co64 in (False, True):
+        # Offsets after the new moov shift by its size, which only depends on use_co64: size it with a dry run first
+        new_length = len(_box(b'moov', _rewrite(payload, lambda offset: 0, use_co64)))
+        placeholder = FaststartLayout(bytes(new_length), insert_at, moov_start, moov_end, size)
+        try: header = _box(b'moov', _rewrite(payload, placeholder.map_offset, use_co64))
+        except OverflowError: continue
+        return FaststartLayout(header, insert_at, moov_start, moov_end, size)
+    return None
+
+
+# --- Cache ---
+def _cache_path(item_id, stat_result):
+    return os.path.join(config.FASTSTART_CACHE_DIR, f"{item_id}-{streaming.file_etag(stat_result)}.moov")
+
+def _load_cached(path, size):
+    try:
+        with open(path, 'rb') as f: data = f.read()
+    except FileNotFoundError: return None
+    insert_at, moov_start, moov_end, source_size = _HEADER.unpack_from(data)
+    if source_size != size: return None
+    return FaststartLayout(data[_HEADER.size:], insert_at, moov_start, moov_end, source_size)
+
+def _store_cached(path, item_id, layout):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f: f.write(_HEADER.pack(layout.insert_at, layout.moov_start, layout.moov_end, layout.source_size)); f.write(layout.header)
+    os.replace(tmp_path, path)
+    for name in os.listdir(config.FASTSTART_CACHE_DIR): # Headers of earlier versions of the file
+        if name.startswith(f"{item_id}-") and name.endswith('.moov') and name != os.path.basename(path):
+            try: os.remove(os.path.join(config.FASTSTART_CACHE_DIR, name))
+            except OSError: pass
+
+def get_layout(item_id, file_path_abs, stat_result):
+    """The fast start layout to serve for a file, or None to serve its own bytes. Built once, then cached."""
+    if not config.FASTSTART_ENABLED or not file_path_abs.lower().endswith(_EXTENSIONS): return None
+    global _layouts_bytes
+    key = _cache_path(item_id, stat_result)
+    with _layouts_lock:
+        if key in _layouts: _layouts.move_to_end(key); return _layouts[key]
+    try:
+        layout = _load_cached(key, stat_result.st_size)
+        if layout is None:
+            layout = build_layout(file_path_abs, stat_result.st_size)
+            if layout is not None:
+                _store_cached(key, item_id, layout)
+                logger.info(f"Fast start layout for '{file_path_abs}': moov of {len(layout.header)} bytes moved from {layout.moov_start} to {layout.insert_at}")
+    except (OSError, ValueError, struct.error, StopIteration) as e:
+        logger.warning(f"Could not build a fast start layout for '{file_path_abs}', serving it as is: {e}"); layout = None
+    with _layouts_lock:
+        _layouts[key] = layout; _layouts_bytes += len(layout.header) if layout else 0
+        while len(_layouts) > 1 and (_layouts_bytes > config.FASTSTART_MEMORY_BYTES or len(_layouts) > config.FASTSTART_MEMORY_FILES):
+            _, evicted = _layouts.popitem(last=False); _layouts_bytes -= len(evicted.header) if evicted else 0
+    return layout
+
+
+# --- Response Bodies ---
+def _iter_pieces(layout, file_path_abs, pieces, chunk_size, client):
+    for source, offset, length in pieces:
+        if source is None:
+            for pos in range(offset, offset + length, config.CHUNK_SIZE): yield layout.header[pos:min(pos + config.CHUNK_SIZE, offset + length)]
+        else: yield from streaming.iter_file_range(file_path_abs, source + offset, length, chunk_size, 'stream', client)
+
+def open_range_body(environ, layout, file_path_abs, start, length):
+    """
+    Like streaming.open_range_body, for bytes [start, start + length) of the virtual layout. A range inside one
+    original segment (any range in the media data) is a plain file range, so it keeps the sendfile path.
+    """
+    pieces = layout.pieces(start, length)
+    if len(pieces) == 1 and pieces[0][0] is not None:
+        source, offset, piece_length = pieces[0]
+        return streaming.open_range_body(environ, file_path_abs, source + offset, piece_length)
+    client = bandwidth.client_key(environ)
+    if bandwidth.is_limited():
+        return bandwidth.ThrottledBody(_iter_pieces(layout, file_path_abs, pieces, config.BANDWIDTH_CHUNK_SIZE, client), client, 'stream')
+    return _iter_pieces(layout, file_path_abs, pieces, None, client)
+
+def etag(stat_result):
+    """Validator for the virtual layout (distinct from the file's, whose bytes /download still serves)."""
+    return f"{streaming.file_etag(stat_result)}-fs"
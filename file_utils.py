@@ -4,11 +4,16 @@ import hashlib
 import logging
 import mimetypes
 import re
+import stat
+import threading
 import time # For modification time
+from collections import OrderedDict
 from werkzeug.utils import safe_join, secure_filename
 from urllib.parse import quote
 
 import config # Use our config file
+import library_index
+import metadata # Cached duration/resolution/codecs for audio and video items
 
 # Initialize logging
 logger = logging.getLogger(__name__)
@@ -92,265 +97,544 @@ def get_file_type(filename):
     _, ext = os.path.splitext(filename)
     return config.EXTENSION_TYPE_MAP.get(ext.lower(), 'other')
 
-# --- Content Listing Helper ---
-def get_folder_contents_with_ids(current_relative_path="", sort_by='name', sort_order='asc'):
+# --- Directory Listing Cache ---
+class DirectoryListing:
+    """One scanned directory: unsorted item dicts plus the stat signature they were built from."""
+    __slots__ = ('relative_path', 'signature', 'items', 'is_image_only', 'scanned_at', 'id_index', 'name_keys', '_orders', '_media_groups', 'metadata_checked_at', 'validated_at')
+
+    def __init__(self, relative_path, signature, items, is_image_only):
+        self.relative_path = relative_path
+        self.signature = signature
+        self.items = items
+        self.is_image_only = is_image_only
+        self.scanned_at = self.validated_at = time.time() # validated_at: last re-stat of the files (see _stale_files)
+        self.id_index = {item['id']: item for item in items} # item ID -> item dict, for O(1) lookups
+        self.name_keys = [natural_sort_key(item['display_name']) for item in items] # Aligned with self.items
+        self._orders = {} # (sort_by, reverse) -> permutation of item indices
+        self._media_groups = None # MediaGroupIndex, built on first use by a player page
+        self.metadata_checked_at = 0.0 # Last metadata cache lookup; None once every media item has its 'meta'
+
+    def sorted_order(self, sort_by, sort_order='asc'):
+        """
+        Item indices in display order, memoized per (sort field, direction): the ascending permutation is
+        sorted once per listing and descending is its reverse (sort keys are unique, so this equals a reverse sort).
+        """
+        if sort_by not in _SORT_FIELDS: sort_by = 'name'
+        reverse_order = (sort_order == 'desc')
+        order = self._orders.get((sort_by, reverse_order))
+        if order is None:
+            ascending = self._orders.get((sort_by, False))
+            if ascending is None:
+                keys = [_item_sort_key(item, name_key, sort_by) for item, name_key in zip(self.items, self.name_keys)]
+                ascending = sorted(range(len(keys)), key=keys.__getitem__)
+                self._orders[(sort_by, False)] = ascending
+            order = ascending[::-1] if reverse_order else ascending
+            self._orders[(sort_by, reverse_order)] = order
+        return order
+
+    def media_groups(self):
+        """The listing's MediaGroupIndex (quality variants and play order), built once per listing."""
+        if self._media_groups is None: self._media_groups = MediaGroupIndex(self)
+        return self._media_groups
+
+
+class MediaGroupIndex:
     """
-    Lists contents of a directory specified by its relative path from base.
-    Assigns types and IDs. Includes all non-hidden files.
-    Sorts results based on sort_by and sort_order.
+    Player-page lookups for one directory listing:
+      - quality variants grouped by base name ('clip_720p.mp4' -> group of 'clip.mp4'), per QUALITY_SUFFIXES
+      - the name-ordered sequence of each item type with an ID -> position map, for prev/next
     """
-    # Clean the input path robustly
-    clean_current_path = str(current_relative_path or "").strip('/\\').replace("\\", "/")
-    if clean_current_path == ".": clean_current_path = ""
-
-    target_dir_abs = get_safe_fullpath(clean_current_path)
-    if target_dir_abs is None or not os.path.isdir(target_dir_abs):
-        logger.error(f"Cannot list contents: Invalid or non-existent directory. Relative='{current_relative_path}', Clean='{clean_current_path}', ResolvedAbs='{target_dir_abs}'")
-        return [], False # Return empty list and 'is_image_only' as False
-
-    logger.debug(f"Listing contents for relative path: '{clean_current_path}' (Absolute: '{target_dir_abs}')")
-
+    __slots__ = ('_variants', '_sequences', '_positions')
+
+    def __init__(self, listing):
+        by_stem = {} # (base name, lowercased extension) -> file item
+        for item in listing.items:
+            if item['type'] == 'folder': continue
+            base, ext = os.path.splitext(item['path'].rsplit('/', 1)[-1]); by_stem[(base, ext.lower())] = item
+        self._variants = {} # original item ID -> {label: variant item}
+        for (base, ext), item in by_stem.items():
+            for suffix, label in config.QUALITY_SUFFIXES.items():
+                if not base.endswith(suffix) or (original := by_stem.get((base[:-len(suffix)], ext))) is None: continue
+                self._variants.setdefault(original['id'], {})[label] = item
+        self._sequences = {} # item type (None = all) -> [item IDs in name order]
+        for index in listing.sorted_order('name', 'asc'):
+            item = listing.items[index]
+            self._sequences.setdefault(item['type'], []).append(item['id'])
+            self._sequences.setdefault(None, []).append(item['id'])
+        self._positions = {item_type: {item_id: i for i, item_id in enumerate(ids)} for item_type, ids in self._sequences.items()}
+
+    def quality_options(self, item):
+        """[{'label', 'path', 'id'}, ...]: 'Original' first, then variants from highest resolution down."""
+        options = [{'label': 'Original', 'path': item['path'], 'id': item['id']}]
+        variants = self._variants.get(item['id'], {})
+        for label in sorted(variants, key=_quality_label_rank, reverse=True):
+            options.append({'label': label, 'path': variants[label]['path'], 'id': variants[label]['id']})
+        return options
+
+    def prev_next(self, item_id, item_type=None):
+        """(previous ID, next ID) around an item in name order, among items of item_type (None = all)."""
+        ids = self._sequences.get(item_type, [])
+        position = self._positions.get(item_type, {}).get(item_id)
+        if position is None: return None, None
+        return (ids[position - 1] if position > 0 else None), (ids[position + 1] if position + 1 < len(ids) else None)
+
+
+class DirectoryListingCache:
+    """
+    LRU cache of DirectoryListing objects keyed by absolute directory path.
+    An entry is only returned while the directory's (dev, inode, mtime) signature is unchanged,
+    so renames/adds/removes done outside the app are picked up on the next lookup.
+    Memory is bounded both by number of directories and by total cached items.
+    """
+    def __init__(self, max_dirs, max_items):
+        self.max_dirs = max_dirs
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._total_items = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, dir_abs, signature):
+        with self._lock:
+            listing = self._entries.get(dir_abs)
+            if listing is None or listing.signature != signature:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(dir_abs)
+            self.hits += 1
+            return listing
+
+    def put(self, dir_abs, listing):
+        with self._lock:
+            self._pop(dir_abs)
+            if len(listing.items) > self.max_items: return # Would evict everything else, don't cache
+            self._entries[dir_abs] = listing
+            self._total_items += len(listing.items)
+            while len(self._entries) > self.max_dirs or self._total_items > self.max_items:
+                oldest_key = next(iter(self._entries))
+                self._pop(oldest_key); self.evictions += 1
+
+    def invalidate(self, dir_abs, recursive=False):
+        """Drops the entry for dir_abs (and, if recursive, every cached directory below it)."""
+        with self._lock:
+            keys = [dir_abs]
+            if recursive:
+                prefix = dir_abs.rstrip(os.sep) + os.sep
+                keys.extend(k for k in self._entries if k.startswith(prefix))
+            for key in keys:
+                if self._pop(key): self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear(); self._total_items = 0
+
+    def stats(self):
+        with self._lock:
+            return {'dirs': len(self._entries), 'items': self._total_items, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _pop(self, dir_abs):
+        listing = self._entries.pop(dir_abs, None)
+        if listing is not None: self._total_items -= len(listing.items)
+        return listing is not None
+
+
+_listing_cache = DirectoryListingCache(config.LISTING_CACHE_MAX_DIRS, config.LISTING_CACHE_MAX_ITEMS)
+
+def _clean_relative_dir(relative_path):
+    clean_path = str(relative_path or "").strip('/\\').replace("\\", "/")
+    return "" if clean_path == "." else clean_path
+
+def _dir_signature(dir_stat):
+    return (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+
+def _make_item(clean_current_path, item_name_orig, item_type, item_size, item_mtime, item_id=None):
+    """Builds the listing dict for one entry (from a disk scan or a library index row)."""
+    display_name = item_name_orig
+    is_problematic = False
+    # Check for problematic encoding for display name
+    try: item_name_orig.encode('utf-8')
+    except UnicodeEncodeError: is_problematic = True; display_name = repr(item_name_orig)
+    # --- Construct FULL RELATIVE path for this item ---
+    item_full_relative_path = os.path.join(clean_current_path, item_name_orig).replace("\\", "/")
+    return {
+        'type': item_type,
+        'display_name': display_name,
+        'id': item_id or generate_item_id(item_full_relative_path),
+        'path': item_full_relative_path, # Store the full relative path
+        'encoded_path': quote(item_full_relative_path, errors='surrogateescape'), # URL-encoded full relative path (raw bytes for undecodable names)
+        'size': item_size,
+        'mtime': item_mtime, # Store modification time
+        'is_problematic': is_problematic,
+    }
+
+def _scan_directory(clean_current_path, target_dir_abs):
+    """Builds item dicts for a directory in one os.scandir pass, reusing the DirEntry type/stat data."""
     items = []
     is_image_only = True # Assume true until proven otherwise
-    try:
-        raw_entry_names = os.listdir(target_dir_abs)
-        for item_name_orig in raw_entry_names:
+    with os.scandir(target_dir_abs) as it:
+        for entry in it:
+            item_name_orig = entry.name
             if item_name_orig.startswith('.'): continue # Skip hidden
 
-            display_name = item_name_orig
-            is_problematic = False
-            item_type = 'other'
-            item_size = 0
-            item_mtime = 0 # Modification time
-            full_item_path_abs = None
-
-            # --- Construct FULL RELATIVE path for this item ---
-            # Join the clean *relative* parent path with the item name
-            item_full_relative_path = os.path.join(clean_current_path, item_name_orig).replace("\\", "/")
-            # ---
-
-            # Check for problematic encoding for display name
-            try: item_name_orig.encode('utf-8')
-            except UnicodeEncodeError: is_problematic = True; display_name = repr(item_name_orig)
-
-            # Get absolute path for type/size check - use safe_join
+            # Same name validation as get_safe_fullpath, without touching the disk
             try: full_item_path_abs = safe_join(target_dir_abs, item_name_orig)
             except Exception as e: logger.warning(f"Could not join path for item '{item_name_orig}' in '{target_dir_abs}': {e}"); continue
-            if not full_item_path_abs: logger.warning(f"safe_join failed for item '{item_name_orig}'"); continue # Skip if safe_join fails
+            if not full_item_path_abs: logger.warning(f"safe_join failed for item '{item_name_orig}'"); continue
 
-            # Determine type and size
+            # Determine type and size from the DirEntry (d_type + a single cached stat)
             try:
-                stat_info = os.stat(full_item_path_abs) # Get file stats
-                item_mtime = stat_info.st_mtime # Modification time timestamp
-
-                if os.path.isdir(full_item_path_abs):
+                if entry.is_dir():
                     item_type = 'folder'
                     item_size = 0 # Folders have size 0 for sorting purposes here
                     is_image_only = False
-                elif os.path.isfile(full_item_path_abs):
+                elif entry.is_file():
                     item_type = get_file_type(item_name_orig)
-                    item_size = stat_info.st_size
                     if item_type != 'image': is_image_only = False
                 else:
-                     # logger.debug(f"Skipping non-file/non-dir item: {item_name_orig}")
-                     continue # Skip non-file/non-dir
+                    continue # Skip non-file/non-dir
+                stat_info = entry.stat()
+                item_mtime = stat_info.st_mtime
+                if item_type != 'folder': item_size = stat_info.st_size
             except OSError as e: logger.error(f"OS error accessing item '{full_item_path_abs}': {e}"); continue
 
-            # Generate ID using the FULL RELATIVE path
-            item_id = generate_item_id(item_full_relative_path)
-
-            items.append({
-                'type': item_type,
-                'display_name': display_name,
-                'id': item_id,
-                'path': item_full_relative_path, # Store the full relative path
-                'encoded_path': quote(item_full_relative_path), # URL-encoded full relative path
-                'size': item_size,
-                'mtime': item_mtime, # Store modification time
-                'is_problematic': is_problematic,
-            })
-
-    except OSError as e: logger.error(f"OSError listing directory '{target_dir_abs}': {e}", exc_info=True); return [], False
-    except Exception as e: logger.error(f"Unexpected error scanning directory '{target_dir_abs}': {e}", exc_info=True); return [], False
-
-    # --- Dynamic Sorting ---
-    reverse_order = (sort_order == 'desc')
-
-    def sort_key_func(item):
-        # Primary sort key based on request
-        primary_key = None
-        if sort_by == 'type':
-            type_order = {'folder': 0, 'video': 1, 'audio': 2, 'image': 3, 'text': 4, 'other': 5}.get(item['type'], 99)
-            primary_key = type_order
-        elif sort_by == 'size':
-             primary_key = item['size'] # Let folders sort with size 0 initially
-        elif sort_by == 'date':
-            primary_key = item['mtime'] # Use timestamp
-        # Default or fallback to name sort
-        else: # sort_by == 'name'
-             name = item['display_name']
-             name_lower = str(name).lower()
-             match = re.match(r'(\d+)', name_lower)
-             num_prefix = int(match.group(1)) if match else float('inf')
-             primary_key = (num_prefix, name_lower) # Tuple for natural sort
-
-        # Secondary sort key is always name (for stable sort within categories)
-        name_secondary = item['display_name']
-        name_lower_secondary = str(name_secondary).lower()
-        match_secondary = re.match(r'(\d+)', name_lower_secondary)
-        num_prefix_secondary = int(match_secondary.group(1)) if match_secondary else float('inf')
-        secondary_key = (num_prefix_secondary, name_lower_secondary)
-
-        # Folder Prioritization: 0 for folders, 1 for files
-        folder_priority = 0 if item['type'] == 'folder' else 1
-
-        # Return tuple: (Folder priority, Then by primary key, Then by name)
-        return (folder_priority, primary_key, secondary_key)
-
-    try:
-        # Sort using the key function.
-        items.sort(key=sort_key_func, reverse=reverse_order)
-        # The key function now handles folder priority directly.
-        # No special post-sort needed unless specific reverse size/date order required putting files first.
-    except Exception as e:
-        # Use the original path argument from the function scope for the error message
-        logger.error(f"Sorting error in directory '{current_relative_path or ''}': {e}", exc_info=True)
-
+            items.append(_make_item(clean_current_path, item_name_orig, item_type, item_size, item_mtime))
 
     if not items: is_image_only = False
-    # logger.debug(f"Listed {len(items)} items in '{clean_current_path}'. Image only: {is_image_only}")
     return items, is_image_only
 
+def _index_entries(items):
+    """Listing items as library index rows: (name, id, type, size, mtime)."""
+    return [(item['path'].rsplit('/', 1)[-1], item['id'], item['type'], item['size'], item['mtime']) for item in items]
 
-# --- Helper to find original path by ID ---
-def find_path_by_id(parent_relative_path, item_id):
-    """Finds the full original relative path of an item given its ID and parent's relative path."""
-    # Clean parent path robustly
-    clean_parent_path = str(parent_relative_path or "").strip('/\\').replace("\\", "/")
-    if clean_parent_path == ".": clean_parent_path = ""
-
-    target_dir_abs = get_safe_fullpath(clean_parent_path)
-    if target_dir_abs is None or not os.path.isdir(target_dir_abs):
-        logger.warning(f"find_path_by_id: Invalid parent directory '{clean_parent_path}' (original: '{parent_relative_path}')")
-        return None
+def _stale_files(target_dir_abs, items):
+    """
+    (name, size, mtime) of the file items whose size or mtime no longer match the disk, or None if one is gone.
+    Editing a file in place doesn't change its directory's mtime, so the signature alone can't catch it.
+    """
+    changes = []
+    for item in items:
+        if item['type'] == 'folder': continue
+        name = item['path'].rsplit('/', 1)[-1]
+        try: st = os.stat(os.path.join(target_dir_abs, name))
+        except OSError: return None
+        if (st.st_size, st.st_mtime) != (item['size'], item['mtime']): changes.append((name, st.st_size, st.st_mtime))
+    return changes
+
+def _read_directory(clean_current_path, target_dir_abs, dir_stat):
+    """
+    Returns (items, is_image_only) for a directory: from the library index while its stored signature
+    matches (file sizes and mtimes re-stat'd, and corrected in the index), otherwise from a disk scan
+    that is then recorded in the index for every other worker.
+    """
+    signature = _dir_signature(dir_stat)
+    if config.LIBRARY_INDEX_ENABLED:
+        stored = library_index.load_directory(clean_current_path, signature)
+        if stored is not None:
+            entries, is_image_only = stored
+            items = [_make_item(clean_current_path, name, item_type, size, mtime, item_id) for name, item_id, item_type, size, mtime in entries]
+            changes = _stale_files(target_dir_abs, items)
+            if changes is not None: # Else an entry vanished: fall back to a scan
+                if changes:
+                    updated = {name: (size, mtime) for name, size, mtime in changes}
+                    for item in items:
+                        name = item['path'].rsplit('/', 1)[-1]
+                        if item['type'] != 'folder' and name in updated: item['size'], item['mtime'] = updated[name]
+                    library_index.update_files(clean_current_path, changes)
+                return items, is_image_only
+    logger.debug(f"Scanning directory: '{clean_current_path}' (Absolute: '{target_dir_abs}')")
+    items, is_image_only = _scan_directory(clean_current_path, target_dir_abs)
+    # Same mtime granularity caveat as the listing cache: a directory that may still be changing is
+    # recorded (so search sees it) but not trusted, so it's re-read next time.
+    if config.LIBRARY_INDEX_ENABLED:
+        settled = time.time() - dir_stat.st_mtime > config.LISTING_CACHE_MTIME_GRACE
+        library_index.store_directory(clean_current_path, signature, _index_entries(items), is_image_only, trusted=settled)
+    return items, is_image_only
 
-    # logger.debug(f"find_path_by_id: Searching for ID '{item_id}' in parent '{clean_parent_path}' (Abs: '{target_dir_abs}')")
+def get_directory_listing(current_relative_path="", force_rescan=False):
+    """
+    Returns the (cached) DirectoryListing for a relative directory path, or None if invalid.
+    A cache hit costs one stat() of the directory itself (plus one per file every LISTING_CACHE_REVALIDATE_INTERVAL);
+    a miss is served from the library index when it is current, else from disk. force_rescan bypasses the memory cache.
+    """
+    clean_current_path = _clean_relative_dir(current_relative_path)
+    target_dir_abs = get_safe_fullpath(clean_current_path)
+    if target_dir_abs is None: return None
     try:
-        for item_name_orig in os.listdir(target_dir_abs):
-            if item_name_orig.startswith('.'): continue
-
-            # Construct the item's full relative path from base
-            item_full_relative_path = os.path.join(clean_parent_path, item_name_orig).replace("\\", "/")
+        dir_stat = os.stat(target_dir_abs)
+    except OSError: return None
+    if not stat.S_ISDIR(dir_stat.st_mode): return None
+
+    signature = _dir_signature(dir_stat)
+    listing = None if force_rescan else _listing_cache.get(target_dir_abs, signature)
+    if listing is not None:
+        if time.time() - listing.validated_at < config.LISTING_CACHE_REVALIDATE_INTERVAL: return listing
+        if _stale_files(target_dir_abs, listing.items) == []: listing.validated_at = time.time(); return listing
+        # A file was edited in place (or vanished): rebuild the listing below
+
+    items, is_image_only = _read_directory(clean_current_path, target_dir_abs, dir_stat)
+    listing = DirectoryListing(clean_current_path, signature, items, is_image_only)
+    # A directory modified within the mtime granularity window may change again without its mtime
+    # moving, so such listings are served once but not cached.
+    if time.time() - dir_stat.st_mtime > config.LISTING_CACHE_MTIME_GRACE:
+        _listing_cache.put(target_dir_abs, listing)
+    return listing
+
+def invalidate_directory_cache(relative_path="", recursive=False):
+    """
+    Forgets cached listings for a directory (and optionally its subtree) after the app modifies it,
+    and re-reads it right away so the library index (and search) reflect the change.
+    """
+    clean_path = _clean_relative_dir(relative_path)
+    target_dir_abs = get_safe_fullpath(clean_path)
+    if not target_dir_abs: return
+    _listing_cache.invalidate(target_dir_abs, recursive=recursive)
+    if not config.LIBRARY_INDEX_ENABLED: return
+    try:
+        if get_directory_listing(clean_path) is None: library_index.remove_tree(clean_path) # Deleted directory
+    except Exception as e: logger.error(f"Could not re-index '{clean_path}': {e}", exc_info=True)
 
-            current_id = generate_item_id(item_full_relative_path)
-            # logger.debug(f"find_path_by_id: Checking '{item_name_orig}' -> path '{item_full_relative_path}' -> ID '{current_id}'")
+def get_listing_cache_stats():
+    """Returns hit/miss/eviction counters and current size of the listing cache."""
+    return _listing_cache.stats()
 
-            if current_id == item_id:
-                logger.info(f"find_path_by_id: Match found for ID '{item_id}': Path='{item_full_relative_path}'")
-                # Final safety check on the found path itself
-                if get_safe_fullpath(item_full_relative_path):
-                    return item_full_relative_path
-                else:
-                    logger.error(f"find_path_by_id: Found path '{item_full_relative_path}' for ID '{item_id}' but it failed safety check.")
-                    return None # Path found but unsafe
-    except OSError as e: logger.error(f"find_path_by_id: OSError listing '{target_dir_abs}' for ID '{item_id}': {e}")
-    except Exception as e: logger.error(f"find_path_by_id: Error searching for ID '{item_id}' in '{clean_parent_path}': {e}", exc_info=True)
+# --- Background Library Indexer ---
+_indexer_lock = threading.Lock()
+_indexer_pid = None # PID that started the indexer thread (threads don't survive a fork)
 
-    logger.warning(f"Could not find item ID '{item_id}' in directory '{clean_parent_path}'")
-    return None
+def refresh_library_index():
+    """
+    Walks MEDIA_DIR_BASE and brings the library index up to date. A directory whose signature is
+    unchanged costs one indexed query and a stat() per entry (catching files edited in place);
+    only changed directories are rescanned.
+    """
+    start_time = time.time(); scanned = unchanged = 0
+    pending = ['']
+    while pending:
+        relative_path = pending.pop()
+        target_dir_abs = get_safe_fullpath(relative_path)
+        try:
+            dir_stat = os.stat(target_dir_abs) if target_dir_abs else None
+        except OSError: dir_stat = None
+        if dir_stat is None or not stat.S_ISDIR(dir_stat.st_mode):
+            library_index.remove_tree(relative_path); continue
+        if library_index.directory_signature(relative_path) == _dir_signature(dir_stat): unchanged += 1
+        else: scanned += 1
+        try: items, _ = _read_directory(relative_path, target_dir_abs, dir_stat) # Index rows (re-stat'd) when unchanged
+        except Exception as e: logger.warning(f"Library indexer could not scan '{relative_path}': {e}"); continue
+        subfolders = [item['path'].rsplit('/', 1)[-1] for item in items if item['type'] == 'folder']
+        pending.extend(f"{relative_path}/{name}" if relative_path else name for name in subfolders)
+    logger.info(f"Library index refreshed in {time.time() - start_time:.1f}s: {scanned} dir(s) rescanned, {unchanged} unchanged. {library_index.stats()}")
+
+def _library_indexer_loop():
+    while True:
+        try:
+            with library_index.indexer_lock() as acquired:
+                if acquired: refresh_library_index() # Another worker holding the lock is already doing it
+        except Exception as e: logger.error(f"Library indexer error: {e}", exc_info=True)
+        time.sleep(config.LIBRARY_INDEX_RESCAN_INTERVAL)
+
+def start_library_indexer():
+    """Starts the background indexer thread once per process. Cheap to call on every request."""
+    global _indexer_pid
+    if not config.LIBRARY_INDEX_ENABLED or _indexer_pid == os.getpid(): return
+    with _indexer_lock:
+        if _indexer_pid == os.getpid(): return
+        threading.Thread(target=_library_indexer_loop, name='library-indexer', daemon=True).start()
+        _indexer_pid = os.getpid()
+        logger.info(f"Library indexer started (pid {_indexer_pid}). Index: {config.LIBRARY_INDEX_PATH}")
+
+# --- Library Search ---
+def search_library(query, item_type=None, offset=0, limit=50):
+    """
+    Filename/path search over the library index. Returns (hits, total); hits are item-like dicts
+    with the parent path needed to build URLs. total is capped at config.SEARCH_MAX_HITS.
+    """
+    if not config.LIBRARY_INDEX_ENABLED: return [], 0
+    rows, total = library_index.search(query, item_type=item_type, offset=offset, limit=limit, max_hits=config.SEARCH_MAX_HITS)
+    hits = [{
+        'type': hit_type,
+        'display_name': path.rsplit('/', 1)[-1],
+        'id': item_id,
+        'path': path,
+        'parent': parent,
+        'size': size,
+        'mtime': mtime,
+    } for path, parent, item_id, hit_type, size, mtime in rows]
+    return hits, total
+
+# --- Sorting ---
+_SORT_FIELDS = ('name', 'type', 'size', 'date')
+_TYPE_SORT_ORDER = {'folder': 0, 'video': 1, 'audio': 2, 'image': 3, 'text': 4, 'other': 5}
+
+_NATURAL_SPLIT_RE = re.compile(r'(\d+)')
+
+def natural_sort_key(name):
+    """
+    Case-insensitive natural sort key: every digit run compares numerically ('ep2' < 'ep10', 'v1.9' < 'v1.10').
+    Text and number chunks alternate at fixed positions, so keys of any two names are comparable.
+    The raw name breaks ties ('01' vs '1', 'a' vs 'A') so keys are unique within a directory.
+    """
+    name = str(name)
+    parts = _NATURAL_SPLIT_RE.split(name.casefold())
+    parts[1::2] = [(int(digits), len(digits)) for digits in parts[1::2]]
+    return (tuple(parts), name)
+
+def _item_sort_key(item, name_key, sort_by):
+    """(Folder priority, then by primary key, then by name) for one item."""
+    if sort_by == 'type': primary_key = _TYPE_SORT_ORDER.get(item['type'], 99)
+    elif sort_by == 'size': primary_key = item['size'] # Let folders sort with size 0 initially
+    elif sort_by == 'date': primary_key = item['mtime'] # Use timestamp
+    else: primary_key = () # Default or fallback to name sort
+    folder_priority = 0 if item['type'] == 'folder' else 1
+    return (folder_priority, primary_key, name_key)
+
+def _load_listing(current_relative_path):
+    try:
+        listing = get_directory_listing(current_relative_path)
+    except OSError as e: logger.error(f"OSError listing directory '{current_relative_path}': {e}", exc_info=True); return None
+    except Exception as e: logger.error(f"Unexpected error scanning directory '{current_relative_path}': {e}", exc_info=True); return None
+    if listing is None:
+        logger.error(f"Cannot list contents: Invalid or non-existent directory. Relative='{current_relative_path}'")
+    else: _attach_metadata(listing)
+    return listing
+
+def _attach_metadata(listing):
+    """
+    Adds cached media metadata ('meta') to the listing's audio/video items: one indexed query, repeated at most every
+    METADATA_RECHECK_INTERVAL seconds while some files are still being read in the background. Never probes.
+    """
+    if not config.METADATA_ENABLED or listing.metadata_checked_at is None: return
+    now = time.time()
+    if now - listing.metadata_checked_at < config.METADATA_RECHECK_INTERVAL: return
+    listing.metadata_checked_at = now
+    if not metadata.annotate([item for item in listing.items if item['type'] in ('video', 'audio') and 'meta' not in item]): listing.metadata_checked_at = None
 
-# --- Quality Options Helper ---
-def get_quality_options(item_full_relative_path):
-    """Finds alternative quality versions using the item's full relative path."""
-    # ... (Keep existing implementation - it uses the full relative path correctly) ...
-    options = []; logger.debug(f"Getting quality options for: {item_full_relative_path!r}")
-    try: dir_part_relative = os.path.dirname(item_full_relative_path).replace("\\","/"); filename = os.path.basename(item_full_relative_path); base_name, ext = os.path.splitext(filename); ext_lower = ext.lower()
-    except Exception as e: logger.error(f"Error parsing path for quality options '{item_full_relative_path}': {e}"); return []
-    original_file_abs = get_safe_fullpath(item_full_relative_path)
-    if not original_file_abs or not os.path.isfile(original_file_abs): logger.warning(f"Original file invalid for quality check: {item_full_relative_path}"); return []
-    options.append({'label': 'Original', 'path': item_full_relative_path, 'id': generate_item_id(item_full_relative_path)})
-    full_dir_path_abs = get_safe_fullpath(dir_part_relative)
-    if full_dir_path_abs is None or not os.path.isdir(full_dir_path_abs): logger.warning(f"Parent directory invalid for quality check: {dir_part_relative}"); return options
+# --- Content Listing Helper ---
+def get_folder_contents_with_ids(current_relative_path="", sort_by='name', sort_order='asc'):
+    """
+    Lists contents of a directory specified by its relative path from base.
+    Assigns types and IDs. Includes all non-hidden files.
+    Sorts results based on sort_by and sort_order.
+    """
+    listing = _load_listing(current_relative_path)
+    if listing is None: return [], False # Return empty list and 'is_image_only' as False
     try:
-        for item_name_scan in os.listdir(full_dir_path_abs):
-            if item_name_scan.startswith('.'): continue
-            variant_full_relative_path = os.path.join(dir_part_relative, item_name_scan).replace("\\", "/")
-            if variant_full_relative_path == item_full_relative_path: continue
-            variant_abs_path = safe_join(full_dir_path_abs, item_name_scan)
-            if not variant_abs_path or not os.path.isfile(variant_abs_path): continue
-            item_base, item_ext = os.path.splitext(item_name_scan)
-            if item_ext.lower() == ext_lower and item_base.startswith(base_name):
-                suffix = item_base[len(base_name):]
-                if suffix in config.QUALITY_SUFFIXES:
-                    if get_safe_fullpath(variant_full_relative_path): options.append({'label': config.QUALITY_SUFFIXES[suffix], 'path': variant_full_relative_path, 'id': generate_item_id(variant_full_relative_path)})
-                    else: logger.warning(f"Skipping unsafe quality option path: {variant_full_relative_path}")
-    except OSError as e: logger.error(f"Error scanning dir for quality opts '{full_dir_path_abs}': {e}")
-    except Exception as e: logger.error(f"Unexpected error finding quality opts: {e}", exc_info=True)
-    def sort_key_q(opt): label=opt['label']; return 9999 if label=='Original' else int(m.group(1)) if (m:=re.match(r'(\d+)p',label)) else 10000
-    try: options.sort(key=sort_key_q, reverse=True)
-    except Exception as e: logger.error(f"Quality options sort error: {e}")
-    seen_paths=set(); unique_options=[opt for opt in options if opt['path'] not in seen_paths and not seen_paths.add(opt['path'])]
-    logger.debug(f"Found {len(unique_options)} quality options for {item_full_relative_path}")
-    return unique_options
-
-
-# --- Prev/Next ID Helper ---
-def find_prev_next_ids(current_item_full_relative_path, item_type_filter=None):
+        items = [listing.items[i] for i in listing.sorted_order(sort_by, sort_order)]
+    except Exception as e:
+        # Use the original path argument from the function scope for the error message
+        logger.error(f"Sorting error in directory '{current_relative_path or ''}': {e}", exc_info=True)
+        items = list(listing.items)
+    return items, listing.is_image_only
+
+def get_folder_page(current_relative_path="", sort_by='name', sort_order='asc', offset=0, limit=100):
     """
-    Finds the previous and next item IDs using the current item's full relative path.
-    Can filter by specific item type. Ensures folder priority in sibling list.
+    Returns (page_items, total_items, is_image_only, listing) for one page of a directory.
+    Pages are slices of the listing's memoized sort order, so paging or flipping asc/desc never re-sorts.
+    listing is None if the directory is invalid.
     """
-    prev_id, next_id = None, None
-    # logger.debug(f"find_prev_next_ids: called for '{current_item_full_relative_path}', filter='{item_type_filter}'")
+    listing = _load_listing(current_relative_path)
+    if listing is None: return [], 0, False, None
+    offset = max(0, offset)
     try:
-        # Derive parent's relative path from the current item's path
-        parent_relative_path = os.path.dirname(current_item_full_relative_path).replace("\\", "/")
-        if parent_relative_path == ".": parent_relative_path = ""
-        # logger.debug(f"find_prev_next_ids: Derived parent path: '{parent_relative_path}'")
+        indices = listing.sorted_order(sort_by, sort_order)
+    except Exception as e:
+        logger.error(f"Sorting error in directory '{current_relative_path or ''}': {e}", exc_info=True)
+        indices = range(len(listing.items))
+    page_items = [listing.items[i] for i in indices[offset:offset + limit]]
+    return page_items, len(listing.items), listing.is_image_only, listing
 
-        # Get siblings, SORTED with folders first by default name sort
-        all_items, _ = get_folder_contents_with_ids(parent_relative_path, sort_by='name', sort_order='asc') # Use default sort here
+def walk_folder(current_relative_path="", recursive=True):
+    """
+    Yields (relative_path, items) for a folder and, if recursive, every folder below it: depth first, in name
+    order, from the listing cache / library index. Each directory is visited once, so symlink loops end.
+    """
+    pending = [current_relative_path]; visited = set()
+    while pending:
+        folder = pending.pop()
+        folder_abs = get_safe_fullpath(folder)
+        try: folder_stat = os.stat(folder_abs) if folder_abs else None
+        except OSError: folder_stat = None
+        if folder_stat is None or (folder_stat.st_dev, folder_stat.st_ino) in visited: continue # Gone, or a symlink loop
+        visited.add((folder_stat.st_dev, folder_stat.st_ino))
+        items, _ = get_folder_contents_with_ids(folder)
+        yield folder, items
+        if recursive: pending.extend(item['path'] for item in reversed(items) if item['type'] == 'folder')
 
-        # Filter items by the desired type if a filter is provided
-        relevant_items = [item for item in all_items if item_type_filter is None or item['type'] == item_type_filter]
-        if not relevant_items: logger.debug("find_prev_next_ids: No relevant items found."); return None, None
 
-        current_id = generate_item_id(current_item_full_relative_path)
-        current_index = -1
-        for i, item in enumerate(relevant_items):
-            if item['id'] == current_id:
-                current_index = i; logger.debug(f"find_prev_next_ids: Found current item at index {i}"); break
+# --- Helper to find original path by ID ---
+def find_item_by_id(parent_relative_path, item_id):
+    """
+    Returns the listing item dict for an ID within a parent directory, or None.
+    Uses the parent listing's ID index: one stat of the parent plus a dict probe. An ID missing
+    from a cached listing triggers a single rescan in case the directory changed within its mtime tick.
+    """
+    clean_parent_path = _clean_relative_dir(parent_relative_path)
+    try:
+        listing = get_directory_listing(clean_parent_path)
+        if listing is None:
+            logger.warning(f"find_path_by_id: Invalid parent directory '{clean_parent_path}' (original: '{parent_relative_path}')")
+            return None
+        item = listing.id_index.get(item_id)
+        if item is None and time.time() - listing.scanned_at > config.LISTING_CACHE_MTIME_GRACE:
+            # Revalidate on a miss; rate-limited by scan age so bogus IDs can't force a rescan per request
+            listing = get_directory_listing(clean_parent_path, force_rescan=True)
+            item = listing.id_index.get(item_id) if listing is not None else None
+    except OSError as e: logger.error(f"find_path_by_id: OSError listing '{clean_parent_path}' for ID '{item_id}': {e}"); return None
+    except Exception as e: logger.error(f"find_path_by_id: Error searching for ID '{item_id}' in '{clean_parent_path}': {e}", exc_info=True); return None
+
+    if item is None:
+        logger.warning(f"Could not find item ID '{item_id}' in directory '{clean_parent_path}'")
+        return None
+    # Final safety check on the found path itself
+    if not get_safe_fullpath(item['path']):
+        logger.error(f"find_path_by_id: Found path '{item['path']}' for ID '{item_id}' but it failed safety check.")
+        return None
+    return item
 
-        if current_index != -1:
-            if current_index > 0: prev_id = relevant_items[current_index - 1]['id']
-            if current_index < len(relevant_items) - 1: next_id = relevant_items[current_index + 1]['id']
-        else: logger.warning(f"find_prev_next_ids: Current item ID '{current_id}' (path '{current_item_full_relative_path}') not found among relevant siblings in parent '{parent_relative_path}'.")
+def find_path_by_id(parent_relative_path, item_id):
+    """Finds the full original relative path of an item given its ID and parent's relative path."""
+    item = find_item_by_id(parent_relative_path, item_id)
+    return item['path'] if item else None
+
+# --- Player Page Helpers (quality options, prev/next) ---
+def _quality_label_rank(label):
+    """Sort rank of a quality label: '1080p' -> 1080; non-resolution labels rank highest."""
+    match = re.match(r'(\d+)p', label)
+    return int(match.group(1)) if match else 10000
+
+def _media_lookup(item_full_relative_path):
+    """(MediaGroupIndex, item) for a file via its parent's cached listing, or (None, None)."""
+    parent_relative_path = os.path.dirname(item_full_relative_path).replace("\\", "/")
+    try: listing = get_directory_listing(parent_relative_path)
+    except OSError as e: logger.error(f"Error listing parent of '{item_full_relative_path}': {e}"); return None, None
+    item = listing.id_index.get(generate_item_id(item_full_relative_path)) if listing is not None else None
+    if item is None: return None, None
+    return listing.media_groups(), item
 
-    except Exception as e: logger.error(f"Error finding prev/next IDs for '{current_item_full_relative_path}': {e}", exc_info=True)
+def get_quality_options(item_full_relative_path):
+    """Finds alternative quality versions using the item's full relative path. O(1) once its listing's media groups exist."""
+    try:
+        groups, item = _media_lookup(item_full_relative_path)
+        if item is None: logger.warning(f"Original file invalid for quality check: {item_full_relative_path}"); return []
+        options = groups.quality_options(item)
+    except Exception as e: logger.error(f"Unexpected error finding quality opts for '{item_full_relative_path}': {e}", exc_info=True); return []
+    logger.debug(f"Found {len(options)} quality options for {item_full_relative_path}")
+    return options
 
-    # logger.debug(f"Prev/Next for '{current_item_full_relative_path}': Prev ID={prev_id}, Next ID={next_id}")
-    return prev_id, next_id
-
-# --- Text File Reader ---
-def read_text_file_safe(file_path_abs, max_size=1024*1024):
-     """Safely reads the content of a text file, limiting size."""
-     # ... (Keep existing implementation - it uses absolute path already) ...
-     try:
-        base_abs_path = os.path.abspath(config.MEDIA_DIR_BASE)
-        if not file_path_abs or not os.path.isfile(file_path_abs) or not os.path.abspath(file_path_abs).startswith(base_abs_path):
-             logger.warning(f"read_text_file_safe: Invalid path provided: {file_path_abs}")
-             return None, "Error: Invalid file path."
-        size = os.path.getsize(file_path_abs)
-        if size > max_size: return None, f"Error: File too large ({size / (1024*1024):.2f} MB)."
-        encodings_to_try = [config.FILESYSTEM_ENCODING, 'utf-8', 'latin-1']
-        content = None; detected_encoding = None
-        for enc in encodings_to_try:
-            try:
-                with open(file_path_abs, 'r', encoding=enc) as f: content = f.read()
-                detected_encoding = enc; break
-            except UnicodeDecodeError: continue
-            except Exception as e: logger.error(f"Error reading file '{file_path_abs}' with encoding '{enc}': {e}"); return None, f"Error reading file (encoding: {enc})."
-        if content is None: return None, "Error: Could not determine file encoding."
-        return content, None
-     except OSError as e: logger.error(f"OS error reading text file '{file_path_abs}': {e}"); return None, "Error: Could not access file."
-     except Exception as e: logger.error(f"Unexpected error reading text file '{file_path_abs}': {e}", exc_info=True); return None, "Error reading file."
\ No newline at end of file
+def find_prev_next_ids(current_item_full_relative_path, item_type_filter=None):
+    """
+    Finds the previous and next item IDs (default name order) using the current item's full relative path.
+    Can filter by specific item type. O(1) once its listing's media groups exist.
+    """
+    try:
+        groups, item = _media_lookup(current_item_full_relative_path)
+        if item is None:
+            logger.warning(f"find_prev_next_ids: Current item '{current_item_full_relative_path}' not found among its siblings.")
+            return None, None
+        return groups.prev_next(item['id'], item_type_filter)
+    except Exception as e: logger.error(f"Error finding prev/next IDs for '{current_item_full_relative_path}': {e}", exc_info=True)
+    return None, None
@@ -0,0 +1,246 @@
+# hls.py
+import os
+import json
+import math
+import logging
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import config # Use our config file
+
+# fcntl is POSIX-only; without it a segment is only deduplicated within one process (through _pending)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Segments are transcoded lazily: a playlist lists every segment of the video up front (durations come
+# from ffprobe), but a segment is only encoded (with input seeking, so each is independent) when a
+# player asks for it or for one shortly before it. Cache layout: HLS_CACHE_DIR/<source key>/<variant>/<n>.ts
+
+_executor = None
+_pending = {} # segment path -> Future
+_probe_cache = {} # source key -> probe info
+_lock = threading.RLock() # Re-entrant: done callbacks may fire inside submit when a job finishes instantly
+_last_eviction = 0.0
+_EVICTION_INTERVAL = 10.0 # Seconds between cache size checks
+_PROBE_CACHE_MAX = 512 # Probe results kept in memory per worker
+
+
+# --- Availability & Variants ---
+def is_available():
+    """True if HLS is enabled and ffmpeg/ffprobe can be found."""
+    return bool(config.HLS_ENABLED and shutil.which(config.FFMPEG_PATH) and shutil.which(config.FFPROBE_PATH))
+
+def source_key(item_id, stat_result):
+    """Cache key for one version of a source file: changes whenever its mtime or size changes."""
+    return f"{item_id}-{int(stat_result.st_mtime * 1000):x}-{stat_result.st_size:x}"
+
+def get_variant(name):
+    """The configured variant with this name, or None."""
+    return next((v for v in config.HLS_VARIANTS if v['name'] == name), None)
+
+def variants_for(info):
+    """Variants worth offering for a source: none taller than the source itself (but always the smallest)."""
+    variants = sorted(config.HLS_VARIANTS, key=lambda v: v['height'])
+    usable = [v for v in variants if not info.get('height') or v['height'] <= info['height']]
+    return usable or variants[:1]
+
+def segment_count(info):
+    return max(1, math.ceil(info['duration'] / config.HLS_SEGMENT_SECONDS))
+
+def segment_bounds(info, index):
+    """(start, duration) in seconds of segment `index`."""
+    start = index * config.HLS_SEGMENT_SECONDS
+    return start, min(config.HLS_SEGMENT_SECONDS, info['duration'] - start)
+
+
+# --- Probing ---
+def probe(src_abs, key):
+    """
+    Returns {'duration', 'width', 'height'} for a video, or None if it can't be probed.
+    Results are cached in memory and next to the segments, so other workers don't re-run ffprobe.
+    """
+    with _lock:
+        info = _probe_cache.get(key)
+    if info is not None: return info
+    probe_path = os.path.join(config.HLS_CACHE_DIR, key, 'probe.json')
+    try:
+        with open(probe_path, 'r', encoding='utf-8') as f: info = json.load(f)
+    except (OSError, ValueError):
+        info = _run_ffprobe(src_abs)
+        if info is None: return None
+        try:
+            os.makedirs(os.path.dirname(probe_path), exist_ok=True)
+            tmp_path = f"{probe_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(info, f)
+            os.replace(tmp_path, probe_path)
+        except OSError as e: logger.warning(f"Could not cache probe result for '{src_abs}': {e}")
+    with _lock:
+        if len(_probe_cache) >= _PROBE_CACHE_MAX: _probe_cache.pop(next(iter(_probe_cache)))
+        _probe_cache[key] = info
+    return info
+
+def _run_ffprobe(src_abs):
+    cmd = [config.FFPROBE_PATH, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:format=duration',
+           '-of', 'json', src_abs]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=30, check=True)
+        data = json.loads(result.stdout)
+        duration = float(data['format']['duration'])
+        stream = (data.get('streams') or [{}])[0]
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"ffprobe failed for '{src_abs}': {e}"); return None
+    if duration <= 0: return None
+    return {'duration': duration, 'width': int(stream.get('width') or 0), 'height': int(stream.get('height') or 0)}
+
+
+# --- Playlists ---
+def master_playlist(info):
+    """Master playlist text; variant playlists are referenced relatively as '<variant>/index.m3u8'."""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for variant in variants_for(info):
+        bandwidth = _bits_per_second(variant['video_bitrate']) + _bits_per_second(variant['audio_bitrate'])
+        width = round(info['width'] * variant['height'] / info['height'] / 2) * 2 if info.get('width') and info.get('height') else 0
+        resolution = f",RESOLUTION={width}x{variant['height']}" if width else ""
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={int(bandwidth * 1.1)}{resolution},NAME=\"{variant['name']}\"")
+        lines.append(f"{variant['name']}/index.m3u8")
+    return '\n'.join(lines) + '\n'
+
+def media_playlist(info):
+    """VOD media playlist listing every segment ('00000.ts', ...) with its exact duration."""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f"#EXT-X-TARGETDURATION:{math.ceil(config.HLS_SEGMENT_SECONDS)}",
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for index in range(segment_count(info)):
+        _, duration = segment_bounds(info, index)
+        lines.append(f"#EXTINF:{duration:.3f},"); lines.append(f"{index:05d}.ts")
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+def _bits_per_second(bitrate):
+    """'2800k' / '5M' / 96000 -> bits per second."""
+    text = str(bitrate).strip().lower()
+    multiplier = {'k': 1000, 'm': 1000 * 1000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * multiplier)
+
+
+# --- Segment Generation ---
+def _segment_path(key, variant_name, index):
+    return os.path.join(config.HLS_CACHE_DIR, key, variant_name, f"{index:05d}.ts")
+
+def _render_segment(src_abs, dest_abs, start, duration, variant):
+    """Encodes one segment with ffmpeg. A per-segment flock (where available) keeps other workers from encoding it twice."""
+    os.makedirs(os.path.dirname(dest_abs), exist_ok=True)
+    with open(f"{dest_abs}.lock", 'a') as lock_file:
+        if fcntl is not None: fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(dest_abs): return dest_abs # Another worker finished it while we waited
+            tmp_path = f"{dest_abs}.{os.getpid()}.tmp"
+            cmd = [config.FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+                   '-ss', f"{start:.3f}", '-i', src_abs, '-t', f"{duration:.3f}",
+                   '-map', '0:v:0', '-map', '0:a:0?', '-sn', '-dn',
+                   '-vf', f"scale=-2:{variant['height']}", '-pix_fmt', 'yuv420p',
+                   '-c:v', config.HLS_VIDEO_ENCODER, '-b:v', str(variant['video_bitrate']),
+                   '-maxrate', str(variant['video_bitrate']), '-bufsize', f"{2 * _bits_per_second(variant['video_bitrate'])}"]
+            if config.HLS_VIDEO_ENCODER == 'libx264': cmd += ['-preset', config.HLS_X264_PRESET, '-profile:v', 'main']
+            cmd += ['-c:a', 'aac', '-b:a', str(variant['audio_bitrate']), '-ac', '2',
+                    '-output_ts_offset', f"{start:.3f}", '-muxdelay', '0', '-f', 'mpegts', tmp_path]
+            started = time.time()
+            try:
+                subprocess.run(cmd, capture_output=True, timeout=config.HLS_SEGMENT_TIMEOUT * 2, check=True)
+                os.replace(tmp_path, dest_abs)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"ffmpeg exited with {e.returncode}: {e.stderr.decode('utf-8', 'replace').strip()[-500:]}") from None
+            finally:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+            logger.debug(f"HLS segment {dest_abs} ({duration:.1f}s) encoded in {time.time() - started:.1f}s")
+        finally:
+            if fcntl is not None: fcntl.flock(lock_file, fcntl.LOCK_UN)
+    try: os.remove(f"{dest_abs}.lock")
+    except OSError: pass
+    _evict_if_needed()
+    return dest_abs
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=config.HLS_MAX_TRANSCODES, thread_name_prefix='hls')
+        logger.info(f"HLS transcoder started with {config.HLS_MAX_TRANSCODES} concurrent ffmpeg job(s). Cache: {config.HLS_CACHE_DIR}")
+    return _executor
+
+def _schedule(src_abs, key, info, variant, index):
+    """Queues a segment unless it is cached or already queued. Returns its Future, or None if cached."""
+    dest_abs = _segment_path(key, variant['name'], index)
+    if os.path.isfile(dest_abs): return None
+    with _lock:
+        future = _pending.get(dest_abs)
+        if future is None:
+            start, duration = segment_bounds(info, index)
+            future = _get_executor().submit(_render_segment, src_abs, dest_abs, start, duration, variant)
+            _pending[dest_abs] = future
+            future.add_done_callback(lambda f, path=dest_abs: _on_done(path, f))
+    return future
+
+def _on_done(dest_abs, future):
+    with _lock:
+        _pending.pop(dest_abs, None)
+    error = future.exception()
+    if error is not None: logger.error(f"HLS segment generation failed for '{dest_abs}': {error}")
+
+def get_segment(src_abs, key, info, variant, index):
+    """
+    Returns the path of a cached segment, encoding it first if needed (and queueing the next
+    HLS_PREFETCH_SEGMENTS behind it). Raises TimeoutError if it isn't ready within HLS_SEGMENT_TIMEOUT,
+    RuntimeError if ffmpeg failed.
+    """
+    future = _schedule(src_abs, key, info, variant, index)
+    for ahead in range(index + 1, min(index + 1 + config.HLS_PREFETCH_SEGMENTS, segment_count(info))):
+        _schedule(src_abs, key, info, variant, ahead)
+    dest_abs = _segment_path(key, variant['name'], index)
+    if future is None: return dest_abs
+    try: future.result(timeout=config.HLS_SEGMENT_TIMEOUT)
+    except FutureTimeoutError: raise TimeoutError(f"Segment {index} of '{src_abs}' not ready after {config.HLS_SEGMENT_TIMEOUT}s") from None
+    return dest_abs
+
+def touch(path):
+    """Marks a cached file as recently used (eviction is least-recently-used by mtime)."""
+    try: os.utime(path)
+    except OSError: pass
+
+
+# --- Cache Eviction ---
+def _evict_if_needed():
+    """Deletes least recently used segments until the cache is under HLS_CACHE_MAX_BYTES (checked at most every few seconds)."""
+    global _last_eviction
+    with _lock:
+        if time.time() - _last_eviction < _EVICTION_INTERVAL: return
+        _last_eviction = time.time()
+    files, total_bytes = [], 0
+    for dir_path, _, file_names in os.walk(config.HLS_CACHE_DIR):
+        for file_name in file_names:
+            if not file_name.endswith('.ts'): continue
+            path = os.path.join(dir_path, file_name)
+            try: st = os.stat(path)
+            except OSError: continue
+            files.append((st.st_mtime, st.st_size, path)); total_bytes += st.st_size
+    if total_bytes <= config.HLS_CACHE_MAX_BYTES: return
+    target_bytes = config.HLS_CACHE_MAX_BYTES * 0.9 # Some headroom so we don't evict on every segment
+    removed = 0
+    for _, size, path in sorted(files):
+        if total_bytes <= target_bytes: break
+        try: os.remove(path); total_bytes -= size; removed += 1
+        except OSError: continue
+        # Drop version directories that are now empty (probe.json alone doesn't keep them)
+        variant_dir = os.path.dirname(path)
+        try: os.rmdir(variant_dir)
+        except OSError: continue
+        key_dir = os.path.dirname(variant_dir)
+        if not any(os.path.isdir(os.path.join(key_dir, d)) for d in os.listdir(key_dir)): shutil.rmtree(key_dir, ignore_errors=True)
+    logger.info(f"HLS cache over limit: evicted {removed} segment(s), {total_bytes / (1024 * 1024):.0f} MB remain.")
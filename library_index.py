@@ -0,0 +1,245 @@
+# library_index.py
+import os
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import config # Use our config file
+
+# fcntl is POSIX-only; on Windows the indexer is only serialized within one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Paths and names are stored as filesystem bytes (surrogateescape), so undecodable names survive the round trip.
+# A directory's rows are only trusted while its (dev, inode, mtime_ns) signature matches the one stored with them.
+# items_search is an FTS5 trigram index over each item's relative path, kept in sync with items by triggers.
+_SCHEMA_VERSION = 2 # Bump on any schema change: the index is a cache and is rebuilt from disk
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS dirs (
+        path BLOB PRIMARY KEY, dev INTEGER NOT NULL, ino INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+        is_image_only INTEGER NOT NULL, scanned_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS items (
+        rowid INTEGER PRIMARY KEY, parent BLOB NOT NULL, name BLOB NOT NULL, id TEXT NOT NULL, type TEXT NOT NULL,
+        size INTEGER NOT NULL, mtime REAL NOT NULL, path TEXT NOT NULL, UNIQUE (parent, name)
+    )""",
+    "CREATE INDEX IF NOT EXISTS items_by_id ON items (id)",
+)
+_SEARCH_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_search USING fts5(path, content='items', content_rowid='rowid', tokenize='trigram')",
+    """CREATE TRIGGER IF NOT EXISTS items_search_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_search (rowid, path) VALUES (new.rowid, new.path);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_search_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_search (items_search, rowid, path) VALUES ('delete', old.rowid, old.path);
+    END""",
+)
+_OLD_OBJECTS = (('TRIGGER', 'items_search_insert'), ('TRIGGER', 'items_search_delete'), ('TABLE', 'items_search'), ('TABLE', 'items'), ('TABLE', 'dirs'))
+UNTRUSTED_MTIME_NS = -1 # Stored instead of the real mtime for directories that may still be changing
+
+_local = threading.local() # Per-thread connection (sqlite3 connections must not cross threads)
+_local_indexer_lock = threading.Lock() # Stands in for the flock where fcntl is unavailable
+
+
+# --- Connection Handling ---
+def _to_blob(text):
+    return text.encode(config.FILESYSTEM_ENCODING, 'surrogateescape')
+
+def _from_blob(blob):
+    return bytes(blob).decode(config.FILESYSTEM_ENCODING, 'surrogateescape')
+
+def _display_text(text):
+    """Searchable text for a path (undecodable bytes become U+FFFD)."""
+    return _to_blob(text).decode('utf-8', 'replace')
+
+def _create_schema(conn):
+    """Creates (or, after a schema version change, recreates) the tables. Runs under a write lock."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            for kind, name in _OLD_OBJECTS: conn.execute(f"DROP {kind} IF EXISTS {name}")
+            for statement in _SCHEMA: conn.execute(statement)
+            try:
+                for statement in _SEARCH_SCHEMA: conn.execute(statement)
+            except sqlite3.OperationalError as e: # FTS5 trigram needs SQLite >= 3.34
+                logger.warning(f"Full-text search index unavailable ({e}); search falls back to a table scan.")
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK"); raise
+
+def _connect():
+    """Returns this thread's connection, reopening it after a fork (gunicorn workers) or first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid(): return conn
+    os.makedirs(os.path.dirname(config.LIBRARY_INDEX_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.LIBRARY_INDEX_PATH, timeout=config.LIBRARY_INDEX_BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL") # Readers in every worker never block the indexer (and vice versa)
+    conn.execute("PRAGMA synchronous=NORMAL") # The index can always be rebuilt from disk
+    _create_schema(conn)
+    _local.conn = conn; _local.pid = os.getpid()
+    _local.has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_search'").fetchone() is not None
+    return conn
+
+def _subtree_clause(relative_path, column):
+    """SQL condition (and params) matching a directory and everything below it."""
+    if not relative_path: return "1", ()
+    prefix = _to_blob(relative_path) + b'/'
+    return f"({column} = ? OR ({column} >= ? AND {column} < ?))", (_to_blob(relative_path), prefix, prefix[:-1] + b'0')
+
+def _delete_tree(conn, relative_path):
+    dir_clause, dir_params = _subtree_clause(relative_path, 'path')
+    item_clause, item_params = _subtree_clause(relative_path, 'parent')
+    conn.execute(f"DELETE FROM dirs WHERE {dir_clause}", dir_params)
+    conn.execute(f"DELETE FROM items WHERE {item_clause}", item_params)
+
+
+# --- Queries ---
+def directory_signature(relative_path):
+    """Stored (dev, inode, mtime_ns) for a directory, or None if it isn't indexed."""
+    try:
+        row = _connect().execute("SELECT dev, ino, mtime_ns FROM dirs WHERE path = ?", (_to_blob(relative_path),)).fetchone()
+    except sqlite3.Error as e: logger.error(f"Library index lookup failed for '{relative_path}': {e}"); return None
+    return tuple(row) if row else None
+
+def load_directory(relative_path, signature):
+    """
+    Returns (entries, is_image_only) for a directory whose stored signature still matches, else None.
+    entries are (name, item_id, type, size, mtime) tuples.
+    """
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT dev, ino, mtime_ns, is_image_only FROM dirs WHERE path = ?", (_to_blob(relative_path),)).fetchone()
+        if row is None or tuple(row[:3]) != tuple(signature): return None
+        rows = conn.execute("SELECT name, id, type, size, mtime FROM items WHERE parent = ?", (_to_blob(relative_path),)).fetchall()
+    except sqlite3.Error as e: logger.error(f"Library index read failed for '{relative_path}': {e}"); return None
+    return [(_from_blob(name), item_id, item_type, size, mtime) for name, item_id, item_type, size, mtime in rows], bool(row[3])
+
+def iter_items_of_type(item_type, batch_size=5000):
+    """Yields (parent, name, size, mtime) for every indexed item of one type, in batches."""
+    last_rowid = 0
+    while True:
+        try:
+            rows = _connect().execute("SELECT rowid, parent, name, size, mtime FROM items WHERE type = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                                      (item_type, last_rowid, batch_size)).fetchall()
+        except sqlite3.Error as e: logger.error(f"Library index read failed for type '{item_type}': {e}"); return
+        if not rows: return
+        for rowid, parent, name, size, mtime in rows: yield _from_blob(parent), _from_blob(name), size, mtime
+        last_rowid = rows[-1][0]
+
+def stats():
+    """Row counts of the index (for logging/diagnostics)."""
+    try:
+        conn = _connect()
+        return {'dirs': conn.execute("SELECT COUNT(*) FROM dirs").fetchone()[0], 'items': conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]}
+    except sqlite3.Error as e: logger.error(f"Library index stats failed: {e}"); return {'dirs': 0, 'items': 0}
+
+
+def _like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search(query, item_type=None, offset=0, limit=50, max_hits=1000):
+    """
+    Case-insensitive substring search over relative paths. Every whitespace-separated term must occur.
+    Terms of 3+ characters use the trigram index; shorter ones only filter its hits (or scan, if alone).
+    Returns (hits, total): hits are (path, parent, item_id, type, size, mtime) ordered by path.
+    At most max_hits matches are considered, so very common terms cost the same as rare ones.
+    """
+    terms = query.split()
+    if not terms: return [], 0
+    try: conn = _connect()
+    except sqlite3.Error as e: logger.error(f"Library index unavailable for search: {e}"); return [], 0
+    indexed_terms = [t for t in terms if len(t) >= 3] if _local.has_fts else []
+    like_terms = [t for t in terms if t not in indexed_terms]
+    where, params = [], []
+    if indexed_terms:
+        from_clause = "items_search JOIN items ON items.rowid = items_search.rowid"
+        where.append("items_search MATCH ?"); params.append(' '.join('"' + t.replace('"', '""') + '"' for t in indexed_terms))
+    else:
+        from_clause = "items"
+    for term in like_terms: where.append("items.path LIKE ? ESCAPE '\\'"); params.append(_like_pattern(term))
+    if item_type: where.append("items.type = ?"); params.append(item_type)
+    # Bounded candidate set (first max_hits matches), then sorted for display
+    candidates_sql = f"SELECT items.rowid FROM {from_clause} WHERE {' AND '.join(where)} LIMIT {int(max_hits)}"
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM ({candidates_sql})", params).fetchone()[0]
+        rows = conn.execute(f"SELECT path, parent, id, type, size, mtime FROM items WHERE rowid IN ({candidates_sql}) "
+                            f"ORDER BY path LIMIT ? OFFSET ?", (*params, max(0, limit), max(0, offset))).fetchall()
+    except sqlite3.Error as e: logger.error(f"Library search failed for {query!r}: {e}"); return [], 0
+    return [(path, _from_blob(parent), item_id, item_type, size, mtime) for path, parent, item_id, item_type, size, mtime in rows], total
+
+# --- Updates ---
+def store_directory(relative_path, signature, entries, is_image_only, trusted=True):
+    """
+    Replaces a directory's rows with a fresh scan (entries as returned by load_directory).
+    Subfolders that disappeared since the last scan are dropped together with their whole subtree.
+    With trusted=False the rows are searchable but the stored signature never matches, so the
+    directory is re-read on its next listing or indexer pass.
+    """
+    if not trusted: signature = (signature[0], signature[1], UNTRUSTED_MTIME_NS)
+    parent = _to_blob(relative_path)
+    new_folders = {name for name, _, item_type, _, _ in entries if item_type == 'folder'}
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for (name,) in conn.execute("SELECT name FROM items WHERE parent = ? AND type = 'folder'", (parent,)).fetchall():
+                name = _from_blob(name)
+                if name not in new_folders: _delete_tree(conn, f"{relative_path}/{name}" if relative_path else name)
+            conn.execute("DELETE FROM items WHERE parent = ?", (parent,))
+            prefix = f"{relative_path}/" if relative_path else ""
+            conn.executemany("INSERT INTO items (parent, name, id, type, size, mtime, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             ((parent, _to_blob(name), item_id, item_type, size, mtime, _display_text(prefix + name))
+                              for name, item_id, item_type, size, mtime in entries))
+            conn.execute("INSERT OR REPLACE INTO dirs (path, dev, ino, mtime_ns, is_image_only, scanned_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (parent, *signature, int(is_image_only), time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK"); raise
+    except sqlite3.Error as e: logger.error(f"Library index write failed for '{relative_path}': {e}"); return False
+    return True
+
+def update_files(relative_path, changes):
+    """Records new (name, size, mtime) for files edited in place (which doesn't move their directory's mtime)."""
+    parent = _to_blob(relative_path)
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE items SET size = ?, mtime = ? WHERE parent = ? AND name = ?",
+                             ((size, mtime, parent, _to_blob(name)) for name, size, mtime in changes))
+            conn.execute("COMMIT")
+        except BaseException: conn.execute("ROLLBACK"); raise
+    except sqlite3.Error as e: logger.error(f"Library index update failed for '{relative_path}': {e}")
+
+def remove_tree(relative_path):
+    """Drops a directory and everything below it from the index."""
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try: _delete_tree(conn, relative_path); conn.execute("COMMIT")
+        except BaseException: conn.execute("ROLLBACK"); raise
+    except sqlite3.Error as e: logger.error(f"Library index delete failed for '{relative_path}': {e}")
+
+@contextmanager
+def indexer_lock():
+    """Non-blocking cross-process lock so only one worker walks the library at a time. Yields True if acquired."""
+    if fcntl is None:
+        if not _local_indexer_lock.acquire(blocking=False): yield False; return
+        try: yield True
+        finally: _local_indexer_lock.release()
+        return
+    os.makedirs(os.path.dirname(config.LIBRARY_INDEX_PATH), exist_ok=True)
+    with open(f"{config.LIBRARY_INDEX_PATH}.lock", 'a') as lock_file:
+        try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: yield False; return
+        try: yield True
+        finally: fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,427 @@
+# metadata.py
+import io
+import os
+import json
+import queue
+import shutil
+import struct
+import logging
+import sqlite3
+import itertools
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import config # Use our config file
+import library_index
+
+# fcntl is POSIX-only; on Windows discovery is only serialized within one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Media metadata (duration, resolution, codecs, sample rate, bitrate), persisted in a SQLite cache shared by all
+# workers. A row is valid only for the size and mtime it was read at, so an edited file is read again. Requests never
+# probe: lookups return what is known and queue the rest for a small pool of background threads, which also work
+# through the whole library index (behind anything a request asked for). MP4/MOV/M4A, Matroska/WebM, MP3 and FLAC
+# are read by header parsers (a few small reads, no subprocess); other files fall back to ffprobe if installed.
+_SCHEMA_VERSION = 2 # Bump on any schema change: the cache is dropped and refilled
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS media (
+        path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, info TEXT, probed_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+)
+_LOOKUP_BATCH = 500 # Paths per SELECT (SQLite parameter limit)
+_PRIORITY_REQUESTED = 0 # Queue order: files someone is looking at first,
+_PRIORITY_DISCOVERED = 1 # then the rest of the library
+
+_local = threading.local()
+_queue = queue.PriorityQueue()
+_queue_order = itertools.count() # FIFO within a priority
+_queued = set() # Paths waiting in _queue (per worker)
+_queued_lock = threading.Lock()
+_workers_lock = threading.Lock()
+_local_discovery_lock = threading.Lock() # Stands in for the flock where fcntl is unavailable
+_workers_pid = None # PID that started the worker threads (threads don't survive a fork)
+
+
+# --- Database ---
+def _to_blob(text):
+    return text.encode(config.FILESYSTEM_ENCODING, 'surrogateescape')
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid(): return conn
+    os.makedirs(os.path.dirname(config.METADATA_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.METADATA_DB_PATH, timeout=config.LIBRARY_INDEX_BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # A lost row is just read again
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS media")
+            for statement in _SCHEMA: conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK"); raise
+    _local.conn = conn; _local.pid = os.getpid()
+    return conn
+
+def _load_rows(paths):
+    """{path: (size, mtime, info or None)} for the stored rows among paths."""
+    rows = {}
+    try:
+        conn = _connect()
+        for i in range(0, len(paths), _LOOKUP_BATCH):
+            batch = [_to_blob(path) for path in paths[i:i + _LOOKUP_BATCH]]
+            for path, size, mtime, info in conn.execute(f"SELECT path, size, mtime, info FROM media WHERE path IN ({','.join('?' * len(batch))})", batch):
+                rows[bytes(path).decode(config.FILESYSTEM_ENCODING, 'surrogateescape')] = (size, mtime, json.loads(info) if info else None)
+    except (sqlite3.Error, ValueError) as e: logger.error(f"Metadata cache read failed: {e}")
+    return rows
+
+def _store(path, size, mtime, info):
+    try:
+        _connect().execute("INSERT OR REPLACE INTO media (path, size, mtime, info, probed_at) VALUES (?, ?, ?, ?, ?)",
+                           (_to_blob(path), size, mtime, json.dumps(info) if info else None, time.time()))
+    except sqlite3.Error as e: logger.error(f"Metadata cache write failed for '{path}': {e}")
+
+
+# --- Lookups ---
+def annotate(items):
+    """
+    Sets item['meta'] (a dict, or None if the file couldn't be read) on listing items ('path', 'size', 'mtime')
+    that have a current cache row. Never probes: the others are queued for the workers. Returns how many are unknown.
+    """
+    if not config.METADATA_ENABLED or not items: return 0
+    rows = _load_rows([item['path'] for item in items]); missing = []
+    for item in items:
+        row = rows.get(item['path'])
+        if row is None or row[:2] != (item['size'], item['mtime']): missing.append(item)
+        else: item['meta'] = row[2]
+    if missing: _request_probe(missing)
+    return len(missing)
+
+def get_durations(items):
+    """Known durations (seconds) of listing items, by path; unknown ones are queued and left out."""
+    annotate([item for item in items if 'meta' not in item])
+    return {item['path']: item['meta']['duration'] for item in items if item.get('meta') and item['meta'].get('duration')}
+
+def _request_probe(items):
+    with _queued_lock:
+        for item in items:
+            if item['path'] in _queued: continue
+            if len(_queued) >= config.METADATA_QUEUE_MAX: logger.debug("Metadata queue full; remaining items wait for a later request."); break
+            _queued.add(item['path']); _queue.put((_PRIORITY_REQUESTED, next(_queue_order), item['path'], item['size'], item['mtime']))
+
+
+# --- Header Parsers ---
+_CODEC_NAMES = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1', 'vp09': 'vp9', 'mp4v': 'mpeg4',
+    'mp4a': 'aac', 'ac-3': 'ac3', 'ec-3': 'eac3', 'opus': 'opus', 'flac': 'flac', '.mp3': 'mp3', 'alac': 'alac',
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_AV1': 'av1', 'V_VP8': 'vp8', 'V_VP9': 'vp9', 'V_MPEG4/ISO/ASP': 'mpeg4',
+    'A_AAC': 'aac', 'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_FLAC': 'flac', 'A_AC3': 'ac3', 'A_EAC3': 'eac3', 'A_DTS': 'dts', 'A_MPEG/L3': 'mp3',
+}
+
+def _codec_name(tag):
+    return _CODEC_NAMES.get(tag) or _CODEC_NAMES.get(tag.lower()) or tag.lower().strip()
+
+# MP4 / MOV / M4A: boxes are walked by their sizes, so only moov (wherever it is) is actually read
+def _mp4_boxes(f, start, end):
+    """Yields (type, payload start, payload end) for the boxes between start and end."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos); header = f.read(16)
+        if len(header) < 8: return
+        size, box_type = struct.unpack('>I4s', header[:8]); header_len = 8
+        if size == 1 and len(header) == 16: size = struct.unpack('>Q', header[8:16])[0]; header_len = 16
+        elif size == 0: size = end - pos # Extends to the end
+        if size < header_len: return
+        yield box_type, pos + header_len, min(pos + size, end)
+        pos += size
+
+def _mp4_find(f, start, end, *path):
+    """Payload of the box at path (e.g. b'mdia', b'hdlr') below [start, end), or None."""
+    for name in path:
+        found = next(((s, e) for t, s, e in _mp4_boxes(f, start, end) if t == name), None)
+        if found is None: return None
+        start, end = found
+    f.seek(start); return f.read(end - start)
+
+def _parse_mp4(f, size):
+    moov = next(((s, e) for t, s, e in _mp4_boxes(f, 0, size) if t == b'moov'), None)
+    if moov is None or moov[1] - moov[0] > config.METADATA_MAX_HEADER_BYTES: return None
+    f.seek(moov[0]); buf = io.BytesIO(f.read(moov[1] - moov[0])); end = moov[1] - moov[0]
+    info = {}
+    mvhd = _mp4_find(buf, 0, end, b'mvhd')
+    if mvhd:
+        timescale, duration = struct.unpack('>IQ', mvhd[20:32]) if mvhd[0] == 1 else struct.unpack('>II', mvhd[12:20])
+        if timescale and duration not in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF): info['duration'] = duration / timescale
+    for box_type, start, stop in _mp4_boxes(buf, 0, end):
+        if box_type != b'trak': continue
+        hdlr = _mp4_find(buf, start, stop, b'mdia', b'hdlr'); stsd = _mp4_find(buf, start, stop, b'mdia', b'minf', b'stbl', b'stsd')
+        if not hdlr or not stsd or len(stsd) < 16: continue
+        handler = hdlr[8:12]; entry = stsd[8:] # First sample entry
+        codec = _codec_name(entry[4:8].decode('latin-1'))
+        if handler == b'vide' and 'video_codec' not in info:
+            info['video_codec'] = codec
+            tkhd = _mp4_find(buf, start, stop, b'tkhd')
+            if tkhd and len(tkhd) >= 8:
+                width, height = struct.unpack('>II', tkhd[-8:]) # 16.16 fixed point
+                if width >> 16 and height >> 16: info['width'] = width >> 16; info['height'] = height >> 16
+        elif handler == b'soun' and 'audio_codec' not in info and len(entry) >= 36:
+            info['audio_codec'] = codec
+            info['channels'] = struct.unpack('>H', entry[24:26])[0]; info['sample_rate'] = struct.unpack('>I', entry[32:36])[0] >> 16
+    return info or None
+
+# Matroska / WebM: EBML elements; Info and Tracks come before the first Cluster
+_EBML_HEADER, _MKV_SEGMENT, _MKV_INFO, _MKV_TRACKS, _MKV_CLUSTER = 0x1A45DFA3, 0x18538067, 0x1549A966, 0x1654AE6B, 0x1F43B675
+
+def _ebml_vint(data, pos, keep_marker):
+    first = data[pos]
+    if first == 0: raise ValueError("invalid EBML length")
+    length = 9 - first.bit_length()
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]: value = (value << 8) | byte
+    if pos + length > len(data): raise ValueError("truncated EBML element")
+    return value, pos + length, length
+
+def _ebml_element(data, pos):
+    """(element ID, payload start, payload size or None if unknown) of the element at pos."""
+    element_id, pos, _ = _ebml_vint(data, pos, True)
+    size, start, length = _ebml_vint(data, pos, False)
+    return element_id, start, None if size == (1 << (7 * length)) - 1 else size
+
+def _ebml_children(data):
+    """Yields (element ID, payload) for the elements in a payload."""
+    pos = 0
+    while pos < len(data):
+        element_id, start, size = _ebml_element(data, pos)
+        if size is None: return
+        yield element_id, data[start:start + size]
+        pos = start + size
+
+def _ebml_float(payload):
+    return struct.unpack('>f' if len(payload) == 4 else '>d', payload)[0]
+
+def _parse_matroska(f, size):
+    f.seek(0); head = f.read(64)
+    element_id, start, header_size = _ebml_element(head, 0)
+    if element_id != _EBML_HEADER or header_size is None: return None
+    pos = start + header_size; f.seek(pos)
+    element_id, start, segment_size = _ebml_element(f.read(16), 0)
+    if element_id != _MKV_SEGMENT: return None
+    pos += start; end = size if segment_size is None else min(size, pos + segment_size)
+    info = {}; seen = set()
+    while pos < end and len(seen) < 2:
+        f.seek(pos); header = f.read(16)
+        if len(header) < 2: break
+        element_id, start, element_size = _ebml_element(header, 0)
+        if element_id == _MKV_CLUSTER or element_size is None: break
+        if element_id in (_MKV_INFO, _MKV_TRACKS):
+            if element_size > config.METADATA_MAX_HEADER_BYTES: break
+            f.seek(pos + start); payload = f.read(element_size); seen.add(element_id)
+            if element_id == _MKV_INFO: _parse_matroska_info(payload, info)
+            else: _parse_matroska_tracks(payload, info)
+        pos += start + element_size
+    return info or None
+
+def _parse_matroska_info(payload, info):
+    scale = 1000000; duration = None
+    for element_id, data in _ebml_children(payload):
+        if element_id == 0x2AD7B1: scale = int.from_bytes(data, 'big') # TimecodeScale (ns per tick)
+        elif element_id == 0x4489: duration = _ebml_float(data)
+    if duration: info['duration'] = duration * scale / 1e9
+
+def _parse_matroska_tracks(payload, info):
+    for element_id, entry in _ebml_children(payload):
+        if element_id != 0xAE: continue # TrackEntry
+        fields = dict(_ebml_children(entry)); track_type = int.from_bytes(fields.get(0x83, b''), 'big')
+        codec = _codec_name(fields.get(0x86, b'').decode('ascii', 'replace'))
+        if track_type == 1 and 'video_codec' not in info:
+            info['video_codec'] = codec; video = dict(_ebml_children(fields.get(0xE0, b'')))
+            if 0xB0 in video and 0xBA in video: info['width'] = int.from_bytes(video[0xB0], 'big'); info['height'] = int.from_bytes(video[0xBA], 'big')
+        elif track_type == 2 and 'audio_codec' not in info:
+            info['audio_codec'] = codec; audio = dict(_ebml_children(fields.get(0xE1, b'')))
+            if 0xB5 in audio: info['sample_rate'] = int(_ebml_float(audio[0xB5]))
+            info['channels'] = int.from_bytes(audio.get(0x9F, b'\x01'), 'big')
+
+# MP3: first confirmed frame header, then the Xing/Info or VBRI frame count (VBR) or the file size (CBR)
+_MP3_BITRATES = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+                 2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)} # kbit/s, Layer III
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)} # By version bits
+_MP3_SYNC_SEARCH = 64 * 1024 # Bytes searched for the first frame after the ID3 tag
+
+def _mp3_header(header):
+    """(version, bitrate_index, rate_index) of a Layer III frame header, or None."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0: return None
+    version = (header[1] >> 3) & 3; layer = (header[1] >> 1) & 3; bitrate_index = header[2] >> 4; rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3: return None # Layer III only
+    return version, bitrate_index, rate_index
+
+def _mp3_frame_length(header, version, bitrate_index, rate_index):
+    bitrate = _MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    return (144 if version == 3 else 72) * bitrate // _MP3_SAMPLE_RATES[version][rate_index] + ((header[2] >> 1) & 1)
+
+def _parse_mp3(f, size):
+    f.seek(0); head = f.read(10); audio_start = 0
+    if len(head) == 10 and head[:3] == b'ID3': # Synchsafe tag size, plus the footer if present
+        audio_start = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]) + (10 if head[5] & 0x10 else 0)
+    f.seek(audio_start); data = f.read(_MP3_SYNC_SEARCH)
+    # A sync pattern alone is common in arbitrary bytes: accept a frame only if a VBR tag or a matching
+    # second frame header follows it, else leave the file to ffprobe
+    for i in range(len(data) - 4):
+        parsed = _mp3_header(data[i:i + 4])
+        if parsed is None: continue
+        version, bitrate_index, rate_index = parsed; channels = 1 if data[i + 3] >> 6 == 3 else 2
+        xing = i + 4 + ((32 if channels == 2 else 17) if version == 3 else (17 if channels == 2 else 9)) # After the side info
+        if data[xing:xing + 4] in (b'Xing', b'Info') or data[i + 36:i + 40] == b'VBRI': break
+        next_frame = i + _mp3_frame_length(data[i:i + 4], version, bitrate_index, rate_index)
+        if next_frame + 4 <= len(data): following = data[next_frame:next_frame + 4]
+        else: f.seek(audio_start + next_frame); following = f.read(4)
+        following_parsed = _mp3_header(following)
+        if following_parsed is not None and following_parsed[0] == version and following_parsed[2] == rate_index: break
+    else: return None
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    bitrate = _MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    samples_per_frame = 1152 if version == 3 else 576
+    info = {'audio_codec': 'mp3', 'sample_rate': sample_rate, 'channels': channels}
+    if data[xing:xing + 4] in (b'Xing', b'Info') and struct.unpack('>I', data[xing + 4:xing + 8])[0] & 1:
+        info['duration'] = struct.unpack('>I', data[xing + 8:xing + 12])[0] * samples_per_frame / sample_rate
+    elif data[i + 36:i + 40] == b'VBRI':
+        info['duration'] = struct.unpack('>I', data[i + 50:i + 54])[0] * samples_per_frame / sample_rate
+    else:
+        f.seek(max(0, size - 128)); audio_end = size - 128 if f.read(3) == b'TAG' else size # ID3v1
+        info['duration'] = (audio_end - audio_start - i) * 8 / bitrate; info['bitrate'] = bitrate
+    if info.get('duration', 1) <= 0: return None # Empty or truncated frame count
+    return info
+
+# FLAC: STREAMINFO is always the first metadata block
+def _parse_flac(f, size):
+    f.seek(0); head = f.read(42)
+    if len(head) < 42 or head[:4] != b'fLaC' or head[4] & 0x7F != 0: return None
+    streaminfo = head[8:]
+    sample_rate = int.from_bytes(streaminfo[10:13], 'big') >> 4; channels = ((streaminfo[12] >> 1) & 7) + 1
+    total_samples = ((streaminfo[13] & 0x0F) << 32) | int.from_bytes(streaminfo[14:18], 'big')
+    info = {'audio_codec': 'flac', 'sample_rate': sample_rate, 'channels': channels}
+    if sample_rate and total_samples: info['duration'] = total_samples / sample_rate
+    return info
+
+_PARSERS = {'.mp4': _parse_mp4, '.m4a': _parse_mp4, '.m4v': _parse_mp4, '.mov': _parse_mp4,
+            '.mkv': _parse_matroska, '.webm': _parse_matroska, '.mp3': _parse_mp3, '.flac': _parse_flac}
+
+
+# --- Extraction ---
+def _run_ffprobe(src_abs):
+    """Metadata from ffprobe, or None if it isn't installed or can't read the file."""
+    if not shutil.which(config.FFPROBE_PATH): return None
+    cmd = [config.FFPROBE_PATH, '-v', 'error', '-show_entries', 'format=duration,bit_rate:stream=codec_type,codec_name,width,height,sample_rate,channels',
+           '-of', 'json', src_abs]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=config.METADATA_PROBE_TIMEOUT, check=True)
+        data = json.loads(result.stdout); fmt = data.get('format') or {}; info = {}
+        if float(fmt.get('duration') or 0) > 0: info['duration'] = float(fmt['duration'])
+        if fmt.get('bit_rate'): info['bitrate'] = int(fmt['bit_rate'])
+        for stream in data.get('streams') or []:
+            if stream.get('codec_type') == 'video' and 'video_codec' not in info and stream.get('codec_name') not in ('mjpeg', 'png'): # Not cover art
+                info['video_codec'] = stream.get('codec_name'); info['width'] = int(stream.get('width') or 0); info['height'] = int(stream.get('height') or 0)
+            elif stream.get('codec_type') == 'audio' and 'audio_codec' not in info:
+                info['audio_codec'] = stream.get('codec_name'); info['sample_rate'] = int(stream.get('sample_rate') or 0); info['channels'] = int(stream.get('channels') or 0)
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, TypeError) as e:
+        logger.debug(f"ffprobe could not read '{src_abs}': {e}"); return None
+    return info or None
+
+def extract(src_abs, size):
+    """Metadata dict for a media file: from its headers if a parser handles the type, else (or if that fails) ffprobe."""
+    info = None; parser = _PARSERS.get(os.path.splitext(src_abs)[1].lower())
+    if parser:
+        try:
+            with open(src_abs, 'rb') as f: info = parser(f, size)
+        except (OSError, ValueError, IndexError, struct.error) as e: logger.debug(f"Header parser failed for '{src_abs}': {e}")
+    if not info or not info.get('duration'): info = _run_ffprobe(src_abs) or info
+    if info and info.get('duration') and not info.get('bitrate'): info['bitrate'] = int(size * 8 / info['duration']) # Overall average
+    return info
+
+def _probe(path, size, mtime):
+    """Reads one queued file unless it changed or another worker already did it."""
+    src_abs = os.path.join(config.MEDIA_DIR_BASE, path) # Paths come from listings, already validated
+    try: st = os.stat(src_abs)
+    except OSError: return
+    if (st.st_size, st.st_mtime) != (size, mtime): return # Changed: its next lookup queues it again
+    row = _load_rows([path]).get(path)
+    if row is not None and row[:2] == (size, mtime): return
+    # Unreadable files are stored too (info NULL), so they aren't retried until they change
+    _store(path, size, mtime, extract(src_abs, size))
+
+
+# --- Background Workers ---
+def _worker_loop():
+    while True:
+        _, _, path, size, mtime = _queue.get()
+        with _queued_lock: _queued.discard(path)
+        try: _probe(path, size, mtime)
+        except Exception as e: logger.error(f"Metadata extraction failed for '{path}': {e}", exc_info=True)
+
+@contextmanager
+def _discovery_lock():
+    """Non-blocking cross-process lock so only one worker walks the library at a time. Yields True if acquired."""
+    if fcntl is None:
+        if not _local_discovery_lock.acquire(blocking=False): yield False; return
+        try: yield True
+        finally: _local_discovery_lock.release()
+        return
+    os.makedirs(os.path.dirname(config.METADATA_DB_PATH), exist_ok=True)
+    with open(f"{config.METADATA_DB_PATH}.lock", 'a') as lock_file:
+        try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: yield False; return
+        try: yield True
+        finally: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _queue_missing(entries):
+    """Queues the (path, size, mtime) entries without a current row, waiting while the queue is full."""
+    rows = _load_rows([path for path, _, _ in entries]); queued = 0
+    for path, size, mtime in entries:
+        row = rows.get(path)
+        if row is not None and row[:2] == (size, mtime): continue
+        while len(_queued) >= config.METADATA_QUEUE_MAX: time.sleep(1.0) # Paced by the workers
+        with _queued_lock:
+            if path in _queued: continue
+            _queued.add(path); _queue.put((_PRIORITY_DISCOVERED, next(_queue_order), path, size, mtime)); queued += 1
+    return queued
+
+def discover_library():
+    """Queues every indexed audio/video file that has no current cache row. Returns the number queued."""
+    queued = 0
+    for item_type in ('video', 'audio'):
+        batch = []
+        for parent, name, size, mtime in library_index.iter_items_of_type(item_type):
+            batch.append((f"{parent}/{name}" if parent else name, size, mtime))
+            if len(batch) >= _LOOKUP_BATCH: queued += _queue_missing(batch); batch = []
+        if batch: queued += _queue_missing(batch)
+    if queued: logger.info(f"Metadata discovery queued {queued} file(s).")
+    return queued
+
+def _discovery_loop():
+    while True:
+        try:
+            with _discovery_lock() as acquired:
+                if acquired: discover_library() # Another worker holding the lock is already doing it
+        except Exception as e: logger.error(f"Metadata discovery error: {e}", exc_info=True)
+        time.sleep(config.METADATA_DISCOVERY_INTERVAL)
+
+def start_workers():
+    """Starts the extraction threads (and library discovery) once per process. Cheap to call on every request."""
+    global _workers_pid
+    if not config.METADATA_ENABLED or _workers_pid == os.getpid(): return
+    with _workers_lock:
+        if _workers_pid == os.getpid(): return
+        _workers_pid = os.getpid()
+        for i in range(config.METADATA_WORKERS): threading.Thread(target=_worker_loop, name=f'metadata-{i}', daemon=True).start()
+        if config.LIBRARY_INDEX_ENABLED: threading.Thread(target=_discovery_loop, name='metadata-discovery', daemon=True).start()
+        logger.info(f"Metadata workers started (pid {_workers_pid}, {config.METADATA_WORKERS} threads, ffprobe fallback: {'yes' if shutil.which(config.FFPROBE_PATH) else 'no'}). Cache: {config.METADATA_DB_PATH}")
@@ -9,76 +9,154 @@ const modalTitle = document.getElementById("modalTitle");
 const textContentElement = document.getElementById("textContent");
 // Find the close button within the modal header
 const closeBtn = modal ? modal.querySelector(".modal-header .close-button") : null;
+// Find the Follow (live tail) toggle
+const followBtn = document.getElementById("textFollowBtn");
 
-// --- Function to Open Modal and Fetch Text Content ---
-function viewTextFile(url) {
-    // Basic check to ensure modal elements exist in the DOM
-    if (!modal || !modalTitle || !textContentElement) {
-        console.error("Modal elements not found in the DOM!");
-        alert("Error: Could not initialize the text file viewer.");
-        return;
-    }
-
-    console.log("Attempting to fetch text content from URL:", url);
-
-    // --- Prepare and Show Modal ---
-    // Reset content and title to loading state
-    textContentElement.textContent = "Loading file content...";
-    textContentElement.scrollTop = 0; // Scroll to top
-    modalTitle.textContent = "Loading...";
-    modal.style.display = "block"; // Make the modal visible
+// --- Paged Text Loading ---
+// view_text returns one page at a time (end_offset says where the next one starts, eof when done),
+// so even multi-GB logs open instantly. The next page is fetched when the reader scrolls near the
+// bottom of the modal body, and appended as a text node rather than re-rendering the whole <pre>.
+const textScrollContainer = modal ? modal.querySelector(".modal-body") : null;
+let textViewerState = null; // { url, followUrl, filename, size, nextOffset, eof, loading, firstPage } for the open file
 
-    // --- Fetch Data from Server ---
-    fetch(url)
+// Fetches one page as JSON, turning HTTP and application errors into thrown Errors
+function fetchTextPage(url) {
+    return fetch(url)
         .then(response => {
             // Check if the HTTP response status is OK (e.g., 200)
             if (!response.ok) {
                 // If not OK, try to parse the response body as JSON for an error message
                 return response.json()
+                    .catch(() => ({}))
                     .then(errData => {
-                        // If JSON parsing works and contains an error field, throw that error
                         throw new Error(errData.error || `Server error: ${response.status} ${response.statusText}`);
-                    })
-                    .catch(() => {
-                        // If response wasn't JSON or parsing failed, throw a generic HTTP error
-                        throw new Error(`Server error: ${response.status} ${response.statusText}`);
                     });
             }
-            // If response is OK, parse it as JSON
             return response.json();
         })
         .then(data => {
-            // --- Process Successful Response ---
             // Check if the parsed JSON data contains an error property (application-level error)
-            if (data.error) {
-                textContentElement.textContent = `Error loading file:\n\n${data.error}`;
-                modalTitle.textContent = "Error";
-                console.error("Server returned an application error:", data.error);
-            } else if (data.content !== undefined) {
-                // If content exists, display it
-                textContentElement.textContent = data.content;
-                modalTitle.textContent = data.filename || "Text File"; // Use filename from data or default
-                console.log("Text content loaded successfully for:", data.filename);
-            } else {
-                 // Handle unexpected successful response without content
-                 throw new Error("Received empty response from server.");
-            }
+            if (data.error) throw new Error(data.error);
+            if (data.content === undefined) throw new Error("Received empty response from server.");
+            return data;
+        });
+}
+
+// Loads the page after what is shown, unless one is already on its way or the file is fully shown
+function loadNextTextPage() {
+    const state = textViewerState;
+    if (!state || state.loading || state.eof) return;
+    state.loading = true;
+    const pageUrl = new URL(state.url, window.location.href);
+    pageUrl.searchParams.set("offset", state.nextOffset);
+    fetchTextPage(pageUrl.toString())
+        .then(data => {
+            if (state !== textViewerState || textFollowSource) return; // Closed, another file opened, or now following
+            if (state.firstPage) { textContentElement.textContent = data.content; state.firstPage = false; }
+            else textContentElement.appendChild(document.createTextNode(data.content));
+            state.filename = data.filename || state.filename; state.followUrl = data.follow_url; state.size = data.size;
+            state.nextOffset = data.end_offset; state.eof = data.eof; state.loading = false;
+            if (followBtn && state.followUrl) followBtn.hidden = false;
+            // Show how much of a large file is loaded until the end is reached
+            const percent = data.size ? Math.floor(100 * data.end_offset / data.size) : 100;
+            modalTitle.textContent = state.eof ? state.filename : `${state.filename} (${percent}% loaded)`;
+            maybeLoadMoreText(); // A short page may not fill the view yet
         })
         .catch(error => {
             // --- Handle Fetch Errors or Thrown Errors ---
             console.error('Error fetching or processing text content:', error);
-            // Display the error message in the modal
-            textContentElement.textContent = `Failed to load content.\n\nError: ${error.message}`;
-            modalTitle.textContent = "Loading Failed";
-            // Optionally alert the user as well, though error is shown in modal
-            // alert(`Failed to load text file: ${error.message}`);
+            if (state !== textViewerState) return;
+            state.loading = false; state.eof = true; // Stop paging after an error
+            if (state.firstPage) {
+                textContentElement.textContent = `Failed to load content.\n\nError: ${error.message}`;
+                modalTitle.textContent = "Loading Failed";
+            } else {
+                textContentElement.appendChild(document.createTextNode(`\n[Failed to load more: ${error.message}]`));
+            }
         });
 }
 
+// Fetches the next page once the reader is within a screenful of the bottom
+function maybeLoadMoreText() {
+    if (!textScrollContainer || !textViewerState) return;
+    const remaining = textScrollContainer.scrollHeight - textScrollContainer.scrollTop - textScrollContainer.clientHeight;
+    if (remaining < textScrollContainer.clientHeight) loadNextTextPage();
+}
+if (textScrollContainer) textScrollContainer.addEventListener('scroll', maybeLoadMoreText, { passive: true });
+
+// --- Live Tail (Follow) ---
+// An EventSource on follow_text receives only what is appended after the shown text ('append'
+// events carry the new offset; 'reset' means the file was truncated or rotated). If the reader
+// hasn't paged to the end of a large file, following jumps to its last few KB instead.
+const FOLLOW_JUMP_BYTES = 16 * 1024;
+let textFollowSource = null; // EventSource while following
+
+function stopFollowingText() {
+    if (textFollowSource) { textFollowSource.close(); textFollowSource = null; }
+    if (followBtn) { followBtn.classList.remove("active"); followBtn.textContent = "Follow"; }
+}
+
+function startFollowingText() {
+    const state = textViewerState;
+    if (!state || !state.followUrl || textFollowSource) return;
+    if (!state.eof && state.size - state.nextOffset > FOLLOW_JUMP_BYTES) {
+        state.nextOffset = state.size - FOLLOW_JUMP_BYTES;
+        textContentElement.appendChild(document.createTextNode("\n[... skipped to the end of the file ...]\n"));
+    }
+    state.eof = true; // Paging stops; the tail takes over from nextOffset
+    const followUrl = new URL(state.followUrl, window.location.href);
+    followUrl.searchParams.set("offset", state.nextOffset);
+    textFollowSource = new EventSource(followUrl.toString());
+    textFollowSource.addEventListener("append", event => {
+        const data = JSON.parse(event.data);
+        const atBottom = textScrollContainer && textScrollContainer.scrollHeight - textScrollContainer.scrollTop - textScrollContainer.clientHeight < 40;
+        textContentElement.appendChild(document.createTextNode(data.text));
+        state.nextOffset = data.offset;
+        if (atBottom) textScrollContainer.scrollTop = textScrollContainer.scrollHeight; // Stay pinned to new lines
+    });
+    textFollowSource.addEventListener("reset", () => {
+        textContentElement.appendChild(document.createTextNode("\n[--- file truncated or rotated, following from its start ---]\n"));
+        state.nextOffset = 0;
+    });
+    followBtn.classList.add("active"); followBtn.textContent = "Following";
+    modalTitle.textContent = state.filename;
+}
+
+if (followBtn) {
+    followBtn.addEventListener("click", () => { if (textFollowSource) stopFollowingText(); else startFollowingText(); });
+}
+
+// --- Function to Open Modal and Fetch Text Content ---
+function viewTextFile(url) {
+    // Basic check to ensure modal elements exist in the DOM
+    if (!modal || !modalTitle || !textContentElement) {
+        console.error("Modal elements not found in the DOM!");
+        alert("Error: Could not initialize the text file viewer.");
+        return;
+    }
+
+    console.log("Attempting to fetch text content from URL:", url);
+
+    // --- Prepare and Show Modal ---
+    // Reset content and title to loading state
+    textContentElement.textContent = "Loading file content...";
+    if (textScrollContainer) textScrollContainer.scrollTop = 0; // Scroll to top
+    modalTitle.textContent = "Loading...";
+    modal.style.display = "block"; // Make the modal visible
+
+    // --- Fetch the First Page ---
+    stopFollowingText();
+    if (followBtn) followBtn.hidden = true; // Shown once the first page says where to follow
+    textViewerState = { url: url, followUrl: null, filename: "Text File", size: 0, nextOffset: 0, eof: false, loading: false, firstPage: true };
+    loadNextTextPage();
+}
+
 // --- Function to Close the Modal ---
 function closeModal() {
     if (modal) {
         modal.style.display = "none"; // Hide the modal
+        textViewerState = null; // Stop paging the closed file
+        stopFollowingText();
         // Clear content and title for next time
         if (textContentElement) textContentElement.textContent = "";
         if (modalTitle) modalTitle.textContent = "";
@@ -124,4 +202,52 @@ if (!modal && document.querySelector('.item-action-button.view')) {
      console.warn("View buttons exist, but the textViewerModal element was not found. Text viewing will not work.");
 } else {
      console.log("browse.js loaded successfully. Modal elements found.");
-}
\ No newline at end of file
+}
+// --- Infinite Scroll ---
+// When a folder has more pages, fetch them from the JSON listing API (browse_json) as the user
+// nears the bottom and append the server-rendered rows. The page links stay as a no-JS fallback.
+(function setupInfiniteScroll() {
+    const list = document.querySelector('ul.file-list[data-list-url]');
+    if (!list || !list.dataset.nextCursor || !('IntersectionObserver' in window)) return;
+
+    const pagination = document.querySelector('.pagination-nav');
+    const sentinel = document.createElement('div');
+    sentinel.className = 'infinite-scroll-sentinel';
+    list.after(sentinel);
+    if (pagination) pagination.style.display = 'none';
+
+    let nextCursor = list.dataset.nextCursor;
+    let loading = false;
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) loadMore();
+    }, { rootMargin: '600px' });
+
+    function loadMore() {
+        if (loading || !nextCursor) return;
+        loading = true;
+        const baseUrl = list.dataset.listUrl;
+        const url = `${baseUrl}${baseUrl.includes('?') ? '&' : '?'}include_html=1&cursor=${encodeURIComponent(nextCursor)}`;
+        fetch(url)
+            .then(response => {
+                if (!response.ok) throw new Error(`Server error: ${response.status} ${response.statusText}`);
+                return response.json();
+            })
+            .then(data => {
+                list.insertAdjacentHTML('beforeend', data.html || '');
+                nextCursor = data.next_cursor;
+                if (data.listing_changed) console.warn("Folder changed while scrolling; a few rows may be repeated or skipped.");
+                document.dispatchEvent(new CustomEvent('fileListAppended', { detail: { list: list } }));
+                if (!nextCursor) { observer.disconnect(); sentinel.remove(); }
+                else { observer.unobserve(sentinel); observer.observe(sentinel); } // Re-check in case the sentinel is still visible
+            })
+            .catch(error => {
+                // Fall back to the page links
+                console.error('Error loading more items:', error);
+                observer.disconnect();
+                if (pagination) pagination.style.display = '';
+            })
+            .finally(() => { loading = false; });
+    }
+
+    observer.observe(sentinel);
+})();
@@ -0,0 +1,256 @@
+# streaming.py
+import os
+import time
+import logging
+import itertools
+import threading
+from collections import deque, OrderedDict
+
+from flask import Response
+
+import config # Use our config file
+import bandwidth # Fair-share pacing of response bodies
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+
+# --- HTTP Validators & Caching ---
+def file_etag(stat_result):
+    """Cheap strong validator from stat data: changes whenever mtime or size changes."""
+    return f"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"
+
+def cache_control_for(file_type):
+    """Cache-Control value configured for a file type ('image', 'video', ...)."""
+    return config.CACHE_CONTROL_BY_TYPE.get(file_type, config.CACHE_CONTROL_BY_TYPE.get('default', 'no-cache'))
+
+def apply_validators(response, stat_result, file_type, etag=None):
+    """Sets ETag (default: file_etag), Last-Modified and the per-type Cache-Control on a response."""
+    response.set_etag(etag or file_etag(stat_result))
+    response.last_modified = int(stat_result.st_mtime)
+    response.headers['Cache-Control'] = cache_control_for(file_type)
+    return response
+
+def is_not_modified(req, stat_result, etag=None):
+    """
+    Evaluates If-None-Match / If-Modified-Since for a GET/HEAD.
+    If-None-Match takes precedence; If-Modified-Since is only consulted without it (RFC 9110 13.2.2).
+    """
+    if req.if_none_match:
+        return req.if_none_match.contains_weak(etag or file_etag(stat_result))
+    if req.if_modified_since is not None:
+        return int(stat_result.st_mtime) <= req.if_modified_since.timestamp()
+    return False
+
+def if_range_allows_partial(req, stat_result, etag=None):
+    """
+    False if an If-Range header no longer matches the file, in which case the full
+    representation must be sent instead of the requested range. Dates must match exactly.
+    """
+    if_range = req.if_range
+    if if_range.etag is not None:
+        return if_range.etag == (etag or file_etag(stat_result))
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) == int(stat_result.st_mtime)
+    return True
+
+
+# --- Small File Byte Cache ---
+class ByteCache:
+    """
+    LRU cache of whole-file bytes keyed by absolute path, for small files fetched over and over
+    (grid thumbnails, images the modal viewer prefetches). An entry is only returned while the file's
+    (mtime, size) is unchanged. Memory is bounded by total bytes; larger files are never cached.
+    """
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._entries = OrderedDict() # path -> (mtime_ns, size, data)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, stat_result):
+        return 0 < stat_result.st_size <= min(self.max_file_bytes, self.max_bytes)
+
+    def read(self, file_path_abs, stat_result):
+        """The file's bytes: from memory while (mtime, size) match stat_result, else read from disk and cached."""
+        signature = (stat_result.st_mtime_ns, stat_result.st_size)
+        with self._lock:
+            entry = self._entries.get(file_path_abs)
+            if entry is not None and entry[:2] == signature:
+                self._entries.move_to_end(file_path_abs); self.hits += 1
+                return entry[2]
+            self.misses += 1
+        with open(file_path_abs, 'rb') as f: data = f.read(stat_result.st_size + 1)
+        if len(data) != stat_result.st_size: return data # Changed while reading: serve, don't cache
+        with self._lock:
+            self._pop(file_path_abs)
+            self._entries[file_path_abs] = (*signature, data); self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries))); self.evictions += 1
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'bytes': self._total_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _pop(self, file_path_abs):
+        entry = self._entries.pop(file_path_abs, None)
+        if entry is not None: self._total_bytes -= entry[1]
+
+_byte_cache = ByteCache(config.BYTE_CACHE_MAX_BYTES, config.BYTE_CACHE_MAX_FILE_BYTES)
+
+def cached_file_response(req, file_path_abs, stat_result, mimetype, etag=None):
+    """
+    Response for a small file served from the byte cache, with the usual validators and conditional/Range
+    handling; None if the file is too big to cache (callers fall back to send_file).
+    """
+    if not _byte_cache.cacheable(stat_result): return None
+    response = Response(_byte_cache.read(file_path_abs, stat_result), mimetype=mimetype)
+    response.set_etag(etag or file_etag(stat_result)); response.last_modified = int(stat_result.st_mtime)
+    return response.make_conditional(req, accept_ranges=True, complete_length=stat_result.st_size)
+
+def get_byte_cache_stats():
+    return _byte_cache.stats()
+
+
+# --- Kernel Page Cache Hints ---
+_HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+def fadvise(fd, offset, length, advice_name):
+    """posix_fadvise by name ('SEQUENTIAL', 'WILLNEED', 'DONTNEED'); a no-op where unsupported or disabled."""
+    if not (_HAS_FADVISE and config.STREAM_FADVISE) or length <= 0: return
+    try: os.posix_fadvise(fd, offset, length, getattr(os, f'POSIX_FADV_{advice_name}'))
+    except OSError as e: logger.debug(f"posix_fadvise {advice_name} failed: {e}")
+
+
+# --- Per-Stream Stats ---
+class StreamStats:
+    """Progress of one generator-served body, for /stream_stats and the end-of-stream log line."""
+    __slots__ = ('id', 'name', 'client', 'traffic_class', 'start', 'length', 'sent', 'chunk_size', 'drain_rate', 'cache_dropped', 'started', 'finished')
+
+    def __init__(self, stream_id, name, client, traffic_class, start, length, chunk_size):
+        self.id = stream_id; self.name = name; self.client = client; self.traffic_class = traffic_class
+        self.start = start; self.length = length; self.sent = 0; self.chunk_size = chunk_size
+        self.drain_rate = None; self.cache_dropped = 0; self.started = time.time(); self.finished = None
+
+    def as_dict(self):
+        elapsed = max((self.finished or time.time()) - self.started, 1e-6)
+        return {'id': self.id, 'name': self.name, 'client': self.client, 'class': self.traffic_class, 'start': self.start, 'length': self.length,
+                'sent': self.sent, 'chunk_size': self.chunk_size, 'drain_rate': int(self.drain_rate) if self.drain_rate else None,
+                'average_rate': int(self.sent / elapsed), 'cache_dropped': self.cache_dropped, 'elapsed': round(elapsed, 2)}
+
+_stream_ids = itertools.count(1)
+_active_streams = {} # stream id -> StreamStats
+_recent_streams = deque(maxlen=20) # Finished ones, newest last
+_stats_lock = threading.Lock()
+
+def get_stream_stats():
+    """Active and recently finished generator-served bodies in this worker."""
+    with _stats_lock:
+        return {'pid': os.getpid(), 'byte_cache': get_byte_cache_stats(), 'active': [st.as_dict() for st in _active_streams.values()], 'recent': [st.as_dict() for st in reversed(_recent_streams)]}
+
+
+# --- Generator Fallback ---
+def _next_chunk_size(drain_rate):
+    """Chunk size that takes about STREAM_CHUNK_TARGET_SECONDS to drain: a power of two within the configured bounds."""
+    wanted = max(config.STREAM_CHUNK_MIN, min(config.STREAM_CHUNK_MAX, int(drain_rate * config.STREAM_CHUNK_TARGET_SECONDS)))
+    return 1 << (wanted.bit_length() - 1)
+
+def iter_file_range(file_path_abs, start, length, chunk_size=None, traffic_class='stream', client=None):
+    """
+    Yields `length` bytes of a file starting at `start`, read in userspace chunks.
+    The range is announced as sequential and read ahead with WILLNEED. Without a fixed chunk_size, chunks
+    grow or shrink with the rate the client drains them (the time the server spends sending each one).
+    'download' bodies drop the bytes already sent from the page cache, so one-off bulk copies don't
+    evict what the players are using.
+    """
+    adaptive = chunk_size is None
+    chunk_size = chunk_size or config.STREAM_CHUNK_INITIAL
+    drop_behind = traffic_class == 'download' and config.STREAM_DROP_BULK_CACHE
+    stats = StreamStats(next(_stream_ids), os.path.basename(file_path_abs), client, traffic_class, start, length, chunk_size)
+    with _stats_lock: _active_streams[stats.id] = stats
+    try:
+        with open(file_path_abs, 'rb', buffering=0) as f:
+            fd = f.fileno(); position = start; end = start + length
+            fadvise(fd, start, length, 'SEQUENTIAL'); readahead_end = start; dropped_to = start
+            while position < end:
+                size = min(chunk_size, end - position)
+                wanted_ahead = min(end, position + size + config.STREAM_READAHEAD_CHUNKS * chunk_size)
+                if wanted_ahead > readahead_end: fadvise(fd, max(readahead_end, position), wanted_ahead - max(readahead_end, position), 'WILLNEED'); readahead_end = wanted_ahead
+                chunk = os.pread(fd, size, position)
+                if not chunk: break
+                handed_over = time.monotonic()
+                yield chunk
+                drain_seconds = time.monotonic() - handed_over
+                position += len(chunk); stats.sent += len(chunk)
+                if drain_seconds > 0:
+                    rate = len(chunk) / drain_seconds
+                    stats.drain_rate = rate if stats.drain_rate is None else 0.7 * stats.drain_rate + 0.3 * rate
+                    if adaptive: chunk_size = stats.chunk_size = _next_chunk_size(stats.drain_rate)
+                if drop_behind and position - dropped_to >= config.STREAM_DROP_BEHIND_BYTES:
+                    fadvise(fd, dropped_to, position - dropped_to, 'DONTNEED'); stats.cache_dropped += position - dropped_to; dropped_to = position
+            if drop_behind and position > dropped_to: fadvise(fd, dropped_to, position - dropped_to, 'DONTNEED'); stats.cache_dropped += position - dropped_to
+    except Exception as e_gen: logger.error(f"Stream generator error for '{file_path_abs}': {e_gen}", exc_info=True)
+    finally:
+        stats.finished = time.time()
+        with _stats_lock: _active_streams.pop(stats.id, None); _recent_streams.append(stats)
+        summary = stats.as_dict()
+        logger.debug(f"Stream {stats.id} ({traffic_class}) '{stats.name}': {stats.sent}/{length} bytes in {summary['elapsed']}s, "
+                     f"avg {summary['average_rate']} B/s, last chunk {stats.chunk_size}, dropped {stats.cache_dropped} from cache")
+
+
+# --- Zero-Copy (sendfile) Path ---
+def can_use_sendfile(environ):
+    """
+    True if the WSGI server offers a file wrapper we trust to sendfile() a bounded range.
+    The wrapper gets a file object positioned at the range start; gunicorn and waitress then send
+    exactly Content-Length bytes from the current offset (gunicorn via os.sendfile). Other servers'
+    wrappers may read to EOF, so they get the generator instead.
+    """
+    if not config.STREAM_USE_SENDFILE or not hasattr(os, 'sendfile'): return False
+    if 'wsgi.file_wrapper' not in environ: return False
+    server_software = str(environ.get('SERVER_SOFTWARE', '')).lower()
+    return any(server_software.startswith(name) for name in config.STREAM_SENDFILE_SERVERS)
+
+def open_range_body(environ, file_path_abs, start, length, traffic_class='stream'):
+    """
+    Returns a WSGI response body for bytes [start, start + length) of a file.
+    Uses the server's wsgi.file_wrapper (kernel copy) when possible, else the chunk generator;
+    while bandwidth limits are set, small chunks paced by the scheduler instead.
+    The caller must set Content-Length to `length` and use direct_passthrough.
+    """
+    client = bandwidth.client_key(environ)
+    if bandwidth.is_limited():
+        return bandwidth.ThrottledBody(iter_file_range(file_path_abs, start, length, config.BANDWIDTH_CHUNK_SIZE, traffic_class, client), client, traffic_class)
+    # Bulk downloads give up the kernel copy so the generator can drop what it has sent from the page cache
+    if length > 0 and can_use_sendfile(environ) and not (traffic_class == 'download' and config.STREAM_DROP_BULK_CACHE):
+        try:
+            f = open(file_path_abs, 'rb')
+        except OSError as e:
+            logger.error(f"Could not open '{file_path_abs}' for sendfile, using generator: {e}")
+        else:
+            try:
+                f.seek(start); fadvise(f.fileno(), start, length, 'SEQUENTIAL')
+                return environ['wsgi.file_wrapper'](f, config.CHUNK_SIZE)
+            except Exception as e:
+                f.close()
+                logger.error(f"wsgi.file_wrapper failed for '{file_path_abs}', using generator: {e}", exc_info=True)
+    return iter_file_range(file_path_abs, start, length, traffic_class=traffic_class, client=client)
+
+def replace_with_range_body(response, environ, file_path_abs, traffic_class):
+    """
+    Swaps a send_file() response body for open_range_body() over the same bytes (its 206 range or the
+    whole file), so downloads get the same read-ahead, cache dropping and pacing as /stream.
+    """
+    if environ.get('REQUEST_METHOD') == 'HEAD' or response.status_code not in (200, 206): return response
+    if response.status_code == 206: start, stop = response.content_range.start, response.content_range.stop
+    else: start, stop = 0, response.content_length
+    if stop is None: return response
+    if hasattr(response.response, 'close'): response.response.close()
+    response.response = open_range_body(environ, file_path_abs, start, stop - start, traffic_class)
+    return response
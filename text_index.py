@@ -0,0 +1,345 @@
+# text_index.py
+import os
+import json
+import time
+import codecs
+import bisect
+import logging
+import threading
+from array import array
+from collections import OrderedDict, deque
+
+import config # Use our config file
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Paged text viewing for files of any size. A LineIndex records, for every TEXT_INDEX_BLOCK_BYTES block,
+# how many newlines precede it (one bytes.count per block), so line N is found by a bisect plus a scan of
+# one block. The index is only extended as far as a request needs, and grows in place when a log is
+# appended to. The encoding is detected once from a sample. Indexes are kept in memory per worker and in
+# TEXT_INDEX_DIR/<item id>.idx (a JSON header line, then the counts) for the other workers.
+
+_memory = OrderedDict() # item ID -> LineIndex
+_memory_lock = threading.Lock()
+
+
+# --- Encoding Detection ---
+def detect_encoding(sample):
+    """First of [FILESYSTEM_ENCODING, 'utf-8', 'latin-1'] that decodes the sample (a cut-off last character is allowed)."""
+    if sample.startswith(codecs.BOM_UTF8): return 'utf-8-sig'
+    for encoding in dict.fromkeys([config.FILESYSTEM_ENCODING, 'utf-8', 'latin-1']):
+        try: codecs.getincrementaldecoder(encoding)().decode(sample, final=False); return encoding
+        except (UnicodeDecodeError, LookupError): continue
+    return 'latin-1'
+
+
+# --- Line Index ---
+class LineIndex:
+    """Newline counts at block boundaries of one file version (dev, inode); see module comment."""
+    __slots__ = ('dev', 'ino', 'size', 'mtime_ns', 'encoding', 'block_lines', 'scanned_to', 'newlines', 'ends_with_newline', 'lock')
+
+    def __init__(self, stat_result, encoding):
+        self.dev = stat_result.st_dev; self.ino = stat_result.st_ino
+        self.size = stat_result.st_size; self.mtime_ns = stat_result.st_mtime_ns; self.encoding = encoding
+        self.block_lines = array('Q', [0]) # block_lines[i] = newlines in [0, i * TEXT_INDEX_BLOCK_BYTES)
+        self.scanned_to = 0 # Bytes counted so far
+        self.newlines = 0 # Newlines in [0, scanned_to)
+        self.ends_with_newline = False # Known once complete
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return self.scanned_to >= self.size
+
+    def total_lines(self):
+        """Line count once the whole file is scanned (a last line without a newline counts), else None."""
+        if not self.complete: return None
+        return self.newlines + (1 if self.size and not self.ends_with_newline else 0)
+
+    def follow(self, stat_result):
+        """
+        Adopts a newer stat of the same file. True if the index is still usable: the file only grew
+        (an appended log), in which case scanning resumes at the last full block. False if replaced or truncated.
+        """
+        if (stat_result.st_dev, stat_result.st_ino) != (self.dev, self.ino) or stat_result.st_size < self.size: return False
+        if stat_result.st_size == self.size and stat_result.st_mtime_ns == self.mtime_ns: return True
+        if stat_result.st_size == self.size: return False # Rewritten in place
+        self.size = stat_result.st_size; self.mtime_ns = stat_result.st_mtime_ns
+        self.scanned_to = (len(self.block_lines) - 1) * config.TEXT_INDEX_BLOCK_BYTES; self.newlines = self.block_lines[-1]
+        return True
+
+    def scan(self, fd, until_line=None, until_offset=None):
+        """Counts newlines block by block until line `until_line` is located, `until_offset` is passed, or EOF."""
+        block = config.TEXT_INDEX_BLOCK_BYTES
+        while self.scanned_to < self.size:
+            if until_line is not None and self.newlines >= until_line: break
+            if until_offset is not None and self.scanned_to >= until_offset: break
+            data = os.pread(fd, min(block, self.size - self.scanned_to), self.scanned_to)
+            if not data: self.size = self.scanned_to; break # Shrank under us
+            self.newlines += data.count(b'\n'); self.scanned_to += len(data)
+            if self.scanned_to >= self.size: self.ends_with_newline = data.endswith(b'\n')
+            if self.scanned_to % block == 0: self.block_lines.append(self.newlines)
+
+    def line_offset(self, fd, line):
+        """Byte offset where 0-based `line` starts, or None if the file has fewer lines."""
+        if line <= 0: return 0
+        self.scan(fd, until_line=line)
+        if self.newlines < line: return None # Only reachable as a last line without a trailing newline
+        block = config.TEXT_INDEX_BLOCK_BYTES
+        i = bisect.bisect_left(self.block_lines, line) - 1 # Block holding the line-th newline
+        data = os.pread(fd, block, i * block); position = -1
+        for _ in range(line - self.block_lines[i]): position = data.find(b'\n', position + 1)
+        return i * block + position + 1
+
+    def line_number(self, fd, offset):
+        """0-based line number of the line starting at `offset`, if the index reaches that far (else None)."""
+        if offset > self.scanned_to: return None
+        block = config.TEXT_INDEX_BLOCK_BYTES; i = offset // block
+        if i >= len(self.block_lines): i = len(self.block_lines) - 1
+        return self.block_lines[i] + os.pread(fd, offset - i * block, i * block).count(b'\n')
+
+
+# --- Persistence ---
+def _index_path(item_id):
+    return os.path.join(config.TEXT_INDEX_DIR, f"{item_id}.idx")
+
+def _load(item_id, stat_result):
+    try:
+        with open(_index_path(item_id), 'rb') as f: header = json.loads(f.readline()); counts = f.read()
+    except (OSError, ValueError): return None
+    if (header.get('dev'), header.get('ino')) != (stat_result.st_dev, stat_result.st_ino): return None
+    index = LineIndex(stat_result, header['encoding'])
+    index.size = header['size']; index.mtime_ns = header['mtime_ns']
+    index.block_lines = array('Q'); index.block_lines.frombytes(counts)
+    index.scanned_to = header['scanned_to']; index.newlines = header['newlines']; index.ends_with_newline = header['ends_with_newline']
+    return index
+
+def _store(item_id, index):
+    header = {'dev': index.dev, 'ino': index.ino, 'size': index.size, 'mtime_ns': index.mtime_ns, 'encoding': index.encoding,
+              'scanned_to': index.scanned_to, 'newlines': index.newlines, 'ends_with_newline': index.ends_with_newline}
+    try:
+        os.makedirs(config.TEXT_INDEX_DIR, exist_ok=True)
+        tmp_path = f"{_index_path(item_id)}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(json.dumps(header).encode('utf-8') + b'\n'); f.write(index.block_lines.tobytes())
+        os.replace(tmp_path, _index_path(item_id))
+    except OSError as e: logger.warning(f"Could not store text index for {item_id}: {e}")
+
+
+def _get_index(item_id, fd, stat_result):
+    """Index for this file version: from memory, then disk, else a new one (encoding from a sample)."""
+    with _memory_lock:
+        index = _memory.get(item_id)
+        if index is not None: _memory.move_to_end(item_id)
+    if index is not None:
+        with index.lock:
+            if not index.follow(stat_result): index = None
+    if index is None:
+        index = _load(item_id, stat_result)
+        if index is not None and not index.follow(stat_result): index = None
+    if index is None:
+        index = LineIndex(stat_result, detect_encoding(os.pread(fd, config.TEXT_ENCODING_SAMPLE_BYTES, 0)))
+        logger.debug(f"New text index for {item_id}: {stat_result.st_size} bytes, encoding {index.encoding}")
+    with _memory_lock:
+        _memory[item_id] = index; _memory.move_to_end(item_id)
+        while len(_memory) > config.TEXT_INDEX_MEMORY_MAX: _memory.popitem(last=False)
+    return index
+
+
+# --- Pages ---
+def read_page(item_id, file_path_abs, line=None, offset=None, max_lines=None):
+    """
+    A window of up to max_lines whole lines, starting at 0-based `line` or at the first line starting at
+    or after byte `offset` (default: the start; pass a previous end_offset to continue). A single line longer
+    than TEXT_PAGE_MAX_BYTES is cut, and the next page starts at the line after it.
+    Returns a dict: content, encoding, size, start_line (None while unknown), start_offset, end_offset
+    (where the next page starts), eof and total_lines (None until the whole file has been scanned).
+    """
+    max_lines = max(1, min(max_lines or config.TEXT_PAGE_LINES, config.TEXT_PAGE_MAX_LINES))
+    with open(file_path_abs, 'rb', buffering=0) as f:
+        fd = f.fileno(); st = os.fstat(fd)
+        index = _get_index(item_id, fd, st)
+        with index.lock:
+            scanned_before = index.scanned_to
+            if line is not None:
+                start = index.line_offset(fd, line); start_line = line
+                if start is None: start = st.st_size; start_line = index.total_lines() # Past the end: empty page
+            else:
+                start = max(0, min(offset or 0, st.st_size))
+                if 0 < start < st.st_size and os.pread(fd, 1, start - 1) != b'\n': # Mid-line: skip to the next line
+                    rest = start
+                    while rest < st.st_size:
+                        data = os.pread(fd, config.TEXT_INDEX_BLOCK_BYTES, rest); newline = data.find(b'\n')
+                        if newline >= 0: start = rest + newline + 1; break
+                        rest += len(data)
+                    else: start = st.st_size
+                start_line = None
+            data = _read_lines(fd, start, st.st_size, max_lines); end = start + len(data)
+            # Count through the page just served (its blocks are in the page cache), so reading a file front
+            # to back builds its index as a side effect and continuation pages know their line numbers
+            index.scan(fd, until_offset=end)
+            if start_line is None: start_line = index.line_number(fd, start)
+            if index.scanned_to != scanned_before: _store(item_id, index)
+            return {'content': data.decode(index.encoding, errors='replace'), 'encoding': index.encoding, 'size': st.st_size,
+                    'start_line': start_line, 'start_offset': start, 'end_offset': end, 'eof': end >= st.st_size,
+                    'total_lines': index.total_lines()}
+
+def _read_lines(fd, start, size, max_lines):
+    """
+    Bytes from start through the max_lines-th newline or EOF. Past TEXT_PAGE_MAX_BYTES the page ends at
+    its last whole line, or, if not even one line fits, inside that line.
+    """
+    parts = []; taken = 0; lines = 0; position = start
+    while position < size and lines < max_lines and taken < config.TEXT_PAGE_MAX_BYTES:
+        data = os.pread(fd, min(64 * 1024, config.TEXT_PAGE_MAX_BYTES - taken), position)
+        if not data: break
+        cut = -1
+        while lines < max_lines and (cut := data.find(b'\n', cut + 1)) >= 0: lines += 1
+        if lines >= max_lines: data = data[:cut + 1]
+        parts.append(data); taken += len(data); position += len(data)
+    page = b''.join(parts)
+    if position < size and 0 < lines < max_lines: page = page[:page.rfind(b'\n') + 1]
+    return page
+
+
+# --- Live Tail (Server-Sent Events) ---
+_watchers = {} # absolute path -> _TailWatcher
+_watchers_lock = threading.Lock()
+
+
+class _TailWatcher:
+    """
+    One per followed file per worker, however many viewers: polls stat every TEXT_FOLLOW_POLL_INTERVAL,
+    reads appended bytes once into a bounded buffer of recent chunks, and notices truncation (size went
+    down) or rotation (the path now names another inode), which starts a new generation at offset 0.
+    The thread exits once nobody has followed the file for a while.
+    """
+    def __init__(self, file_path_abs, stat_result):
+        self.path = file_path_abs
+        self.cond = threading.Condition()
+        self.ino = stat_result.st_ino; self.size = stat_result.st_size
+        self.generation = 0 # Incremented on truncation/rotation
+        self.chunks = deque() # (start offset, bytes) of the current generation, oldest first
+        self.buffered = 0
+        self.subscribers = 0
+        self.idle_since = None
+
+    def _poll_once(self):
+        try: st = os.stat(self.path)
+        except OSError: return # Mid-rotation or deleted: keep the old state until it reappears
+        with self.cond:
+            if st.st_ino != self.ino or st.st_size < self.size:
+                logger.info(f"Followed file '{self.path}' was {'rotated' if st.st_ino != self.ino else 'truncated'}; restarting at 0")
+                self.ino = st.st_ino; self.size = 0; self.generation += 1; self.chunks.clear(); self.buffered = 0
+                self.cond.notify_all()
+            if st.st_size <= self.size: return
+            start = self.size
+        try:
+            with open(self.path, 'rb', buffering=0) as f:
+                if os.fstat(f.fileno()).st_ino != st.st_ino: return # Rotated between stat and open: next poll
+                data = os.pread(f.fileno(), min(st.st_size - start, config.TEXT_FOLLOW_MAX_READ), start)
+        except OSError as e: logger.warning(f"Could not read appended data of '{self.path}': {e}"); return
+        with self.cond:
+            if not data or self.size != start or self.ino != st.st_ino: return
+            self.chunks.append((start, data)); self.buffered += len(data); self.size = start + len(data)
+            while self.buffered > config.TEXT_FOLLOW_BUFFER_BYTES and len(self.chunks) > 1:
+                self.buffered -= len(self.chunks.popleft()[1])
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with _watchers_lock, self.cond: # Same lock order as _get_watcher
+                if self.subscribers == 0 and time.monotonic() - self.idle_since > config.TEXT_FOLLOW_IDLE_SECONDS:
+                    if _watchers.get(self.path) is self: del _watchers[self.path]
+                    return
+            try: self._poll_once()
+            except Exception as e: logger.error(f"Tail watcher error for '{self.path}': {e}", exc_info=True)
+            time.sleep(config.TEXT_FOLLOW_POLL_INTERVAL)
+
+    def subscribe(self):
+        with self.cond: self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+            if self.subscribers == 0: self.idle_since = time.monotonic()
+
+
+def _get_watcher(file_path_abs, stat_result):
+    with _watchers_lock:
+        watcher = _watchers.get(file_path_abs)
+        if watcher is None:
+            watcher = _watchers[file_path_abs] = _TailWatcher(file_path_abs, stat_result)
+            watcher.subscribe() # Before the thread starts, so it can't retire at once
+            threading.Thread(target=watcher.run, name=f"tail-{os.path.basename(file_path_abs)}", daemon=True).start()
+        else: watcher.subscribe()
+    return watcher
+
+
+def _sse(event, data, event_id=None):
+    """One Server-Sent Events message (data as single-line JSON)."""
+    return (f"id: {event_id}\n" if event_id is not None else "").encode() + f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class FollowStream:
+    """
+    text/event-stream body for one viewer: 'append' events ({text, offset}) with everything written after
+    the client's offset, 'reset' ({offset: 0}) when the file is truncated or rotated, and keep-alive
+    comments. Each event's id is the byte offset reached, so EventSource reconnects resume via Last-Event-ID.
+    Ends after max_seconds so a worker isn't held forever (the browser reconnects, after retry_ms if given).
+    poll() never blocks; iterating waits on the shared watcher, the ASGI server awaits between polls instead.
+    """
+    def __init__(self, item_id, file_path_abs, offset, max_seconds=None, retry_ms=None):
+        with open(file_path_abs, 'rb', buffering=0) as f:
+            st = os.fstat(f.fileno())
+            self.encoding = _get_index(item_id, f.fileno(), st).encoding
+        self.path = file_path_abs
+        self.watcher = _get_watcher(file_path_abs, st)
+        with self.watcher.cond:
+            self.generation = self.watcher.generation
+            self.position = offset if offset <= self.watcher.size else 0 # Client is ahead: file was truncated
+            self._pending = [] if offset <= self.watcher.size else [_sse('reset', {'offset': 0}, 0)]
+        if retry_ms is not None: self._pending.insert(0, f"retry: {int(retry_ms)}\n\n".encode())
+        self.max_seconds = config.TEXT_FOLLOW_MAX_SECONDS if max_seconds is None else max_seconds
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        self.started = self.last_sent = time.monotonic()
+        self.finished = False
+        self._closed = False
+
+    def poll(self):
+        """Bytes to send now (possibly empty); sets `finished` when the stream should end."""
+        out = self._pending; self._pending = []
+        with self.watcher.cond:
+            if self.generation != self.watcher.generation:
+                self.generation = self.watcher.generation; self.position = 0; self._decoder.reset()
+                out.append(_sse('reset', {'offset': 0}, 0))
+            size = self.watcher.size
+            oldest = self.watcher.chunks[0][0] if self.watcher.chunks else size
+            chunks = [(start, data) for start, data in self.watcher.chunks if start + len(data) > self.position]
+        if self.position < min(oldest, size): # Behind the buffer: catch up from disk (bounded)
+            gap_end = min(oldest, size)
+            if gap_end - self.position > config.TEXT_FOLLOW_MAX_CATCHUP: self.position = gap_end - config.TEXT_FOLLOW_MAX_CATCHUP
+            try:
+                with open(self.path, 'rb', buffering=0) as f: data = os.pread(f.fileno(), gap_end - self.position, self.position)
+                chunks.insert(0, (self.position, data))
+            except OSError as e: logger.warning(f"Follow catch-up read failed for '{self.path}': {e}")
+        for start, data in chunks:
+            data = data[self.position - start:] if start < self.position else data
+            if not data: continue
+            self.position += len(data)
+            out.append(_sse('append', {'text': self._decoder.decode(data), 'offset': self.position}, self.position))
+        now = time.monotonic()
+        if out: self.last_sent = now
+        elif now - self.last_sent >= config.TEXT_FOLLOW_KEEPALIVE: out.append(b": keep-alive\n\n"); self.last_sent = now
+        if now - self.started >= self.max_seconds: self.finished = True
+        return b''.join(out)
+
+    def __iter__(self):
+        while not self.finished:
+            data = self.poll()
+            if data: yield data; continue
+            with self.watcher.cond: self.watcher.cond.wait(config.TEXT_FOLLOW_POLL_INTERVAL)
+
+    def close(self):
+        if not self._closed: self._closed = True; self.watcher.unsubscribe()
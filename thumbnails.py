@@ -0,0 +1,132 @@
+# thumbnails.py
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config # Use our config file
+
+# Pillow is optional: without it the grid falls back to full-size images
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None; ImageOps = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# 1x1 transparent GIF returned (with 202) while a thumbnail is being generated
+PENDING_PLACEHOLDER_GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00'
+                           b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+
+# Formats Pillow can't (or shouldn't) rasterize; these are served as-is
+_UNSUPPORTED_EXTENSIONS = ('.svg',)
+
+_executor = None
+_pending = {} # cache key -> Future
+_failed = OrderedDict() # cache keys whose generation raised (LRU); not retried until the source changes
+_FAILED_MAX = 4096 # Failed keys remembered per worker
+_lock = threading.RLock() # Re-entrant: done callbacks may fire inside submit when a job finishes instantly
+
+
+# --- Cache Layout ---
+def thumbnail_key(item_id, mtime, size):
+    """Derivative cache key: changes whenever the source image's mtime or size changes."""
+    return f"{item_id}-{int(mtime * 1000):x}-{size:x}"
+
+def _thumbnail_path(key):
+    item_id = key.split('-', 1)[0]
+    return os.path.join(config.THUMBNAIL_CACHE_DIR, item_id[:2], f"{key}.jpg")
+
+def is_supported(file_path_abs):
+    """True if thumbnails can be generated for this file in this environment."""
+    return Image is not None and not file_path_abs.lower().endswith(_UNSUPPORTED_EXTENSIONS)
+
+
+# --- Worker (runs in the process pool) ---
+def _render_thumbnail(src_abs, dest_abs, max_size, quality):
+    """Decodes, orients, downsizes and writes one JPEG thumbnail atomically. Returns dest_abs."""
+    item_prefix = os.path.basename(dest_abs).split('-', 1)[0] + '-'
+    os.makedirs(os.path.dirname(dest_abs), exist_ok=True)
+    with Image.open(src_abs) as img:
+        img.draft('RGB', (max_size, max_size)) # JPEG: let libjpeg decode at 1/2..1/8 scale, much faster on a Pi
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size))
+        if img.mode != 'RGB': img = img.convert('RGB')
+        tmp_path = f"{dest_abs}.{os.getpid()}.tmp"
+        try:
+            img.save(tmp_path, 'JPEG', quality=quality, optimize=True)
+            os.replace(tmp_path, dest_abs)
+        except Exception:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+    # Drop thumbnails of older versions of the same item
+    for name in os.listdir(os.path.dirname(dest_abs)):
+        old_path = os.path.join(os.path.dirname(dest_abs), name)
+        if name.startswith(item_prefix) and old_path != dest_abs and name.endswith('.jpg'):
+            try: os.remove(old_path)
+            except OSError: pass
+    return dest_abs
+
+
+# --- Scheduling ---
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=config.THUMBNAIL_WORKERS)
+        logger.info(f"Thumbnail pool started with {config.THUMBNAIL_WORKERS} worker(s). Cache: {config.THUMBNAIL_CACHE_DIR}")
+    return _executor
+
+def _reset_executor(broken):
+    """Drops a pool that lost a worker process (e.g. to the OOM killer); the next submit starts a new one."""
+    global _executor
+    with _lock:
+        if _executor is not broken: return # Already replaced
+        _executor = None
+    logger.warning("Thumbnail pool broke (a worker process died); restarting it.")
+    broken.shutdown(wait=False)
+
+def _on_done(key, executor, future):
+    with _lock:
+        _pending.pop(key, None)
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool): _reset_executor(executor); return # Not this image's fault: retried on the next request
+        if error is not None:
+            _failed[key] = True
+            while len(_failed) > _FAILED_MAX: _failed.popitem(last=False)
+            logger.error(f"Thumbnail generation failed for key '{key}': {error}")
+
+def _submit(src_abs, thumb_path):
+    """(executor, future) for one render; a pool found broken at submit time is replaced once."""
+    for attempt in range(2):
+        executor = _get_executor()
+        try: return executor, executor.submit(_render_thumbnail, src_abs, thumb_path, config.THUMBNAIL_MAX_SIZE, config.THUMBNAIL_QUALITY)
+        except BrokenProcessPool:
+            if attempt: raise
+            _reset_executor(executor)
+
+def get_or_schedule(item_id, src_abs, stat_result):
+    """
+    Returns (status, path_or_key):
+      ('ready', thumbnail_path)  - cached thumbnail exists
+      ('pending', key)           - generation queued or running
+      ('unavailable', key)       - unsupported format, Pillow missing or generation failed
+    Never generates on the calling (request) thread.
+    """
+    key = thumbnail_key(item_id, stat_result.st_mtime, stat_result.st_size)
+    if not is_supported(src_abs): return 'unavailable', key
+    thumb_path = _thumbnail_path(key)
+    if os.path.isfile(thumb_path): return 'ready', thumb_path
+    with _lock:
+        if key in _failed: _failed.move_to_end(key); return 'unavailable', key
+        if key not in _pending:
+            try: executor, future = _submit(src_abs, thumb_path)
+            except Exception as e:
+                logger.error(f"Could not schedule thumbnail for '{src_abs}': {e}", exc_info=True)
+                return 'unavailable', key
+            _pending[key] = future
+            future.add_done_callback(lambda f, k=key, e=executor: _on_done(k, e, f))
+    return 'pending', key
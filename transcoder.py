@@ -0,0 +1,292 @@
+# transcoder.py
+import os
+import logging
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import config # Use our config file
+import file_utils
+import hls # Shared ffprobe helper and ffmpeg availability check
+import library_index
+
+# fcntl is POSIX-only; without it locks are process-local and each process runs one job at a time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Produces the QUALITY_SUFFIXES variants ('<name>_720p.mp4', ...) that get_quality_options discovers.
+# Jobs live in a small SQLite database shared by all workers; at most TRANSCODE_MAX_JOBS run at once
+# across the whole server (one flock'ed slot file per job), each ffmpeg niced below live streaming.
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY, parent TEXT NOT NULL, source_name TEXT NOT NULL, suffix TEXT NOT NULL,
+        source_mtime REAL NOT NULL, status TEXT NOT NULL, priority REAL NOT NULL DEFAULT 0,
+        progress REAL NOT NULL DEFAULT 0, error TEXT, owner_pid INTEGER,
+        created_at REAL NOT NULL, started_at REAL, finished_at REAL, UNIQUE (parent, source_name, suffix)
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id)",
+    "CREATE INDEX IF NOT EXISTS jobs_by_parent ON jobs (parent, status)",
+)
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+_local = threading.local()
+_worker_lock = threading.Lock()
+_local_locks = {} # lock name -> threading.Lock, standing in for the flock files where fcntl is unavailable
+_worker_pid = None # PID that started the worker threads (threads don't survive a fork)
+_prioritized = {} # parent path -> last time its jobs were bumped (per worker, throttles DB writes)
+_PRIORITIZE_INTERVAL = 60.0
+_PROGRESS_INTERVAL = 2.0 # Seconds between progress writes
+
+
+# --- Database ---
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid(): return conn
+    os.makedirs(os.path.dirname(config.TRANSCODE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.TRANSCODE_DB_PATH, timeout=config.LIBRARY_INDEX_BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in _SCHEMA: conn.execute(statement)
+    _local.conn = conn; _local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def _transaction():
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try: yield conn; conn.execute("COMMIT")
+    except BaseException: conn.execute("ROLLBACK"); raise
+
+
+# --- Variant Naming ---
+def _target_height(suffix):
+    """'_720p' -> 720 (from its QUALITY_SUFFIXES label)."""
+    return int(config.QUALITY_SUFFIXES[suffix].rstrip('p'))
+
+def _is_variant_name(name):
+    base, _ = os.path.splitext(name)
+    return any(base.endswith(suffix) for suffix in config.QUALITY_SUFFIXES)
+
+def _variant_name(source_name, suffix):
+    base, ext = os.path.splitext(source_name)
+    return f"{base}{suffix}{ext}"
+
+def _wanted_suffixes(source_name, sibling_names):
+    """Configured targets still missing for a source video (by name only; height is checked when the job runs)."""
+    if _is_variant_name(source_name) or os.path.splitext(source_name)[1].lower() not in config.TRANSCODE_CONTAINERS: return []
+    return [suffix for suffix in config.TRANSCODE_TARGETS if _variant_name(source_name, suffix) not in sibling_names]
+
+
+# --- Queueing ---
+def _enqueue(conn, parent, source_name, source_mtime, suffixes, priority):
+    """Inserts jobs; a failed job is retried once its source file has changed."""
+    now = time.time(); added = 0
+    for suffix in suffixes:
+        cursor = conn.execute(
+            "INSERT INTO jobs (parent, source_name, suffix, source_mtime, status, priority, created_at) VALUES (?, ?, ?, ?, 'queued', ?, ?) "
+            "ON CONFLICT (parent, source_name, suffix) DO UPDATE SET status = 'queued', source_mtime = excluded.source_mtime, "
+            "progress = 0, error = NULL, priority = MAX(priority, excluded.priority) WHERE status = 'failed' AND source_mtime != excluded.source_mtime",
+            (parent, source_name, suffix, source_mtime, priority, now))
+        added += cursor.rowcount
+    return added
+
+def discover_videos():
+    """Queues missing variants for every video in the library index. Returns the number of new jobs."""
+    by_parent = {}
+    for parent, name, _, mtime in library_index.iter_items_of_type('video'):
+        by_parent.setdefault(parent, []).append((name, mtime))
+    added = 0
+    with _transaction() as conn:
+        for parent, videos in by_parent.items():
+            names = {name for name, _ in videos}
+            for name, mtime in videos:
+                suffixes = _wanted_suffixes(name, names)
+                if suffixes: added += _enqueue(conn, parent, name, mtime, suffixes, priority=0)
+    if added: logger.info(f"Transcode discovery queued {added} new job(s).")
+    return added
+
+def prioritize_folder(relative_path, items):
+    """
+    Called when a folder is browsed: queues its videos' missing variants (if not queued yet) and moves
+    its queued jobs to the front. Throttled per folder, so repeated page loads cost nothing.
+    """
+    if not config.TRANSCODE_ENABLED: return
+    now = time.time()
+    if now - _prioritized.get(relative_path, 0) < _PRIORITIZE_INTERVAL: return
+    _prioritized[relative_path] = now
+    if len(_prioritized) > 1000: _prioritized.clear()
+    videos = [item for item in items if item['type'] == 'video']
+    if not videos: return
+    names = {item['path'].rsplit('/', 1)[-1] for item in videos}
+    try:
+        with _transaction() as conn:
+            for item in videos:
+                name = item['path'].rsplit('/', 1)[-1]
+                suffixes = _wanted_suffixes(name, names)
+                if suffixes: _enqueue(conn, relative_path, name, item['mtime'], suffixes, priority=now)
+            conn.execute("UPDATE jobs SET priority = ? WHERE parent = ? AND status = 'queued'", (now, relative_path))
+    except sqlite3.Error as e: logger.error(f"Could not prioritize transcodes for '{relative_path}': {e}")
+
+def _claim_next_job():
+    """Atomically marks the highest-priority queued job as running for this process and returns it."""
+    with _transaction() as conn:
+        row = conn.execute("SELECT id, parent, source_name, suffix FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id LIMIT 1").fetchone()
+        if row is None: return None
+        conn.execute("UPDATE jobs SET status = 'running', owner_pid = ?, started_at = ?, progress = 0 WHERE id = ?", (os.getpid(), time.time(), row[0]))
+    return {'id': row[0], 'parent': row[1], 'source_name': row[2], 'suffix': row[3]}
+
+def _finish_job(job_id, status, error=None):
+    with _transaction() as conn:
+        conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ?, progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END WHERE id = ?",
+                     (status, error, time.time(), status, job_id))
+
+def _requeue_orphans():
+    """Jobs left 'running' by a worker that died (or was restarted) go back to the queue."""
+    with _transaction() as conn:
+        for job_id, pid in conn.execute("SELECT id, owner_pid FROM jobs WHERE status = 'running'").fetchall():
+            if pid == os.getpid(): alive = False # This process runs one job at a time, and not right now
+            else:
+                try: os.kill(pid, 0); alive = True
+                except PermissionError: alive = True
+                except (OSError, TypeError): alive = False
+            if not alive: conn.execute("UPDATE jobs SET status = 'queued', owner_pid = NULL, progress = 0 WHERE id = ?", (job_id,))
+
+
+# --- Running a Job ---
+def _run_job(job):
+    """Encodes one variant next to its source. Returns (status, error)."""
+    source_relative = f"{job['parent']}/{job['source_name']}" if job['parent'] else job['source_name']
+    source_abs = file_utils.get_safe_fullpath(source_relative)
+    target_name = _variant_name(job['source_name'], job['suffix'])
+    target_abs = os.path.join(os.path.dirname(source_abs), target_name) if source_abs else None
+    if not source_abs or not os.path.isfile(source_abs): return 'failed', 'Source file no longer exists.'
+    if os.path.exists(target_abs): return 'done', None # Made by hand (or another worker) in the meantime
+    st = os.stat(source_abs)
+    info = hls.probe(source_abs, hls.source_key(file_utils.generate_item_id(source_relative), st))
+    if info is None: return 'failed', 'Could not probe source video.'
+    target_height = _target_height(job['suffix'])
+    if info.get('height') and info['height'] <= target_height: return 'done', f"Skipped: source is only {info['height']}p."
+
+    base, ext = os.path.splitext(target_name)
+    tmp_abs = os.path.join(os.path.dirname(source_abs), f".{base}.transcoding{ext}") # Hidden, so listings ignore it
+    cmd = [config.FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', source_abs,
+           '-map', '0:v:0', '-map', '0:a?', '-sn', '-dn',
+           '-vf', f"scale=-2:{target_height}", '-pix_fmt', 'yuv420p', '-c:v', config.HLS_VIDEO_ENCODER]
+    if config.HLS_VIDEO_ENCODER == 'libx264': cmd += ['-preset', config.TRANSCODE_X264_PRESET, '-crf', str(config.TRANSCODE_CRF)]
+    cmd += ['-c:a', 'aac', '-b:a', '160k', '-threads', str(config.TRANSCODE_THREADS)]
+    if ext.lower() in ('.mp4', '.mov'): cmd += ['-movflags', '+faststart']
+    cmd += ['-progress', 'pipe:1', '-nostats', tmp_abs]
+    logger.info(f"Transcoding '{source_relative}' -> {target_name}")
+    started = time.time()
+    # stderr goes to a file, never a pipe: a damaged source can print more errors than a pipe holds while we only read stdout
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+    except OSError as e: stderr_file.close(); return 'failed', f"Could not start ffmpeg: {e}"
+    watchdog = threading.Timer(config.TRANSCODE_JOB_TIMEOUT, proc.kill); watchdog.daemon = True; watchdog.start()
+    try:
+        try: os.setpriority(os.PRIO_PROCESS, proc.pid, config.TRANSCODE_NICENESS) # Live streams keep the CPU
+        except (OSError, AttributeError) as e: logger.warning(f"Could not renice ffmpeg: {e}")
+        last_update = 0.0
+        for line in proc.stdout: # '-progress' emits key=value lines
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us' and value.isdigit() and time.time() - last_update >= _PROGRESS_INTERVAL:
+                last_update = time.time()
+                progress = min(0.99, int(value) / 1e6 / info['duration'])
+                _connect().execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, job['id']))
+        proc.wait()
+        if proc.returncode != 0:
+            if time.time() - started >= config.TRANSCODE_JOB_TIMEOUT: return 'failed', f"Killed after TRANSCODE_JOB_TIMEOUT ({config.TRANSCODE_JOB_TIMEOUT}s)."
+            stderr_file.seek(max(0, os.fstat(stderr_file.fileno()).st_size - 2048)) # Only the tail matters
+            return 'failed', f"ffmpeg exited with {proc.returncode}: {stderr_file.read().decode('utf-8', 'replace').strip()[-500:]}"
+        try: os.link(tmp_abs, target_abs) # Never clobber a file created meanwhile
+        except FileExistsError: pass
+        except OSError: os.replace(tmp_abs, target_abs)
+    finally:
+        watchdog.cancel(); stderr_file.close()
+        if proc.poll() is None: proc.kill(); proc.wait()
+        if os.path.exists(tmp_abs): os.remove(tmp_abs)
+    file_utils.invalidate_directory_cache(job['parent'])
+    logger.info(f"Transcoded {target_name} in {time.time() - started:.0f}s")
+    return 'done', None
+
+
+# --- Worker Threads ---
+@contextmanager
+def _try_lock(name):
+    """Non-blocking server-wide flock on cache/<db>.<name>.lock (process-local without fcntl). Yields True if acquired."""
+    if fcntl is None:
+        with _worker_lock: lock = _local_locks.setdefault(name, threading.Lock())
+        if not lock.acquire(blocking=False): yield False; return
+        try: yield True
+        finally: lock.release()
+        return
+    os.makedirs(os.path.dirname(config.TRANSCODE_DB_PATH), exist_ok=True)
+    with open(f"{config.TRANSCODE_DB_PATH}.{name}.lock", 'a') as lock_file:
+        try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: yield False; return
+        try: yield True
+        finally: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@contextmanager
+def _slot():
+    """Holds one of TRANSCODE_MAX_JOBS server-wide job slots (one per process without fcntl). Yields True if one was free."""
+    for index in range(config.TRANSCODE_MAX_JOBS if fcntl is not None else 1):
+        with _try_lock(f"slot{index}") as acquired:
+            if acquired: yield True; return
+    yield False
+
+def _worker_loop():
+    last_discovery = 0.0
+    while True:
+        try:
+            if time.time() - last_discovery >= config.TRANSCODE_DISCOVERY_INTERVAL:
+                last_discovery = time.time()
+                with _try_lock('discovery') as acquired: # One worker at a time walks the index
+                    if acquired: _requeue_orphans(); discover_videos()
+            with _slot() as acquired:
+                job = _claim_next_job() if acquired else None
+                if job is not None:
+                    try: status, error = _run_job(job)
+                    except Exception as e: logger.error(f"Transcode job {job['id']} crashed: {e}", exc_info=True); status, error = 'failed', str(e)
+                    _finish_job(job['id'], status, error)
+                    continue # Look for the next job straight away
+        except Exception as e: logger.error(f"Transcode worker error: {e}", exc_info=True)
+        time.sleep(config.TRANSCODE_POLL_INTERVAL)
+
+def start_worker():
+    """Starts the transcode worker thread once per process (no-op unless enabled and ffmpeg is available)."""
+    global _worker_pid
+    if not config.TRANSCODE_ENABLED or _worker_pid == os.getpid(): return
+    with _worker_lock:
+        if _worker_pid == os.getpid(): return
+        _worker_pid = os.getpid()
+        if not hls.is_available(): logger.warning("Transcoding enabled but ffmpeg/ffprobe not found; not starting."); return
+        threading.Thread(target=_worker_loop, name='transcoder', daemon=True).start()
+        logger.info(f"Transcode worker started (pid {_worker_pid}). Targets: {', '.join(config.TRANSCODE_TARGETS)}")
+
+
+# --- Status ---
+def get_status(recent_limit=10):
+    """Queue depth per status, running jobs with progress, the next queued jobs and recent failures."""
+    conn = _connect()
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()))
+    def jobs(where, order):
+        rows = conn.execute(f"SELECT id, parent, source_name, suffix, status, progress, error, created_at, started_at, finished_at "
+                            f"FROM jobs WHERE {where} ORDER BY {order} LIMIT ?", (recent_limit,)).fetchall()
+        return [{'id': r[0], 'path': f"{r[1]}/{r[2]}" if r[1] else r[2], 'variant': config.QUALITY_SUFFIXES.get(r[3], r[3]), 'status': r[4],
+                 'progress': round(r[5], 3), 'error': r[6], 'created_at': r[7], 'started_at': r[8], 'finished_at': r[9]} for r in rows]
+    return {
+        'enabled': config.TRANSCODE_ENABLED, 'max_concurrent_jobs': config.TRANSCODE_MAX_JOBS, 'queue_depth': counts['queued'], 'counts': counts,
+        'running': jobs("status = 'running'", "started_at"), 'next': jobs("status = 'queued'", "priority DESC, id"),
+        'recent_failures': jobs("status = 'failed'", "finished_at DESC"),
+    }
@@ -0,0 +1,324 @@
+# uploads.py
+import os
+import re
+import errno
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+import config # Use our config file
+
+# fcntl is POSIX-only; on Windows sessions are only serialized within one process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+_SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_local_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """Upload failure carrying the HTTP status the route should return."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# --- Filename Handling ---
+def clean_upload_filename(original_filename):
+    """Returns (final_filename, error_message) for a client-supplied upload filename."""
+    cleaned_filename = str(original_filename or "").strip('. ')
+    if os.path.sep != '/': cleaned_filename = cleaned_filename.replace(os.path.sep, '_')
+    cleaned_filename = cleaned_filename.replace('/', '_')
+    if ".." in cleaned_filename:
+        return None, f"Filename '{original_filename}' contains invalid components ('..')."
+    if not cleaned_filename:
+        return None, f"Filename '{original_filename}' is invalid."
+    return cleaned_filename, None
+
+
+# --- Received Range Bookkeeping ---
+def merge_ranges(ranges, start, end):
+    """Adds the half-open range [start, end) to a sorted list of disjoint [start, end) pairs."""
+    merged = []
+    for r_start, r_end in sorted(list(ranges) + [[start, end]]):
+        if merged and r_start <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], r_end)
+        else: merged.append([r_start, r_end])
+    return merged
+
+def bytes_received(ranges):
+    return sum(r_end - r_start for r_start, r_end in ranges)
+
+
+# --- Session Storage (JSON files shared by all app workers) ---
+def _session_file(session_id):
+    return os.path.join(config.UPLOAD_SESSION_DIR, f"{session_id}.json")
+
+def _validate_session_id(session_id):
+    if not _SESSION_ID_RE.match(str(session_id or "")): raise UploadError("Invalid upload session ID.", 404)
+
+@contextmanager
+def _locked_session(session_id):
+    """Loads a session under an exclusive lock and writes back any changes on exit."""
+    _validate_session_id(session_id)
+    lock_path = _session_file(session_id) + '.lock'
+    if not os.path.exists(_session_file(session_id)): raise UploadError("Upload session not found or expired.", 404)
+    with _local_lock if fcntl is None else nullcontext():
+        with open(lock_path, 'a') as lock_f:
+            if fcntl is not None: fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(_session_file(session_id), 'r', encoding='utf-8') as f: session = json.load(f)
+                except FileNotFoundError: raise UploadError("Upload session not found or expired.", 404)
+                before = json.dumps(session, sort_keys=True)
+                yield session
+                if session.get('_deleted'): return
+                if json.dumps(session, sort_keys=True) != before: _write_session(session)
+            finally:
+                if fcntl is not None: fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+def _write_session(session):
+    path = _session_file(session['id'])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(session, f)
+    os.replace(tmp_path, path)
+
+def _remove_session_files(session):
+    for path in (session.get('temp_path'), _session_file(session['id']), _session_file(session['id']) + '.lock'):
+        if path and os.path.exists(path):
+            try: os.remove(path)
+            except OSError as e: logger.warning(f"Could not remove upload file '{path}': {e}")
+
+
+# --- Public API ---
+def purge_expired_sessions():
+    """Removes sessions (and their partial temp files) idle for longer than UPLOAD_SESSION_TTL."""
+    if not os.path.isdir(config.UPLOAD_SESSION_DIR): return
+    cutoff = time.time() - config.UPLOAD_SESSION_TTL
+    for name in os.listdir(config.UPLOAD_SESSION_DIR):
+        if not name.endswith('.json'): continue
+        try:
+            with _locked_session(name[:-5]) as session:
+                if session.get('updated', 0) < cutoff:
+                    logger.info(f"Purging expired upload session {session['id']} for '{session['filename']}'")
+                    _remove_session_files(session); session['_deleted'] = True
+        except (UploadError, OSError, ValueError): continue
+
+def create_session(target_dir_abs, target_relative_path, filename, size):
+    """Creates an upload session with a preallocated hidden temp file in the target directory."""
+    if size < 0 or size > config.UPLOAD_MAX_FILE_SIZE: raise UploadError(f"File size must be between 0 and {config.UPLOAD_MAX_FILE_SIZE} bytes.", 413)
+    destination_abs = os.path.join(target_dir_abs, filename)
+    if os.path.exists(destination_abs): raise UploadError(f"File '{filename}' already exists.", 409)
+    purge_expired_sessions()
+    os.makedirs(config.UPLOAD_SESSION_DIR, exist_ok=True)
+
+    session_id = uuid.uuid4().hex
+    # Temp file lives next to the destination (same filesystem, so finalize is an atomic rename).
+    # The leading dot hides it from listings and get_safe_fullpath.
+    temp_path = os.path.join(target_dir_abs, f".upload-{session_id}.part")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if size > 0: preallocate(fd, size)
+    except OSError as e:
+        os.close(fd); os.remove(temp_path)
+        raise UploadError(f"Not enough space for '{filename}': {e.strerror}", 507)
+    os.close(fd)
+
+    now = time.time()
+    session = {'id': session_id, 'filename': filename, 'target_path': target_relative_path, 'destination': destination_abs,
+               'temp_path': temp_path, 'size': size, 'received': [], 'created': now, 'updated': now}
+    _write_session(session)
+    logger.info(f"Upload session {session_id} created for '{filename}' ({size} bytes) in '{target_relative_path}'")
+    return session
+
+def preallocate(fd, size):
+    """Reserves disk space for the whole file up front (falls back to a sparse truncate)."""
+    if hasattr(os, 'posix_fallocate'):
+        try: os.posix_fallocate(fd, 0, size); return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL): raise # e.g. FAT/exFAT: fall through to truncate
+    os.ftruncate(fd, size)
+
+def _write_at(fd, buf, position):
+    if hasattr(os, 'pwrite'): os.pwrite(fd, buf, position)
+    else: os.lseek(fd, position, os.SEEK_SET); os.write(fd, buf) # fd is private to this request
+
+class _FileSink:
+    """
+    Buffers incoming data and writes it to an fd in UPLOAD_WRITE_BLOCK_SIZE-aligned blocks,
+    so the card sees a few large writes instead of many small ones. Applies the fsync policy.
+    """
+    def __init__(self, fd, start_offset=0):
+        self.fd = fd
+        self.position = start_offset # File offset of the first buffered byte
+        self.written = 0 # Bytes accepted so far (buffered or on disk)
+        self._buffer = bytearray()
+        self._since_sync = 0
+
+    def write(self, data):
+        self._buffer += data; self.written += len(data)
+        block = config.UPLOAD_WRITE_BLOCK_SIZE
+        if len(self._buffer) >= block:
+            flush_len = len(self._buffer) - len(self._buffer) % block
+            self._flush(flush_len)
+
+    def close(self):
+        """Writes any remainder and fsyncs unless the policy is 'none'."""
+        if self._buffer: self._flush(len(self._buffer))
+        if config.UPLOAD_FSYNC_POLICY != 'none': os.fsync(self.fd)
+
+    def _flush(self, length):
+        view = memoryview(self._buffer)[:length]
+        _write_at(self.fd, view, self.position)
+        view.release()
+        del self._buffer[:length]
+        self.position += length; self._since_sync += length
+        if config.UPLOAD_FSYNC_POLICY == 'interval' and self._since_sync >= config.UPLOAD_FSYNC_INTERVAL_BYTES:
+            os.fsync(self.fd); self._since_sync = 0 # Bounds dirty page cache during huge uploads
+
+def _log_throughput(label, num_bytes, started):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logger.info(f"{label}: {num_bytes / (1024*1024):.1f} MB in {elapsed:.2f}s ({num_bytes / (1024*1024) / elapsed:.1f} MB/s)")
+
+def _commit_temp_file(temp_path, destination, filename):
+    """Moves a finished temp file into place without ever overwriting an existing file."""
+    try:
+        # link() fails if the destination appeared meanwhile, so we never clobber a file
+        os.link(temp_path, destination); os.remove(temp_path)
+    except FileExistsError:
+        raise UploadError(f"File '{filename}' already exists.", 409)
+    except OSError:
+        # Filesystems without hard links (FAT/exFAT): plain rename after an existence check
+        if os.path.exists(destination): raise UploadError(f"File '{filename}' already exists.", 409)
+        os.replace(temp_path, destination)
+
+def get_status(session_id):
+    with _locked_session(session_id) as session:
+        return session_status(session)
+
+def session_status(session):
+    received = bytes_received(session['received'])
+    return {'session_id': session['id'], 'filename': session['filename'], 'size': session['size'],
+            'received': session['received'], 'bytes_received': received, 'complete': received >= session['size']}
+
+def write_chunk(session_id, offset, stream, content_length):
+    """
+    Writes a request body at `offset` into the session's temp file with pwrite.
+    Whatever arrived before a disconnect is still recorded, so the client only resends the gap.
+    """
+    with _locked_session(session_id) as session:
+        size = session['size']; temp_path = session['temp_path']
+    if content_length is None:
+        raise UploadError("Chunk uploads need a Content-Length header.", 411)
+    if offset < 0 or offset + content_length > size:
+        raise UploadError(f"Chunk [{offset}, {offset}+{content_length}) is outside file of {size} bytes.", 416)
+
+    written = 0; started = time.monotonic()
+    fd = os.open(temp_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    sink = _FileSink(fd, offset)
+    try:
+        while sink.written < content_length:
+            buf = stream.read(min(config.UPLOAD_WRITE_BLOCK_SIZE, content_length - sink.written))
+            if not buf: break
+            sink.write(buf)
+    finally:
+        try: sink.close(); written = sink.written
+        finally: os.close(fd)
+        # Record under the lock (other workers may be writing other chunks of the same file)
+        if written:
+            with _locked_session(session_id) as session:
+                session['received'] = merge_ranges(session['received'], offset, offset + written)
+                session['updated'] = time.time()
+    _log_throughput(f"Upload {session_id} chunk at {offset}", written, started)
+    if written < content_length: raise UploadError(f"Chunk truncated: received {written} of {content_length} bytes.", 400)
+    return get_status(session_id)
+
+def finalize(session_id):
+    """Verifies every byte arrived and atomically moves the temp file into place."""
+    with _locked_session(session_id) as session:
+        if bytes_received(session['received']) < session['size']:
+            raise UploadError("Upload incomplete; query the session for missing ranges.", 409)
+        # Chunks were already fsynced as they were written (unless UPLOAD_FSYNC_POLICY is 'none')
+        _commit_temp_file(session['temp_path'], session['destination'], session['filename'])
+        destination = session['destination']
+        logger.info(f"Upload session {session_id} finalized: '{destination}'")
+        _remove_session_files(session); session['_deleted'] = True
+        return {'filename': session['filename'], 'target_path': session['target_path']}
+
+def abort_session(session_id):
+    with _locked_session(session_id) as session:
+        _remove_session_files(session); session['_deleted'] = True
+        logger.info(f"Upload session {session_id} aborted for '{session['filename']}'")
+        return session['target_path']
+
+
+# --- Streaming Multipart Upload (single write, no werkzeug spool file) ---
+def receive_multipart_upload(stream, boundary, content_length, target_dir_abs, field_name='file'):
+    """
+    Parses a multipart/form-data body incrementally and writes the first `field_name` file part
+    straight into a hidden temp file in target_dir_abs, then commits it with an atomic rename.
+    Each uploaded byte is written once. Returns the final filename; raises UploadError.
+    """
+    # The decoder's own memory limit would apply to file data too, so plain fields are limited below
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    started = time.monotonic()
+    in_file_part = False; done_with_file = False; body_ended = False; field_size = 0
+    final_filename = None; temp_path = None; fd = None; sink = None
+    try:
+        while True:
+            try: event = decoder.next_event()
+            except ValueError as e: raise UploadError(f"Malformed multipart body: {e}", 400)
+            if isinstance(event, NeedData):
+                if body_ended: raise UploadError("Upload body ended unexpectedly.", 400)
+                data = stream.read(config.UPLOAD_WRITE_BLOCK_SIZE)
+                body_ended = not data
+                decoder.receive_data(data or None) # None tells the decoder the body has ended
+                continue
+            if isinstance(event, Epilogue): break
+            if isinstance(event, Field):
+                in_file_part = False; field_size = 0
+            elif isinstance(event, File):
+                in_file_part = event.name == field_name and not done_with_file; field_size = 0
+                if not in_file_part: continue
+                final_filename, filename_error = clean_upload_filename(event.filename)
+                if filename_error: raise UploadError(filename_error, 400)
+                destination = os.path.join(target_dir_abs, final_filename)
+                if os.path.exists(destination): raise UploadError(f"File '{final_filename}' already exists.", 409)
+                temp_path = os.path.join(target_dir_abs, f".upload-{uuid.uuid4().hex}.part")
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+                if content_length and content_length <= config.UPLOAD_MAX_FILE_SIZE:
+                    try: preallocate(fd, content_length) # Body length is an upper bound; trimmed after
+                    except OSError as e: raise UploadError(f"Not enough space for '{final_filename}': {e.strerror}", 507)
+                sink = _FileSink(fd)
+            elif isinstance(event, Data) and in_file_part:
+                sink.write(event.data)
+                if not event.more_data:
+                    in_file_part = False; done_with_file = True
+                    sink.close(); os.ftruncate(fd, sink.written)
+                    os.close(fd); fd = None
+            elif isinstance(event, Data):
+                # Plain form fields and extra file parts are discarded, but bounded
+                field_size += len(event.data)
+                if field_size > config.UPLOAD_MAX_FORM_MEMORY: raise UploadError("Form field too large.", 413)
+
+        if not done_with_file: raise UploadError(f"No '{field_name}' file part in the request.", 400)
+        _commit_temp_file(temp_path, os.path.join(target_dir_abs, final_filename), final_filename)
+        temp_path = None
+        _log_throughput(f"Upload '{final_filename}'", sink.written, started)
+        return final_filename
+    finally:
+        if fd is not None: os.close(fd)
+        if temp_path and os.path.exists(temp_path):
+            try: os.remove(temp_path)
+            except OSError: pass
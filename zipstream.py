@@ -0,0 +1,218 @@
+# zipstream.py
+import os
+import time
+import zlib
+import bisect
+import struct
+import hashlib
+import logging
+import sqlite3
+import threading
+
+import config # Use our config file
+import bandwidth
+import file_utils
+import streaming
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+logger.setLevel(config.LOG_LEVEL)
+
+# Folder downloads as ZIP64 archives with every member stored (media doesn't compress), streamed straight from the
+# files. Since nothing is compressed, the whole byte layout - and so Content-Length - follows from the names and
+# sizes alone, and any byte offset maps to a member header, a range of one file, a data descriptor or the central
+# directory. Only the CRC-32s aren't known up front: each member carries a data descriptor after its data, and CRCs
+# computed while sending are kept in ZIP_CRC_DB_PATH, so a resumed download rarely has to re-read what it skipped.
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_DESCRIPTOR = struct.Struct('<IIQQ')
+_ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_LOCATOR = struct.Struct('<IIQI')
+_END = struct.Struct('<IHHHHIIH')
+_LOCAL_EXTRA_SIZE = 20 # ZIP64 extra: tag, size, uncompressed and compressed size
+_CENTRAL_EXTRA_SIZE = 28 # ZIP64 extra: tag, size, both sizes and the local header offset
+_VERSION = 45 # ZIP64
+_FLAGS = 0x0008 # Sizes/CRC in a data descriptor after the data
+_FLAG_UTF8 = 0x0800
+_LOOKUP_BATCH = 500 # Paths per SELECT (SQLite parameter limit)
+_READ_SIZE = 1024 * 1024 # Block size when a CRC has to be computed from the file
+
+_local = threading.local()
+
+
+# --- CRC Cache (shared by workers) ---
+def _to_blob(text):
+    return text.encode(config.FILESYSTEM_ENCODING, 'surrogateescape')
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid(): return conn
+    os.makedirs(os.path.dirname(config.ZIP_CRC_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.ZIP_CRC_DB_PATH, timeout=config.LIBRARY_INDEX_BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # A lost row is just computed again
+    conn.execute("CREATE TABLE IF NOT EXISTS crcs (path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, crc INTEGER NOT NULL) WITHOUT ROWID")
+    _local.conn = conn; _local.pid = os.getpid()
+    return conn
+
+def _load_crcs(members):
+    """{member: crc} for the members with a current cache row."""
+    found = {}
+    try:
+        conn = _connect()
+        for i in range(0, len(members), _LOOKUP_BATCH):
+            batch = {_to_blob(m.path): m for m in members[i:i + _LOOKUP_BATCH]}
+            for path, size, mtime, crc in conn.execute(f"SELECT path, size, mtime, crc FROM crcs WHERE path IN ({','.join('?' * len(batch))})", list(batch)):
+                member = batch[bytes(path)]
+                if (size, mtime) == (member.size, member.mtime): found[member] = crc
+    except sqlite3.Error as e: logger.error(f"ZIP CRC cache read failed: {e}")
+    return found
+
+def _store_crc(member, crc):
+    try: _connect().execute("INSERT OR REPLACE INTO crcs (path, size, mtime, crc) VALUES (?, ?, ?, ?)", (_to_blob(member.path), member.size, member.mtime, crc))
+    except sqlite3.Error as e: logger.error(f"ZIP CRC cache write failed for '{member.path}': {e}")
+
+def _file_crc(file_path_abs, length, crc=0):
+    """CRC-32 of the first `length` bytes of a file."""
+    with open(file_path_abs, 'rb', buffering=0) as f:
+        position = 0
+        while position < length:
+            block = os.pread(f.fileno(), min(_READ_SIZE, length - position), position)
+            if not block: raise OSError(f"'{file_path_abs}' is shorter than expected")
+            crc = zlib.crc32(block, crc); position += len(block)
+    return crc
+
+
+# --- Archive Layout ---
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980: return 0, (1 << 5) | 1 # 1980-01-01, the earliest DOS date
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((min(t.tm_year, 2107) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class ZipMember:
+    """One file in the archive, with its local header (which needs no CRC) prebuilt."""
+    __slots__ = ('path', 'name', 'size', 'mtime', 'flags', 'dos_time', 'dos_date', 'offset', 'header')
+
+    def __init__(self, path, name, size, mtime, offset):
+        self.path = path; self.size = size; self.mtime = mtime; self.offset = offset
+        self.name = _to_blob(name)
+        try: self.name.decode('utf-8'); self.flags = _FLAGS | _FLAG_UTF8
+        except UnicodeDecodeError: self.flags = _FLAGS # Undecodable names go out as their raw bytes
+        self.dos_time, self.dos_date = _dos_datetime(mtime)
+        self.header = (_LOCAL_HEADER.pack(0x04034b50, _VERSION, self.flags, 0, self.dos_time, self.dos_date, 0, 0xFFFFFFFF, 0xFFFFFFFF, len(self.name), _LOCAL_EXTRA_SIZE)
+                       + self.name + struct.pack('<HHQQ', 0x0001, 16, size, size))
+
+    @property
+    def end(self):
+        """Archive offset just past this member's data descriptor."""
+        return self.offset + len(self.header) + self.size + _DESCRIPTOR.size
+
+    def descriptor(self, crc):
+        return _DESCRIPTOR.pack(0x08074b50, crc, self.size, self.size)
+
+    def central_entry(self, crc):
+        return (_CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | _VERSION, _VERSION, self.flags, 0, self.dos_time, self.dos_date, crc, 0xFFFFFFFF, 0xFFFFFFFF,
+                                     len(self.name), _CENTRAL_EXTRA_SIZE, 0, 0, 0, 0o100644 << 16, 0xFFFFFFFF)
+                + self.name + struct.pack('<HHQQQ', 0x0001, 24, self.size, self.size, self.offset))
+
+class ZipArchive:
+    """Byte layout of a folder's archive: members, central directory and ZIP64 end records."""
+    def __init__(self, members):
+        self.members = members; self.offsets = [m.offset for m in members]
+        self.cd_offset = members[-1].end if members else 0
+        self.cd_offsets = []; position = self.cd_offset # Start of each member's central directory entry
+        for m in members: self.cd_offsets.append(position); position += _CENTRAL_HEADER.size + len(m.name) + _CENTRAL_EXTRA_SIZE
+        self.cd_size = position - self.cd_offset
+        count = len(members); zip64_end = position
+        self.trailer = (_ZIP64_END.pack(0x06064b50, _ZIP64_END.size - 12, (3 << 8) | _VERSION, _VERSION, 0, 0, count, count, self.cd_size, self.cd_offset)
+                        + _ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end, 1)
+                        + _END.pack(0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), min(self.cd_size, 0xFFFFFFFF), min(self.cd_offset, 0xFFFFFFFF), 0))
+        self.size = position + len(self.trailer)
+        digest = hashlib.sha1()
+        for m in members: digest.update(b'%s\0%d\0%r\0' % (m.name, m.size, m.mtime))
+        self.etag = f"zip-{digest.hexdigest()[:24]}"
+        self._crcs = {} # member -> CRC-32, as they become known
+
+    def crc(self, member):
+        """CRC-32 of a member: known from sending it, cached, or (last resort) read from the file."""
+        crc = self._crcs.get(member)
+        if crc is None:
+            crc = _load_crcs([member]).get(member)
+            if crc is None: crc = _file_crc(os.path.join(config.MEDIA_DIR_BASE, member.path), member.size); _store_crc(member, crc)
+            self._crcs[member] = crc
+        return crc
+
+    def _known(self, member, crc):
+        self._crcs[member] = crc; _store_crc(member, crc)
+
+    # --- Body ---
+    def iter_range(self, start, stop, chunk_size=None, client=None):
+        """Yields archive bytes [start, stop)."""
+        position = start
+        for i in range(max(0, bisect.bisect_right(self.offsets, start) - 1), len(self.members)):
+            if position >= stop: return
+            m = self.members[i]; data_start = m.offset + len(m.header); data_end = data_start + m.size
+            if position < data_start: # Local header
+                yield m.header[position - m.offset:min(stop, data_start) - m.offset]; position = min(stop, data_start)
+            if position < stop and position < data_end:
+                crc = yield from self._iter_data(m, position - data_start, min(stop, data_end) - data_start, stop > data_end, chunk_size, client)
+                position = min(stop, data_end)
+                if crc is not None: self._known(m, crc)
+            if position < stop and position < m.end: # Data descriptor
+                yield m.descriptor(self.crc(m))[position - data_end:min(stop, m.end) - data_end]; position = min(stop, m.end)
+        if position < stop and position < self.cd_offset + self.cd_size: # Central directory
+            first = max(0, bisect.bisect_right(self.cd_offsets, position) - 1)
+            missing = [m for m in self.members[first:] if m not in self._crcs]
+            if missing: self._crcs.update(_load_crcs(missing))
+            batch = bytearray(); batch_start = self.cd_offsets[first]
+            for m in self.members[first:]:
+                batch += m.central_entry(self.crc(m))
+                if len(batch) >= config.CHUNK_SIZE or m is self.members[-1]:
+                    lo = max(position, batch_start); hi = min(stop, batch_start + len(batch))
+                    if lo < hi: yield bytes(batch[lo - batch_start:hi - batch_start]); position = hi
+                    batch_start += len(batch); batch = bytearray()
+                    if position >= stop: return
+        trailer_start = self.cd_offset + self.cd_size
+        if position < stop: yield self.trailer[position - trailer_start:stop - trailer_start]
+
+    def _iter_data(self, member, start, stop, want_crc, chunk_size, client):
+        """Yields member data [start, stop); returns the member's CRC-32 if want_crc and it wasn't known yet."""
+        file_path_abs = os.path.join(config.MEDIA_DIR_BASE, member.path) # Paths come from listings, already validated
+        st = os.stat(file_path_abs)
+        if (st.st_size, st.st_mtime) != (member.size, member.mtime): raise OSError(f"'{member.path}' changed since the download started")
+        crc = None
+        if want_crc and member not in self._crcs:
+            cached = _load_crcs([member]).get(member)
+            if cached is not None: self._crcs[member] = cached
+            else: crc = _file_crc(file_path_abs, start) if start else 0 # Resumed mid-file: the skipped part still counts
+        sent = 0
+        for chunk in streaming.iter_file_range(file_path_abs, start, stop - start, chunk_size, 'download', client):
+            if crc is not None: crc = zlib.crc32(chunk, crc)
+            sent += len(chunk); yield chunk
+        if sent != stop - start: raise OSError(f"'{member.path}' ended early (sent {sent} of {stop - start} bytes)")
+        return crc
+
+
+def build_archive(relative_path):
+    """
+    ZipArchive of every file in a folder and below it (names start with the folder's own name; empty folders are left out).
+    Each member is stat'd here: listing rows can predate an in-place edit, and the layout must match what _iter_data reads.
+    """
+    root_name = os.path.basename(relative_path) or 'media_root'; prefix_length = len(relative_path) + 1 if relative_path else 0
+    members = []; offset = 0
+    for _, items in file_utils.walk_folder(relative_path):
+        for item in items:
+            if item['type'] == 'folder': continue
+            try: st = os.stat(os.path.join(config.MEDIA_DIR_BASE, item['path']))
+            except OSError: continue # Removed since it was listed
+            member = ZipMember(item['path'], f"{root_name}/{item['path'][prefix_length:]}", st.st_size, st.st_mtime, offset)
+            members.append(member); offset = member.end
+    return ZipArchive(members)
+
+def open_body(environ, archive, start, stop):
+    """WSGI body for archive bytes [start, stop), paced by the bandwidth scheduler while limits are set."""
+    client = bandwidth.client_key(environ)
+    if bandwidth.is_limited():
+        return bandwidth.ThrottledBody(archive.iter_range(start, stop, config.BANDWIDTH_CHUNK_SIZE, client), client, 'download')
+    return archive.iter_range(start, stop, client=client)